@@ -18,17 +18,47 @@
 
 from __future__ import annotations
 
+import contextlib
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
 
-from craft_application import Application, AppMetadata, errors
+import craft_providers
+import pydantic
+from craft_application import Application, AppMetadata, ConfigModel, errors
+from craft_cli import emit
 from overrides import override  # type: ignore[reportUnknownVariableType]
 
-from rockcraft import plugins
+from rockcraft import image_cache, plugins
+from rockcraft.errors import RockcraftError
 from rockcraft.models import project
 
 if TYPE_CHECKING:
+    import craft_platforms
     from craft_parts.plugins.plugins import PluginType
 
+# Options of the lifecycle commands that need the terminal of the instance.
+_INTERACTIVE_OPTIONS = ("--shell", "--shell-after", "--debug")
+
+
+class RockcraftConfigModel(ConfigModel):
+    """Rockcraft's configuration, set with ROCKCRAFT_* environment variables."""
+
+    base_image_cache_dir: str | None = None
+    """Directory of the base image cache shared by all projects."""
+    base_image_cache_max_size: pydantic.ByteSize = pydantic.ByteSize(
+        image_cache.DEFAULT_MAX_SIZE
+    )
+    """Size above which the least recently used base images are evicted."""
+    base_image_tag_ttl: pydantic.NonNegativeInt = image_cache.DEFAULT_TAG_TTL
+    """Seconds for which a base image tag resolved from the registry is reused."""
+    max_parallel_builds: pydantic.PositiveInt | None = None
+    """Platforms built at the same time in managed mode (default: the number of CPUs)."""
+
+
 APP_METADATA = AppMetadata(
     name="rockcraft",
     summary="A tool to create OCI images",
@@ -37,6 +67,7 @@ APP_METADATA = AppMetadata(
     docs_url="https://documentation.ubuntu.com/rockcraft/en/{version}",
     check_supported_base=True,
     artifact_type="rock",
+    ConfigModel=RockcraftConfigModel,
 )
 
 
@@ -51,6 +82,127 @@ class Rockcraft(Application):
         self.services.update_kwargs("init", default_name="my-rock-name")
         super()._configure_services(provider_name)
 
+    @override
+    def run_managed(self, platform: str | None, build_for: str | None) -> None:
+        """Run the application in managed instances, several platforms at once.
+
+        As in craft-application, each platform of the build plan is built in
+        its own instance, but up to ``max_parallel_builds`` instances run at
+        the same time. Instances are still launched one at a time, because
+        launching one may create the base instance that the others copy.
+
+        A single platform, or builds with the fetch service, are run by
+        craft-application as usual.
+
+        :raises RockcraftError: If several platforms are built at once with an
+            option that opens a shell in the instance.
+        """
+        build_planner = self.services.get("build_plan")
+        if platform:
+            build_planner.set_platforms(platform)
+        if build_for:
+            build_planner.set_build_fors(build_for)
+        plan = build_planner.plan()
+
+        max_builds = self.services.get("config").get("max_parallel_builds")
+        jobs = min(len(plan), max_builds or os.cpu_count() or 1)
+        fetch_service = self.services.get("fetch")
+        # A fetch-service session is tied to a single instance.
+        if (
+            jobs <= 1
+            or self._enable_fetch_service
+            or fetch_service.is_active(enable_command_line=self._enable_fetch_service)
+        ):
+            super().run_managed(platform, build_for)
+            return
+
+        interactive = [arg for arg in sys.argv[1:] if arg in _INTERACTIVE_OPTIONS]
+        if interactive:
+            raise RockcraftError(
+                f"Cannot use {interactive[0]!r} while building {len(plan)} "
+                f"platforms at once.",
+                resolution=(
+                    "Select a single platform with '--platform', or set "
+                    "ROCKCRAFT_MAX_PARALLEL_BUILDS to 1."
+                ),
+            )
+
+        emit.progress(
+            f"Building {len(plan)} platforms, {jobs} at a time", permanent=True
+        )
+        launch_lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(self._run_in_instance, build_info, launch_lock)
+                for build_info in plan
+            ]
+        # Every build runs to completion; all the failures are reported.
+        failures: dict[str, Exception] = {}
+        for build_info, future in zip(plan, futures, strict=True):
+            error = future.exception()
+            if isinstance(error, Exception):
+                failures[build_info.platform] = error
+            elif error is not None:
+                raise error
+        if failures:
+            raise craft_providers.ProviderError(
+                f"Failed to execute {self.app.name} in instances for platforms: "
+                f"{', '.join(failures)}.",
+                details="\n".join(
+                    f"{platform}: {error}" for platform, error in failures.items()
+                ),
+            ) from next(iter(failures.values()))
+
+    def _run_in_instance(
+        self, build_info: craft_platforms.BuildInfo, launch_lock: threading.Lock
+    ) -> None:
+        """Run the application for one platform in its managed instance.
+
+        The output of the instance is shown line by line, prefixed with the
+        name of the platform. As the output of several instances is
+        interleaved, the lines are kept rather than shown as progress.
+
+        :param build_info: The build of the platform.
+        :param launch_lock: The lock held while launching the instance.
+        """
+        env: dict[str, str | None] = {
+            "CRAFT_PLATFORM": build_info.platform,
+            "CRAFT_VERBOSITY_LEVEL": emit.get_mode().name,
+        }
+        cmd = [self.app.name, *sys.argv[1:]]
+        with contextlib.ExitStack() as stack:
+            with launch_lock:
+                instance = stack.enter_context(
+                    self.services.get("provider").instance(
+                        build_info,
+                        work_dir=self._work_dir,
+                        clean_existing=False,
+                        use_base_instance=True,
+                    )
+                )
+                env.update(self.services.get("proxy").configure_instance(instance))
+
+            emit.debug(
+                f"Executing {cmd} in the {build_info.platform} instance with {env}."
+            )
+            with instance.execute_popen(
+                cmd,
+                cwd=self.app.managed_instance_project_path,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+            ) as process:
+                for line in process.stdout or []:
+                    emit.message(f"[{build_info.platform}] {line.rstrip()}")
+
+        if process.returncode:
+            raise craft_providers.ProviderError(
+                f"Failed to execute {self.app.name} in instance "
+                f"for platform {build_info.platform!r} "
+                f"(exit code {process.returncode})."
+            )
+
     @override
     def _get_app_plugins(self) -> dict[str, PluginType]:
         """Get the plugins for this application.
@@ -0,0 +1,128 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lock file pinning the base images of a project to registry digests."""
+
+import re
+from pathlib import Path
+from typing import Any
+
+import yaml
+
+from rockcraft import errors
+
+LOCK_FILE_NAME = "rockcraft.lock"
+
+_DIGEST_RE = re.compile(r"^sha256:[0-9a-f]{64}$")
+
+_HEADER = (
+    "# This file is generated by rockcraft to pin the base images of the\n"
+    "# project. Run 'rockcraft pack --update-lock' to update it.\n"
+)
+
+
+class BaseLock:
+    """The digests of the base images of a project, per architecture.
+
+    The lock file looks like::
+
+        bases:
+          ubuntu@24.04:
+            amd64: sha256:...
+
+    :param path: The path of the lock file.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._bases: dict[str, dict[str, str]] = {}
+        self._changed = False
+
+    @classmethod
+    def load(cls, project_dir: Path) -> "BaseLock":
+        """Load the lock file of a project, which may not exist yet.
+
+        :param project_dir: The directory of the project.
+        """
+        lock = cls(project_dir / LOCK_FILE_NAME)
+        if not lock.path.exists():
+            return lock
+
+        try:
+            data: Any = yaml.safe_load(lock.path.read_text())
+        except yaml.YAMLError as err:
+            raise errors.RockcraftError(
+                f"Invalid lock file {str(lock.path)!r}: {err}",
+                resolution="Fix the file, or remove it to pin the bases again.",
+            ) from err
+
+        bases = data.get("bases") if isinstance(data, dict) else None
+        if not isinstance(bases, dict):
+            bases = {}
+        for base, digests in bases.items():
+            if not isinstance(digests, dict):
+                continue
+            for arch, digest in digests.items():
+                if not isinstance(digest, str) or not _DIGEST_RE.match(digest):
+                    raise errors.RockcraftError(
+                        f"Invalid digest for {base} on {arch} in {str(lock.path)!r}",
+                        resolution="Run 'rockcraft pack --update-lock'.",
+                    )
+                lock._bases.setdefault(str(base), {})[str(arch)] = digest
+
+        return lock
+
+    @property
+    def path(self) -> Path:
+        """The path of the lock file."""
+        return self._path
+
+    def get(self, base: str, arch: str) -> str | None:
+        """Get the pinned digest of a base image, if any.
+
+        :param base: The base image, in ``name@tag`` format.
+        :param arch: The architecture of the image, in Debian format.
+        :returns: The digest, as ``sha256:<hex>``.
+        """
+        return self._bases.get(base, {}).get(arch)
+
+    def set(self, base: str, arch: str, digest: str) -> None:
+        """Pin the digest of a base image.
+
+        :param base: The base image, in ``name@tag`` format.
+        :param arch: The architecture of the image, in Debian format.
+        :param digest: The digest, as ``sha256:<hex>``.
+        """
+        if not _DIGEST_RE.match(digest):
+            raise ValueError(f"Bad digest: {digest}")
+        if self.get(base, arch) != digest:
+            self._bases.setdefault(base, {})[arch] = digest
+            self._changed = True
+
+    def save(self) -> None:
+        """Write the lock file, if any digest changed."""
+        if not self._changed:
+            return
+        data = {
+            "bases": {
+                base: dict(sorted(digests.items()))
+                for base, digests in sorted(self._bases.items())
+            }
+        }
+        temp_path = self._path.with_suffix(".lock.tmp")
+        temp_path.write_text(_HEADER + yaml.safe_dump(data, sort_keys=False))
+        temp_path.replace(self._path)
+        self._changed = False
@@ -34,7 +34,15 @@ COMMAND_GROUPS: list[CommandGroup] = [
             commands.ExpandExtensionsCommand,
         ],
     ),
-    CommandGroup("Lifecycle", [appcommands.TestCommand, appcommands.RemoteBuild]),
+    CommandGroup(
+        "Lifecycle",
+        [
+            commands.PackCommand,
+            commands.MergeCommand,
+            appcommands.TestCommand,
+            appcommands.RemoteBuild,
+        ],
+    ),
 ]
 
 
@@ -21,9 +21,13 @@ from .extensions import (
     ExtensionsCommand,
     ListExtensionsCommand,
 )
+from .lifecycle import PackCommand
+from .merge import MergeCommand
 
 __all__ = [
     "ExpandExtensionsCommand",
     "ExtensionsCommand",
     "ListExtensionsCommand",
+    "MergeCommand",
+    "PackCommand",
 ]
@@ -0,0 +1,200 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lifecycle-related cli commands."""
+
+import argparse
+import os
+import pathlib
+from typing import TYPE_CHECKING, Any, cast
+
+from craft_application.commands import lifecycle
+from craft_cli import emit
+from overrides import overrides  # type: ignore[reportUnknownVariableType]
+
+from rockcraft import errors, processes, timings
+from rockcraft.compression import COMPRESSION_ALGORITHMS, LayerCompression
+from rockcraft.services.package import LAYER_MODES, PackOptions
+
+if TYPE_CHECKING:
+    from rockcraft.services import RockcraftImageService, RockcraftPackageService
+
+
+def _positive_int(value: str) -> int:
+    """Parse a strictly positive integer command line argument."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"invalid positive integer: {value!r}")
+    return number
+
+
+class PackCommand(lifecycle.PackCommand):
+    """Command to pack the final rock, with Rockcraft-specific options."""
+
+    @overrides
+    def _fill_parser(self, parser: argparse.ArgumentParser) -> None:
+        super()._fill_parser(parser)
+
+        parser.add_argument(
+            "--compression",
+            choices=COMPRESSION_ALGORITHMS,
+            default="gzip",
+            help="Compression algorithm for the layers of the rock (default: gzip)",
+        )
+        parser.add_argument(
+            "--compression-level",
+            type=_positive_int,
+            metavar="LEVEL",
+            help=(
+                "Compression level for the layers of the rock "
+                "(default: 6 for gzip, 3 for zstd)"
+            ),
+        )
+        parser.add_argument(
+            "--compression-threads",
+            type=_positive_int,
+            metavar="N",
+            help=(
+                "Number of threads used to compress each layer "
+                "(default: the number of available CPUs)"
+            ),
+        )
+        parser.add_argument(
+            "--deduplicate-files",
+            action="store_true",
+            help=(
+                "Store files with identical contents, mode and owner "
+                "as hard links to a single copy"
+            ),
+        )
+        parser.add_argument(
+            "--layers",
+            choices=LAYER_MODES,
+            default="single",
+            help=(
+                "Split the primed files into a single layer, one layer per part, "
+                "or one layer per group of parts at the same depth of their "
+                "'after' dependencies (default: single)"
+            ),
+        )
+        parser.add_argument(
+            "--layer-cache-from",
+            type=pathlib.Path,
+            metavar="ROCK",
+            help=(
+                "Reuse the layers of a previously packed rock "
+                "when their content is unchanged"
+            ),
+        )
+        parser.add_argument(
+            "--separate-synthetic-layers",
+            action="store_true",
+            help=(
+                "Add the rock's user, Pebble layer and control data in one layer "
+                "each, instead of a single layer"
+            ),
+        )
+        parser.add_argument(
+            "--timings",
+            type=pathlib.Path,
+            metavar="FILE",
+            help=(
+                "Write a timeline of the build, in the Chrome trace event format, "
+                "to FILE; '{platform}' in FILE is replaced by the platform name"
+            ),
+        )
+        parser.add_argument(
+            "--refresh-base",
+            action="store_true",
+            help="Resolve the base image tag in the registry again, even if cached",
+        )
+        parser.add_argument(
+            "--update-lock",
+            action="store_true",
+            help="Resolve the base image again and pin its digest in rockcraft.lock",
+        )
+
+    @overrides
+    def _run_real(
+        self,
+        parsed_args: argparse.Namespace,
+        step_name: str | None = None,
+    ) -> None:
+        package = cast("RockcraftPackageService", self._services.get("package"))
+        package.set_options(get_pack_options(parsed_args))
+        image = cast("RockcraftImageService", self._services.get("image"))
+        image.refresh_base = getattr(parsed_args, "refresh_base", False)
+        image.update_lock = getattr(parsed_args, "update_lock", False)
+
+        timings_path: pathlib.Path | None = getattr(parsed_args, "timings", None)
+        if timings_path is not None:
+            build_plan = self._services.get("build_plan").plan()
+            if build_plan:
+                timings_path = pathlib.Path(
+                    str(timings_path).replace("{platform}", build_plan[0].platform)
+                )
+        with (
+            timings.record(timings_path, "rockcraft pack"),
+            processes.recording() as process_log,
+        ):
+            try:
+                super()._run_real(parsed_args, step_name)
+            finally:
+                emit.debug(process_log.format_totals())
+
+
+def get_pack_options(parsed_args: argparse.Namespace) -> PackOptions:
+    """Get the pack options requested in the command line.
+
+    The rock is made reproducible if ``SOURCE_DATE_EPOCH`` is set in the
+    environment, as specified in https://reproducible-builds.org/specs/source-date-epoch/.
+
+    :param parsed_args: The parsed arguments of the pack command.
+    """
+    settings: dict[str, Any] = {
+        "algorithm": getattr(parsed_args, "compression", "gzip"),
+        "level": getattr(parsed_args, "compression_level", None),
+    }
+    threads: int | None = getattr(parsed_args, "compression_threads", None)
+    if threads is not None:
+        settings["threads"] = threads
+
+    return PackOptions(
+        compression=LayerCompression(**settings),
+        source_date_epoch=_get_source_date_epoch(),
+        deduplicate_files=getattr(parsed_args, "deduplicate_files", False),
+        layers=getattr(parsed_args, "layers", "single"),
+        layer_cache_from=getattr(parsed_args, "layer_cache_from", None),
+        squash_synthetic_layers=not getattr(
+            parsed_args, "separate_synthetic_layers", False
+        ),
+    )
+
+
+def _get_source_date_epoch() -> int | None:
+    """Get the timestamp in ``SOURCE_DATE_EPOCH``, if set."""
+    value = os.environ.get("SOURCE_DATE_EPOCH")
+    if not value:
+        return None
+    if not value.isdigit():
+        raise errors.RockcraftError(
+            f"Invalid SOURCE_DATE_EPOCH: {value!r}",
+            resolution="Set it to a number of seconds since the Unix epoch.",
+        )
+    return int(value)
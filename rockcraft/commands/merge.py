@@ -0,0 +1,74 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Command to merge rocks for several platforms into a multi-architecture rock."""
+
+import argparse
+import pathlib
+import textwrap
+
+from craft_application.commands import AppCommand
+from craft_cli import emit
+from overrides import overrides  # type: ignore[reportUnknownVariableType]
+
+from rockcraft import oci
+
+
+class MergeCommand(AppCommand):
+    """Merge rocks for several platforms into a multi-architecture rock."""
+
+    name = "merge"
+    help_msg = "Merge rocks for several platforms into a multi-architecture rock."
+    overview = textwrap.dedent(
+        """
+        Merge rocks, or other OCI archives, for different platforms into a
+        single OCI archive with an image index that lists the image of each
+        platform.
+
+        The layers of the rocks are copied as they are, and the layers
+        shared by several rocks are only stored once.
+        """
+    )
+
+    @overrides
+    def fill_parser(self, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument(
+            "rocks",
+            type=pathlib.Path,
+            nargs="+",
+            metavar="ROCK",
+            help="The rocks to merge, one for each platform",
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            type=pathlib.Path,
+            required=True,
+            help="The path of the multi-architecture rock",
+        )
+        parser.add_argument(
+            "--tag",
+            help="The tag of the image index (default: the tag of the first rock)",
+        )
+
+    @overrides
+    def run(self, parsed_args: argparse.Namespace) -> None:
+        """Write the multi-architecture rock."""
+        emit.progress(f"Merging {len(parsed_args.rocks)} rocks")
+        oci.merge_oci_archives(
+            parsed_args.rocks, parsed_args.output, tag=parsed_args.tag
+        )
+        emit.message(f"Merged rocks into {str(parsed_args.output)!r}")
@@ -0,0 +1,355 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compression of the blobs for rocks image layers."""
+
+import collections
+import gzip
+import math
+import os
+import struct
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Literal, Protocol, cast
+
+from craft_cli import emit
+from typing_extensions import Self
+
+from rockcraft import errors
+from rockcraft.layers import BinaryWriter
+
+if TYPE_CHECKING:
+    import types
+
+    import zstandard
+
+CompressionAlgorithm = Literal["gzip", "zstd"]
+
+COMPRESSION_ALGORITHMS: tuple[CompressionAlgorithm, ...] = ("gzip", "zstd")
+
+GZIP_LAYER_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+gzip"
+ZSTD_LAYER_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+zstd"
+
+# The gzip compression level used for new layers (zlib's default).
+DEFAULT_GZIP_LEVEL = 6
+
+# The zstd compression level used for new layers (zstd's default).
+DEFAULT_ZSTD_LEVEL = 3
+
+_LEVEL_RANGES: dict[CompressionAlgorithm, tuple[int, int]] = {
+    "gzip": (1, 9),
+    "zstd": (1, 22),
+}
+
+# The amount of uncompressed data in each independently-compressed block.
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+# Each block is primed with the tail of the previous one, like pigz does, so
+# that splitting the stream costs (almost) nothing in compression ratio.
+_GZIP_DICT_SIZE = 32 * 1024
+
+# gzip header: magic, deflate method, no flags, no mtime, no extra flags and
+# an "unknown" OS, matching Python's gzip module with mtime=0.
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+_CGROUP_V2_CPU_MAX = Path("/sys/fs/cgroup/cpu.max")
+_CGROUP_V1_CPU_QUOTA = Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+_CGROUP_V1_CPU_PERIOD = Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+
+
+def default_threads() -> int:
+    """Get the number of compression threads to use if none is requested.
+
+    This is the number of CPUs this process can run on, further limited by the
+    CPU quota of its cgroup (for example, in a container with ``--cpus=2``).
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:  # pragma: no cover (not Linux)
+        cpus = os.cpu_count() or 1
+
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+
+    return max(1, cpus)
+
+
+def _cgroup_cpu_quota() -> float | None:
+    """Get the CPU quota of the current cgroup, in CPUs, if there is one."""
+    try:
+        if _CGROUP_V2_CPU_MAX.exists():
+            quota, period = _CGROUP_V2_CPU_MAX.read_text().split()[:2]
+            if quota == "max":
+                return None
+            return int(quota) / int(period)
+
+        if _CGROUP_V1_CPU_QUOTA.exists():
+            quota_us = int(_CGROUP_V1_CPU_QUOTA.read_text())
+            period_us = int(_CGROUP_V1_CPU_PERIOD.read_text())
+            if quota_us <= 0 or period_us <= 0:
+                return None
+            return quota_us / period_us
+    except (OSError, ValueError) as err:
+        emit.debug(f"Could not read the cgroup CPU quota: {err}")
+
+    return None
+
+
+class CompressionWriter(BinaryWriter, Protocol):
+    """A writer that compresses data into another one until it is closed."""
+
+    def close(self) -> None:
+        """Finish the compressed stream, without closing the output."""
+
+    def abort(self) -> None:
+        """Stop compressing, without finishing the stream or closing the output."""
+
+
+@dataclass(frozen=True)
+class LayerCompression:
+    """How the blobs for new layers are compressed.
+
+    :param algorithm: The compression algorithm, "gzip" or "zstd".
+    :param level: The compression level, or None for the algorithm's default.
+    :param threads: The number of threads compressing each layer, or None for
+        ``default_threads()``, resolved when a layer is compressed.
+    """
+
+    algorithm: CompressionAlgorithm = "gzip"
+    level: int | None = None
+    threads: int | None = None
+
+    def __post_init__(self) -> None:
+        if self.algorithm not in COMPRESSION_ALGORITHMS:
+            raise errors.RockcraftError(
+                f"Unsupported layer compression {self.algorithm!r}"
+            )
+        low, high = _LEVEL_RANGES[self.algorithm]
+        if self.level is not None and not low <= self.level <= high:
+            raise errors.RockcraftError(
+                f"Invalid {self.algorithm} compression level {self.level}",
+                resolution=f"Use a level between {low} and {high}.",
+            )
+
+    @property
+    def media_type(self) -> str:
+        """The OCI media type of layers compressed this way."""
+        if self.algorithm == "zstd":
+            return ZSTD_LAYER_MEDIA_TYPE
+        return GZIP_LAYER_MEDIA_TYPE
+
+    def open(self, output: BinaryWriter) -> CompressionWriter:
+        """Get a writer that compresses data into ``output``."""
+        threads = default_threads() if self.threads is None else self.threads
+        if self.algorithm == "zstd":
+            level = DEFAULT_ZSTD_LEVEL if self.level is None else self.level
+            return _open_zstd(output, level=level, threads=threads)
+
+        level = DEFAULT_GZIP_LEVEL if self.level is None else self.level
+        return ParallelGzipWriter(output, level=level, threads=threads)
+
+
+def open_layer_reader(blob: IO[bytes], media_type: str) -> IO[bytes]:
+    """Get a reader of the uncompressed tarball in a layer blob.
+
+    :param blob: The layer blob, opened for reading.
+    :param media_type: The media type of the layer; gzip and zstd compressed
+        layers are decompressed, any other layer is read as is.
+    """
+    if media_type.endswith("zstd"):
+        zstandard = _import_zstandard()
+        return cast(IO[bytes], zstandard.ZstdDecompressor().stream_reader(blob))
+    if media_type.endswith("gzip"):
+        return cast(IO[bytes], gzip.GzipFile(fileobj=blob, mode="rb"))
+    return blob
+
+
+def _import_zstandard() -> "types.ModuleType":
+    """Import the ``zstandard`` package, an optional dependency.
+
+    It is only needed when packing rocks with zstd-compressed layers, or when
+    reading such layers.
+    """
+    try:
+        # pylint: disable=import-outside-toplevel
+        import zstandard
+    except ImportError as err:
+        raise errors.RockcraftError(
+            "zstd layer compression requires the 'zstandard' Python package",
+            resolution="Install rockcraft with the 'zstd' extra, or use gzip.",
+        ) from err
+    return zstandard
+
+
+def _open_zstd(output: BinaryWriter, *, level: int, threads: int) -> CompressionWriter:
+    """Get a writer that zstd-compresses data into ``output``."""
+    zstandard = _import_zstandard()
+
+    # zstd runs its own worker threads. The output is the same for any number
+    # of workers, but not when compressing in the calling thread (threads=0),
+    # so always use at least one to get the same layers on every machine.
+    compressor = zstandard.ZstdCompressor(level=level, threads=max(1, threads))
+    return _ZstdWriter(compressor.stream_writer(cast(IO[bytes], output), closefd=False))
+
+
+class _ZstdWriter:
+    """Adapt a zstandard stream writer to the CompressionWriter protocol.
+
+    :param writer: The zstandard stream writer.
+    """
+
+    def __init__(self, writer: "zstandard.ZstdCompressionWriter") -> None:
+        self._writer = writer
+
+    def write(self, data: bytes) -> int:
+        """Add ``data`` to the compressed stream."""
+        return self._writer.write(data)
+
+    def flush(self) -> None:
+        """Do nothing; flushing mid-stream would only hurt the compression."""
+
+    def close(self) -> None:
+        """Finish the zstd frame."""
+        self._writer.close()
+
+    def abort(self) -> None:
+        """Do nothing; the unfinished frame is dropped along with the writer."""
+
+
+class ParallelGzipWriter:
+    """A file object that gzip-compresses data on multiple threads.
+
+    The input is split into blocks of ``GZIP_BLOCK_SIZE`` bytes which are
+    deflated independently on a thread pool (zlib releases the GIL while
+    compressing) and written out in order, ending each one on a byte boundary
+    with a sync flush. The result is a single, regular gzip member that any
+    gzip reader can decompress.
+
+    The output only depends on the data and the compression level, and not on
+    the number of threads; with a single thread, blocks are compressed inline.
+
+    :param output: Where the compressed stream is written.
+    :param level: The compression level.
+    :param threads: The maximum number of blocks being compressed at once.
+    """
+
+    def __init__(self, output: BinaryWriter, *, level: int, threads: int) -> None:
+        self._output = output
+        self._level = level
+        self._threads = max(1, threads)
+        self._executor = (
+            ThreadPoolExecutor(
+                max_workers=self._threads, thread_name_prefix="rockcraft-gzip"
+            )
+            if self._threads > 1
+            else None
+        )
+        self._pending: collections.deque[Future[bytes]] = collections.deque()
+        self._buffer = bytearray()
+        self._dictionary = b""
+        self._crc = 0
+        self._size = 0
+        self._closed = False
+
+        self._output.write(_GZIP_HEADER)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *args: object) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data: bytes) -> int:
+        """Add ``data`` to the compressed stream."""
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= GZIP_BLOCK_SIZE:
+            block = bytes(self._buffer[:GZIP_BLOCK_SIZE])
+            del self._buffer[:GZIP_BLOCK_SIZE]
+            self._submit(block, last=False)
+        return len(data)
+
+    def flush(self) -> None:
+        """Do nothing; blocks are only written once they are complete."""
+
+    def close(self) -> None:
+        """Compress the remaining data and finish the gzip stream."""
+        if self._closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer.clear()
+            while self._pending:
+                self._output.write(self._pending.popleft().result())
+            self._output.write(
+                struct.pack("<II", self._crc & 0xFFFFFFFF, self._size & 0xFFFFFFFF)
+            )
+        finally:
+            self._shutdown()
+
+    def abort(self) -> None:
+        """Stop compressing, dropping the blocks that are not written yet."""
+        self._shutdown()
+
+    def _submit(self, block: bytes, *, last: bool) -> None:
+        dictionary = self._dictionary
+        self._dictionary = (dictionary + block)[-_GZIP_DICT_SIZE:]
+
+        if self._executor is None:
+            self._output.write(
+                _deflate_block(block, dictionary, self._level, last=last)
+            )
+            return
+
+        self._pending.append(
+            self._executor.submit(
+                _deflate_block, block, dictionary, self._level, last=last
+            )
+        )
+        # Bound the memory used by blocks waiting to be written.
+        while len(self._pending) > 2 * self._threads:
+            self._output.write(self._pending.popleft().result())
+
+    def _shutdown(self) -> None:
+        self._closed = True
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _deflate_block(block: bytes, dictionary: bytes, level: int, *, last: bool) -> bytes:
+    """Raw-deflate one block of a gzip stream.
+
+    :param block: The data to compress.
+    :param dictionary: The data preceding ``block`` in the stream, if any.
+    :param level: The compression level.
+    :param last: Whether this is the final block of the stream.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block)
+    return data + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
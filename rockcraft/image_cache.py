@@ -0,0 +1,602 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Host-wide cache of the base images fetched from the registry."""
+
+import collections
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections.abc import Collection, Iterator
+from pathlib import Path
+from typing import Any
+
+import platformdirs
+from craft_cli import emit
+
+from rockcraft import oci, utils
+from rockcraft.rootfs_index import RootfsIndex
+
+# The default maximum size of the cached blobs, in bytes.
+DEFAULT_MAX_SIZE = 10 * 1024**3
+
+# The default time, in seconds, for which a resolved tag is considered fresh.
+DEFAULT_TAG_TTL = 60 * 60
+
+# The default number of extracted root filesystems kept in the cache.
+DEFAULT_MAX_ROOTFS = 4
+
+_STATE_FILE = "state.json"
+_LOCK_FILE = "lock"
+_INDEX_SUFFIX = ".index.json"
+
+
+def get_cache_dir(app_name: str, configured_dir: str | None) -> Path:
+    """Get the location of the base image cache.
+
+    :param app_name: The name of the application owning the cache.
+    :param configured_dir: The configured location of the cache, if any.
+    """
+    if configured_dir:
+        return Path(configured_dir)
+    return platformdirs.user_cache_path(app_name) / "base-images"
+
+
+def get_rootfs_cache_dir(app_name: str) -> Path:
+    """Get the location of the extracted root filesystem cache.
+
+    Unlike the base image cache, this is never shared with build instances:
+    root filesystems must be extracted where they are used, to preserve the
+    ownership of their files.
+
+    :param app_name: The name of the application owning the cache.
+    """
+    return platformdirs.user_cache_path(app_name) / "rootfs"
+
+
+def _get_source_image(image_name: str) -> str:
+    """Get the registry source of an image in ``name@tag`` format."""
+    return f"docker://{oci.REGISTRY_URL}/{image_name.replace('@', ':')}"
+
+
+class BaseImageCache:
+    """A content-addressed store of base images, shared by all projects.
+
+    Blobs are stored once, by digest, and images are recorded by the digest
+    of their manifest. Tags are resolved against the registry at most once
+    every ``tag_ttl`` seconds; in between, images are served straight from the
+    store. The least recently used images are evicted when the store grows
+    beyond ``max_size`` bytes.
+
+    :param path: The directory of the cache.
+    :param max_size: The maximum size of the cached blobs, in bytes.
+    :param tag_ttl: For how long a resolved tag is fresh, in seconds.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        max_size: int = DEFAULT_MAX_SIZE,
+        tag_ttl: int = DEFAULT_TAG_TTL,
+    ) -> None:
+        self._path = path
+        self._blobs_path = path / "blobs" / "sha256"
+        self._max_size = max_size
+        self._tag_ttl = tag_ttl
+
+    def get_image(
+        self,
+        image_name: str,
+        *,
+        image_dir: Path,
+        arch: str,
+        refresh: bool = False,
+        digest: str | None = None,
+    ) -> tuple[oci.Image, str]:
+        """Obtain an image from the registry, through the cache.
+
+        This is a cached equivalent of ``oci.Image.from_docker_registry()``:
+        the image is only fetched if it is not cached, or if its tag is stale.
+        Its blobs are then linked (or cloned) into ``image_dir``.
+
+        :param image_name: The image to retrieve, in ``name@tag`` format.
+        :param image_dir: The directory to store local OCI images.
+        :param arch: The architecture of the image to fetch, in Debian format.
+        :param refresh: Whether to resolve the tag again, even if fresh.
+        :param digest: If set, obtain the image with this registry digest (as
+            pinned in a lock file) instead of resolving the tag. Pinned images
+            never go stale, so they are served from the cache without any
+            registry queries.
+
+        :returns: The local image and its corresponding source image.
+        """
+        if "@" not in image_name:
+            raise ValueError(f"Bad image name: {image_name}")
+
+        name, tag = image_name.split("@", maxsplit=1)
+        ref = f"{name}@{digest}/{arch}" if digest else f"{image_name}/{arch}"
+        source_image = _get_source_image(image_name)
+        image_path = image_dir / f"{name}:{tag}"
+        image = oci.Image(image_name=f"{name}:{tag}", path=image_dir)
+
+        with self._locked():
+            state = self._load_state()
+            now = time.time()
+            entry = state["refs"].get(ref)
+            if (
+                entry is not None
+                and (digest or not refresh)
+                and (digest or now - entry["resolved"] < self._tag_ttl)
+                and self._has_image(entry["digest"])
+            ):
+                emit.debug(f"Using cached {image_name} for {arch}: {entry['digest']}")
+                self._use(state, entry["digest"], image_path, now=now, evict=False)
+                return image, source_image
+            reusable = _related_blobs(state, name, arch)
+
+        # The lock is not held while downloading, so that other processes can
+        # use the cache in the meantime, even for the same image.
+        if digest:
+            source_digest = digest.removeprefix("sha256:")
+        else:
+            # Resolve the tag first and fetch that digest, so that the source
+            # digest is the one of the fetched image and cache hits need no
+            # queries at all.
+            source_digest = oci.Image.digest(source_image).hex()
+        with tempfile.TemporaryDirectory(dir=self._path, prefix=".fetch-") as tmp:
+            fetched_path = self._fetch(
+                image_name,
+                arch,
+                Path(tmp),
+                digest=f"sha256:{source_digest}",
+                reusable=reusable,
+            )
+            with self._locked():
+                descriptor, blobs = self._store(fetched_path)
+                image_digest = descriptor["digest"]
+                state = self._load_state()
+                now = time.time()
+                state["refs"][ref] = {
+                    "digest": image_digest,
+                    "resolved": now,
+                    "source_digest": source_digest,
+                }
+                state["images"][image_digest] = {
+                    "descriptor": descriptor,
+                    "blobs": blobs,
+                }
+                emit.debug(f"Cached {image_name} for {arch}: {image_digest}")
+                self._use(state, image_digest, image_path, now=now, evict=True)
+
+        return image, source_image
+
+    def get_source_digest(self, image_name: str, *, arch: str) -> bytes:
+        """Get the digest of an image in the registry, as of its last resolution.
+
+        This is the digest that ``oci.Image.digest()`` returns for the image's
+        source, memoized when the image was last fetched. The registry is only
+        queried if the image was never obtained through the cache.
+
+        :param image_name: The image, in ``name@tag`` format.
+        :param arch: The architecture of the image, in Debian format.
+        """
+        ref = f"{image_name}/{arch}"
+        with self._locked():
+            entry = self._load_state()["refs"].get(ref)
+        if entry is None:
+            return oci.Image.digest(_get_source_image(image_name))
+        if "source_digest" in entry:
+            return bytes.fromhex(entry["source_digest"])
+
+        source_digest = oci.Image.digest(_get_source_image(image_name))
+        with self._locked():
+            state = self._load_state()
+            if ref in state["refs"]:
+                state["refs"][ref].setdefault("source_digest", source_digest.hex())
+                self._save_state(state)
+        return source_digest
+
+    def _use(
+        self,
+        state: dict[str, Any],
+        digest: str,
+        image_path: Path,
+        *,
+        now: float,
+        evict: bool,
+    ) -> None:
+        """Mark a cached image as used, and write it into a local OCI layout.
+
+        Must be called with the lock held.
+
+        :param state: The state of the cache, saved once updated.
+        :param digest: The digest of the image's manifest.
+        :param image_path: path of the OCI image, in the format <image>:<tag>
+        :param evict: Whether blobs were just added to the store. Otherwise,
+            images are only evicted if the store is known to be too large.
+        """
+        state["images"][digest]["last_used"] = now
+        if evict or state.get("size", self._max_size + 1) > self._max_size:
+            self._evict(state, keep=digest)
+        self._save_state(state)
+        self._export(state["images"][digest]["descriptor"], image_path)
+
+    def _fetch(
+        self,
+        image_name: str,
+        arch: str,
+        fetch_dir: Path,
+        *,
+        digest: str,
+        reusable: Collection[str],
+    ) -> Path:
+        """Fetch an image from the registry into a temporary layout.
+
+        The cached blobs that the image may share are linked into the layout
+        first, so that they are reused instead of downloaded again. The lock
+        does not need to be held: blobs evicted in the meantime are just
+        downloaded.
+
+        :param fetch_dir: The directory of the temporary layout, in the cache.
+        :param digest: The registry digest of the image to fetch.
+        :param reusable: The hex digests of the cached blobs to link.
+        :returns: The path of the fetched image, in the format <image>:<tag>.
+        """
+        name, tag = image_name.split("@", maxsplit=1)
+        blobs_path = fetch_dir / name / "blobs" / "sha256"
+        blobs_path.mkdir(parents=True)
+        for blob in reusable:
+            with contextlib.suppress(OSError):
+                os.link(self._blobs_path / blob, blobs_path / blob)
+
+        oci.Image.from_docker_registry(
+            image_name, image_dir=fetch_dir, arch=arch, digest=digest
+        )
+        return fetch_dir / f"{name}:{tag}"
+
+    def _store(self, image_path: Path) -> tuple[dict[str, Any], dict[str, int]]:
+        """Move the blobs of a fetched image into the store.
+
+        Must be called with the lock held.
+
+        :param image_path: path of the fetched image, in the format <image>:<tag>
+        :returns: The descriptor of the image's manifest, and the sizes of its
+            blobs by hex digest.
+        """
+        descriptor = oci.get_manifest_descriptor(image_path)
+        layout_dir = Path(str(image_path).split(":", maxsplit=1)[0])
+        blobs_path = layout_dir / "blobs" / "sha256"
+        self._blobs_path.mkdir(parents=True, exist_ok=True)
+        blobs: dict[str, int] = {}
+        for blob in _manifest_blobs(blobs_path, descriptor["digest"]):
+            target = self._blobs_path / blob
+            if not target.exists():
+                (blobs_path / blob).replace(target)
+            blobs[blob] = target.stat().st_size
+        return descriptor, blobs
+
+    def _export(self, descriptor: dict[str, Any], image_path: Path) -> None:
+        """Write a cached image into a local OCI layout.
+
+        :param descriptor: The descriptor of the image's manifest.
+        :param image_path: path of the OCI image, in the format <image>:<tag>
+        """
+        layout_dir = Path(str(image_path).split(":", maxsplit=1)[0])
+        blobs_path = layout_dir / "blobs" / "sha256"
+        blobs_path.mkdir(parents=True, exist_ok=True)
+
+        for digest in self._image_blobs(descriptor["digest"]):
+            target = blobs_path / digest
+            if not target.exists():
+                utils.link_or_copy(self._blobs_path / digest, target)
+
+        oci.set_manifest_descriptor(image_path, descriptor)
+
+    def _image_blobs(self, digest: str) -> list[str]:
+        """Get the hex digests of all the blobs of a cached image.
+
+        :param digest: The digest of the image's manifest.
+        """
+        return _manifest_blobs(self._blobs_path, digest)
+
+    def _blob_sizes(self, digest: str) -> dict[str, int] | None:
+        """Get the sizes of the blobs of a cached image, by hex digest.
+
+        :param digest: The digest of the image's manifest.
+        :returns: The sizes, or None if some of the blobs are missing.
+        """
+        try:
+            return {
+                blob: (self._blobs_path / blob).stat().st_size
+                for blob in self._image_blobs(digest)
+            }
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _has_image(self, digest: str) -> bool:
+        """Whether the store has all the blobs of an image."""
+        try:
+            blobs = self._image_blobs(digest)
+        except (OSError, ValueError, KeyError):
+            return False
+        return all((self._blobs_path / blob).is_file() for blob in blobs)
+
+    def _evict(self, state: dict[str, Any], *, keep: str) -> None:
+        """Remove the least recently used images, until the store is small enough.
+
+        Blobs that no cached image refers to (for example, left behind by an
+        interrupted fetch) are removed as well. The total size of the store is
+        recorded in the state.
+
+        :param state: The state of the cache, updated in place.
+        :param keep: The digest of an image that must not be evicted.
+        """
+        images: dict[str, dict[str, Any]] = state["images"]
+        for digest, entry in list(images.items()):
+            # Images cached by older versions have no recorded blob sizes.
+            if "blobs" not in entry:
+                blobs = self._blob_sizes(digest)
+                if blobs is None:
+                    del images[digest]
+                else:
+                    entry["blobs"] = blobs
+
+        references: collections.Counter[str] = collections.Counter()
+        sizes: dict[str, int] = {}
+        for entry in images.values():
+            references.update(entry["blobs"].keys())
+            sizes.update(entry["blobs"])
+        total = sum(sizes.values())
+
+        for digest in sorted(images, key=lambda digest: images[digest]["last_used"]):
+            if total <= self._max_size:
+                break
+            if digest == keep:
+                continue
+            emit.debug(f"Evicting {digest} from the base image cache")
+            for blob in images.pop(digest)["blobs"]:
+                references[blob] -= 1
+                if not references[blob]:
+                    total -= sizes.pop(blob)
+
+        state["size"] = total
+        state["refs"] = {
+            ref: entry
+            for ref, entry in state["refs"].items()
+            if entry["digest"] in images
+        }
+        self._remove_unused_blobs(sizes.keys())
+
+    def _remove_unused_blobs(self, used: Collection[str]) -> None:
+        """Remove the blobs of the store that are not in ``used``.
+
+        :param used: The hex digests of the blobs referenced by cached images.
+        """
+        if not self._blobs_path.is_dir():
+            return
+        for blob in self._blobs_path.iterdir():
+            if not blob.name.startswith(".") and blob.name not in used:
+                blob.unlink(missing_ok=True)
+
+    def _load_state(self) -> dict[str, Any]:
+        """Load the state of the cache.
+
+        A state that cannot be read, for example because it was cut short, is
+        treated as empty: the images are fetched again, and the blobs that
+        are no longer referenced are evicted.
+        """
+        state_path = self._path / _STATE_FILE
+        empty_state: dict[str, Any] = {"refs": {}, "images": {}}
+        if not state_path.exists():
+            return empty_state
+        try:
+            state = json.loads(state_path.read_bytes())
+        except (OSError, ValueError) as err:
+            emit.debug(f"Rebuilding the base image cache state: {err}")
+            return empty_state
+        if not isinstance(state, dict) or not all(
+            isinstance(state.get(key), dict) for key in empty_state
+        ):
+            emit.debug("Rebuilding the base image cache state: bad format")
+            return empty_state
+        return state
+
+    def _save_state(self, state: dict[str, Any]) -> None:
+        """Save the state of the cache, replacing the previous one at once."""
+        fd, temp_name = tempfile.mkstemp(
+            dir=self._path, prefix=f".{_STATE_FILE}.", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as temp_file:
+                json.dump(state, temp_file, indent=2)
+            Path(temp_name).replace(self._path / _STATE_FILE)
+        finally:
+            Path(temp_name).unlink(missing_ok=True)
+
+    def _locked(self) -> contextlib.AbstractContextManager[None]:
+        """Hold the cache's lock, shared by all the processes that use it."""
+        return _locked(self._path)
+
+
+class RootfsCache:
+    """A store of extracted base image root filesystems, keyed by digest.
+
+    Bundles extracted from an image's manifest are kept, so that other work
+    directories can get a copy of them through reflinks or hard links instead
+    of unpacking the image again. Since copies may share their files with the
+    cache, they must never be modified in place; rockcraft only reads them.
+
+    The cache also keeps the index of the root filesystem of each image, for
+    the builds that only need a partial root filesystem.
+
+    :param path: The directory of the cache.
+    :param max_entries: The maximum number of root filesystems to keep.
+    """
+
+    def __init__(self, path: Path, *, max_entries: int = DEFAULT_MAX_ROOTFS) -> None:
+        self._path = path
+        self._max_entries = max_entries
+
+    def extract(self, image: oci.Image, bundle_dir: Path) -> Path:
+        """Unpack an image to an OCI runtime bundle, through the cache.
+
+        This is a cached equivalent of ``oci.Image.extract_to()``.
+
+        :param image: The image to unpack.
+        :param bundle_dir: The directory to store runtime bundles.
+        :returns: The path of the bundle's root filesystem.
+        """
+        digest = image.manifest_digest()
+        bundle_path = bundle_dir / image.image_name.replace(":", "-")
+        if oci.bundle_matches(bundle_path, digest, rootless=False):
+            emit.debug(f"Reusing {bundle_path}, already extracted from {digest}")
+            return bundle_path / "rootfs"
+
+        entry = self._path / digest.removeprefix("sha256:")
+        with _locked(self._path):
+            if oci.bundle_matches(entry, digest, rootless=False):
+                try:
+                    self._copy(entry, bundle_path)
+                except OSError as err:
+                    emit.debug(f"Cannot copy the cached rootfs of {digest}: {err}")
+                else:
+                    emit.debug(f"Copied the cached rootfs of {digest}")
+                    os.utime(entry)
+                    return bundle_path / "rootfs"
+
+            rootfs = image.extract_to(bundle_dir)
+            try:
+                self._copy(bundle_path, entry)
+            except OSError as err:
+                emit.debug(f"Cannot cache the rootfs of {digest}: {err}")
+            self._evict()
+
+        return rootfs
+
+    def extract_index(
+        self, image: oci.Image, bundle_dir: Path
+    ) -> tuple[Path, RootfsIndex]:
+        """Get the index of an image, and a partial root filesystem made from it.
+
+        The index is built on first use, by reading the layers of the image,
+        and then loaded from the cache. See ``RootfsIndex.extract_to()`` for
+        the contents of the partial root filesystem.
+
+        :param image: The image to index.
+        :param bundle_dir: The directory to store runtime bundles.
+        :returns: The path of the partial root filesystem, and the index.
+        """
+        digest = image.manifest_digest()
+        index_path = self._path / f"{digest.removeprefix('sha256:')}{_INDEX_SUFFIX}"
+        with _locked(self._path):
+            index = RootfsIndex.load(index_path)
+            if index is None:
+                emit.debug(f"Indexing the root filesystem of {digest}")
+                index = RootfsIndex.from_image(image)
+                try:
+                    index.save(index_path)
+                except OSError as err:
+                    emit.debug(f"Cannot cache the rootfs index of {digest}: {err}")
+                self._evict()
+            else:
+                emit.debug(f"Using the cached rootfs index of {digest}")
+                os.utime(index_path)
+
+        bundle_path = bundle_dir / f"{image.image_name.replace(':', '-')}-partial"
+        rootfs = bundle_path / "rootfs"
+        index.extract_to(rootfs)
+        return rootfs, index
+
+    def _copy(self, source: Path, destination: Path) -> None:
+        """Copy a bundle, replacing ``destination`` only once it is complete."""
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = destination.with_name(f".{destination.name}.tmp")
+        shutil.rmtree(temp_path, ignore_errors=True)
+        try:
+            utils.link_tree(source, temp_path)
+            shutil.rmtree(destination, ignore_errors=True)
+            temp_path.rename(destination)
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def _evict(self) -> None:
+        """Remove the least recently used root filesystems beyond the limit.
+
+        Root filesystems and indexes are counted separately.
+        """
+        paths = [path for path in self._path.iterdir() if not path.name.startswith(".")]
+        for entries in (
+            [path for path in paths if path.is_dir()],
+            [path for path in paths if path.name.endswith(_INDEX_SUFFIX)],
+        ):
+            entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+            for entry in entries[self._max_entries :]:
+                emit.debug(f"Evicting {entry.name} from the rootfs cache")
+                if entry.is_dir():
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    entry.unlink(missing_ok=True)
+
+
+def _related_blobs(state: dict[str, Any], name: str, arch: str) -> set[str]:
+    """Get the blobs of the cached images of a repository, for an architecture.
+
+    These are the images that a new image of the repository is likely to share
+    blobs with, like an earlier revision of the same tag.
+
+    :param state: The state of the cache.
+    :param name: The name of the image, without its tag.
+    :param arch: The architecture of the image, in Debian format.
+    :returns: The hex digests of the blobs.
+    """
+    blobs: set[str] = set()
+    for ref, entry in state["refs"].items():
+        if ref.startswith(f"{name}@") and ref.endswith(f"/{arch}"):
+            image = state["images"].get(entry["digest"], {})
+            blobs.update(image.get("blobs", ()))
+    return blobs
+
+
+def _manifest_blobs(blobs_path: Path, digest: str) -> list[str]:
+    """Get the hex digests of all the blobs of an image.
+
+    :param blobs_path: The directory of the image's blobs.
+    :param digest: The digest of the image's manifest.
+    """
+    manifest_digest = digest.removeprefix("sha256:")
+    manifest = json.loads((blobs_path / manifest_digest).read_bytes())
+    return [
+        manifest_digest,
+        manifest["config"]["digest"].removeprefix("sha256:"),
+        *(layer["digest"].removeprefix("sha256:") for layer in manifest["layers"]),
+    ]
+
+
+@contextlib.contextmanager
+def _locked(path: Path) -> Iterator[None]:
+    """Hold the lock of a cache directory, shared by all the processes using it."""
+    path.mkdir(parents=True, exist_ok=True)
+    with (path / _LOCK_FILE).open("a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,224 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reuse of the layers of earlier builds, found by the fingerprint of their content."""
+
+import hashlib
+import json
+import tarfile
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from craft_cli import emit
+
+from rockcraft import errors
+
+# The annotation of the layer descriptors in the image manifest that holds the
+# fingerprint of the layer (see ``layers.layer_fingerprint()``).
+FINGERPRINT_ANNOTATION = "io.rockcraft.layer.fingerprint"
+
+# Blobs are copied in chunks of this size.
+_COPY_SIZE = 1024 * 1024
+
+
+class CachedLayer(NamedTuple):
+    """A layer of an earlier build.
+
+    :param diff_id: The hex digest of the uncompressed layer.
+    :param digest: The hex digest of the compressed layer blob.
+    :param size: The size of the compressed layer blob.
+    :param media_type: The media type of the compressed layer blob.
+    """
+
+    diff_id: str
+    digest: str
+    size: int
+    media_type: str
+
+
+class _BlobSource(NamedTuple):
+    """Where to copy a blob from: a range of a file."""
+
+    path: Path
+    offset: int
+
+
+class LayerCache:
+    """The layers of earlier builds that can be reused, by fingerprint.
+
+    Rockcraft annotates the layers it adds to an image with the fingerprint
+    of their content. The layers of the images in a local OCI layout, like the
+    one a project is packed in, or in a rock archive, are indexed by that
+    fingerprint; when a new layer has the same fingerprint as one of them, the
+    existing blob is reused instead of archiving and compressing the layer.
+    """
+
+    def __init__(self) -> None:
+        self._layers: dict[str, CachedLayer] = {}
+        self._sources: dict[str, _BlobSource] = {}
+
+    def __len__(self) -> int:
+        return len(self._layers)
+
+    def add_layout(self, layout_dir: Path) -> None:
+        """Index the layers of all the images in a local OCI layout.
+
+        Images that cannot be read, or whose blobs are gone, are skipped.
+
+        :param layout_dir: The directory of the OCI layout.
+        """
+        blobs_path = layout_dir / "blobs" / "sha256"
+        try:
+            index = json.loads((layout_dir / "index.json").read_bytes())
+        except (OSError, ValueError) as err:
+            emit.debug(f"Cannot reuse the layers in {str(layout_dir)!r}: {err}")
+            return
+
+        sources = {
+            path.name: _BlobSource(path, 0)
+            for path in blobs_path.glob("*")
+            if not path.name.startswith(".")
+        }
+        self._add_images(
+            index, lambda digest: (blobs_path / digest).read_bytes(), sources
+        )
+
+    def add_archive(self, archive_path: Path) -> None:
+        """Index the layers of the images in an OCI archive, like a rock.
+
+        :param archive_path: The path of the archive.
+        :raises RockcraftError: If the archive cannot be read.
+        """
+        try:
+            with tarfile.open(archive_path, "r:") as archive:
+                members = {
+                    member.name.removeprefix("./"): member
+                    for member in archive
+                    if member.isreg()
+                }
+
+                def read_member(name: str) -> bytes:
+                    file = archive.extractfile(members[name])
+                    return file.read() if file else b""
+
+                index = json.loads(read_member("index.json"))
+                sources = {
+                    name.removeprefix("blobs/sha256/"): _BlobSource(
+                        archive_path, member.offset_data
+                    )
+                    for name, member in members.items()
+                    if name.startswith("blobs/sha256/")
+                }
+                self._add_images(
+                    index, lambda digest: read_member(f"blobs/sha256/{digest}"), sources
+                )
+        except (OSError, tarfile.TarError, ValueError, KeyError) as err:
+            raise errors.RockcraftError(
+                f"Cannot reuse the layers of {str(archive_path)!r}: {err}",
+                resolution="Make sure the file is a rock or an OCI archive.",
+            ) from err
+
+    def fetch(self, fingerprint: str, blobs_path: Path) -> CachedLayer | None:
+        """Get a cached layer, copying its blob into ``blobs_path`` if needed.
+
+        :param fingerprint: The fingerprint of the new layer.
+        :param blobs_path: The directory of the blobs of the image the layer
+            is added to.
+        :returns: The cached layer, or None if there is none with this
+            fingerprint, or if its blob cannot be copied.
+        """
+        layer = self._layers.get(fingerprint)
+        if layer is None:
+            return None
+        blob_path = blobs_path / layer.digest
+        if blob_path.is_file():
+            return layer
+
+        source = self._sources[layer.digest]
+        temp_path = blobs_path / f".layer.{layer.digest}.tmp"
+        try:
+            valid = _copy_blob(source, layer, temp_path)
+            if valid:
+                temp_path.chmod(0o644)
+                temp_path.replace(blob_path)
+        except OSError as err:
+            emit.debug(f"Cannot copy layer sha256:{layer.digest}: {err}")
+            valid = False
+        finally:
+            temp_path.unlink(missing_ok=True)
+        return layer if valid else None
+
+    def _add_images(
+        self,
+        index: dict[str, Any],
+        read_blob: Callable[[str], bytes],
+        sources: dict[str, _BlobSource],
+    ) -> None:
+        """Index the fingerprinted layers of the images in an OCI index.
+
+        :param index: The top level index of the layout or archive.
+        :param read_blob: A function to read a blob, by hex digest.
+        :param sources: Where to copy each blob of the layout from.
+        """
+        for descriptor in index.get("manifests", []):
+            # Nested indexes, without a config, are skipped too.
+            try:
+                manifest = json.loads(read_blob(_hex(descriptor["digest"])))
+                config = json.loads(read_blob(_hex(manifest["config"]["digest"])))
+            except (OSError, ValueError, KeyError) as err:
+                emit.debug(f"Cannot reuse the layers of {descriptor['digest']}: {err}")
+                continue
+
+            diff_ids = config.get("rootfs", {}).get("diff_ids", [])
+            for layer, diff_id in zip(manifest.get("layers", []), diff_ids):
+                fingerprint = layer.get("annotations", {}).get(FINGERPRINT_ANNOTATION)
+                digest = _hex(layer["digest"])
+                if fingerprint and digest in sources:
+                    self._layers[fingerprint] = CachedLayer(
+                        diff_id=_hex(diff_id),
+                        digest=digest,
+                        size=layer["size"],
+                        media_type=layer["mediaType"],
+                    )
+                    self._sources.setdefault(digest, sources[digest])
+
+
+def _copy_blob(source: _BlobSource, layer: CachedLayer, temp_path: Path) -> bool:
+    """Copy a blob to ``temp_path``, checking its digest on the way.
+
+    :returns: Whether the copy has the expected size and digest.
+    """
+    hasher = hashlib.sha256()
+    remaining = layer.size
+    with source.path.open("rb") as src, temp_path.open("wb") as dest:
+        src.seek(source.offset)
+        while remaining:
+            data = src.read(min(_COPY_SIZE, remaining))
+            if not data:
+                break
+            hasher.update(data)
+            dest.write(data)
+            remaining -= len(data)
+    if remaining or hasher.hexdigest() != layer.digest:
+        emit.debug(f"Cannot reuse layer sha256:{layer.digest}: its blob is corrupt")
+        return False
+    return True
+
+
+def _hex(digest: str) -> str:
+    """Get the hex part of a ``sha256:<hex>`` digest."""
+    return digest.rsplit(":", maxsplit=1)[-1]
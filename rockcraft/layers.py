@@ -16,23 +16,125 @@
 
 """Handling of files and directories for rocks image layers."""
 
+import functools
+import grp
+import hashlib
+import io
+import json
 import os
+import pwd
+import stat
+import sys
 import tarfile
 from collections import defaultdict
+from collections.abc import Collection, Iterator, Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import IO, TYPE_CHECKING, Protocol, cast
 
 from craft_cli import emit
 from craft_parts.executor.collisions import paths_collide
 from craft_parts.overlays import overlays
 from craft_parts.permissions import Permissions
 
-from rockcraft import errors
+from rockcraft import errors, utils
+
+if TYPE_CHECKING:
+    from rockcraft.rootfs_index import RootfsEntry, RootfsIndex
+
+# Data is written to the layer file in chunks of (at least) this size.
+_WRITE_SIZE = 1024 * 1024
+
+# Bumped when the layer tarballs change for the same fingerprint.
+_FINGERPRINT_VERSION = 2
+
+# Files are hashed or compared in chunks of this size.
+_READ_SIZE = 1024 * 1024
+
+# Files smaller than this are read and written, even if they could be copied
+# within the kernel, to batch them with the headers around them.
+_KERNEL_COPY_MIN_SIZE = 64 * 1024
+
+# The name of the file marking a directory as opaque in an OCI layer.
+_OCI_OPAQUE_MARKER = overlays.oci_opaque_dir(Path()).name
+
+
+class BinaryWriter(Protocol):
+    """A binary file object that is only written to, sequentially."""
+
+    def write(self, data: bytes, /) -> int:
+        """Write ``data``, returning the number of bytes written."""
+        ...
+
+    def flush(self) -> None:
+        """Flush any buffered data."""
+        ...
+
+
+class StatCache:
+    """The ``lstat()`` results of paths, so that each one is only stat'ed once.
+
+    Entries are only ever added, so a cache must not outlive the changes to
+    the files it describes.
+    """
+
+    __slots__ = ("_stats",)
+
+    def __init__(self) -> None:
+        self._stats: dict[str, os.stat_result | None] = {}
+
+    def add(self, path: Path | str, stat_result: os.stat_result) -> None:
+        """Record the ``lstat()`` result of ``path``, already known."""
+        self._stats[str(path)] = stat_result
+
+    def lstat(self, path: Path | str) -> os.stat_result | None:
+        """Get the ``lstat()`` result of ``path``, or None if it does not exist."""
+        key = str(path)
+        try:
+            return self._stats[key]
+        except KeyError:
+            pass
+        try:
+            result: os.stat_result | None = os.lstat(key)
+        except (FileNotFoundError, NotADirectoryError):
+            result = None
+        self._stats[key] = result
+        return result
+
+    def stat(self, path: Path | str) -> os.stat_result | None:
+        """Get the ``stat()`` result of ``path``, following symlinks."""
+        result = self.lstat(path)
+        if result is not None and stat.S_ISLNK(result.st_mode):
+            # Symlinks are rare enough that their targets are not cached.
+            try:
+                return Path(path).stat()
+            except OSError:
+                return None
+        return result
+
+    def is_dir(self, path: Path | str) -> bool:
+        """Whether ``path`` is a directory, or a symlink to one."""
+        result = self.stat(path)
+        return result is not None and stat.S_ISDIR(result.st_mode)
+
+    def is_file(self, path: Path | str) -> bool:
+        """Whether ``path`` is a regular file, or a symlink to one."""
+        result = self.stat(path)
+        return result is not None and stat.S_ISREG(result.st_mode)
+
+    def is_symlink(self, path: Path | str) -> bool:
+        """Whether ``path`` is a symlink."""
+        result = self.lstat(path)
+        return result is not None and stat.S_ISLNK(result.st_mode)
 
 
 def archive_layer(
     new_layer_dir: Path,
     temp_tar_file: Path,
     base_layer_dir: Path | None = None,
+    *,
+    source_date_epoch: int | None = None,
+    deduplicate: bool = False,
 ) -> None:
     """Prepare new OCI layer by archiving its content into tar file.
 
@@ -41,21 +143,253 @@ def archive_layer(
     :param base_layer_dir: optional path to the filesystem containing the extracted
         base below this new layer. Used to preserve lower-level directory symlinks,
         like the ones from Debian/Ubuntu's usrmerge.
+    :param source_date_epoch: if set, no entry in the layer is newer than this
+        timestamp, so that rebuilding the same content gives the same layer.
+    :param deduplicate: whether to store regular files with the same contents,
+        mode and owner as an earlier file in the layer as hard links to it.
+        Extracted, all these files are then one and the same, with the
+        timestamp of the first one.
     """
-    candidates = _gather_layer_paths(new_layer_dir, base_layer_dir)
-    layer_paths = _merge_layer_paths(candidates)
+    # Unbuffered, so that file contents can be copied within the kernel.
+    with temp_tar_file.open("wb", buffering=0) as layer_file:
+        write_layer(
+            new_layer_dir,
+            layer_file,
+            base_layer_dir,
+            source_date_epoch=source_date_epoch,
+            deduplicate=deduplicate,
+        )
+
+
+def write_layer(
+    new_layer_dir: Path,
+    layer_file: BinaryWriter,
+    base_layer_dir: Path | None = None,
+    *,
+    source_date_epoch: int | None = None,
+    deduplicate: bool = False,
+    paths: Collection[str] | None = None,
+    content_digests: dict[str, str] | None = None,
+) -> None:
+    """Stream the content of a new OCI layer, as an uncompressed tarball.
+
+    See ``archive_layer()`` for the other parameters; the tarball is written
+    sequentially to ``layer_file``, which only needs a ``write()`` method.
+    Writes are at least ``_WRITE_SIZE`` bytes long, except for the last one.
 
-    with tarfile.open(temp_tar_file, mode="w") as tar_file:
-        # Iterate on sorted keys, so that the directories are always listed before
-        # any files that they contain (otherwise tools like Docker might choke on
-        # the layer tarball).
-        for arcname in sorted(layer_paths):
-            filepath = layer_paths[arcname]
-            emit.debug(f"Adding to layer: {filepath} as '{arcname}'")
-            tar_file.add(filepath, arcname=arcname, recursive=False)
+    :param paths: If set, only these paths of ``new_layer_dir``, relative to
+        it, and their parent directories are added to the layer.
+    :param content_digests: If set, the hex SHA-256 digests of the contents
+        of the regular files stored in the layer are added to it, by name, so
+        that ``layer_fingerprint()`` does not read them again.
+    """
+    stat_cache = StatCache()
+    layer_paths = _collect_layer_paths(new_layer_dir, base_layer_dir, paths, stat_cache)
+    duplicates = _find_duplicate_files(layer_paths, stat_cache) if deduplicate else {}
+
+    tar_writer = _LayerTarWriter(
+        layer_file,
+        source_date_epoch=source_date_epoch,
+        content_digests=content_digests,
+    )
+    # Iterate on sorted keys, so that the directories are always listed before
+    # any files that they contain (otherwise tools like Docker might choke on
+    # the layer tarball).
+    for arcname in sorted(layer_paths):
+        filepath = layer_paths[arcname]
+        emit.debug(f"Adding to layer: {filepath} as '{arcname}'")
+        stat_result = stat_cache.lstat(filepath)
+        if stat_result is None:
+            raise errors.LayerArchivingError(f"Cannot add '{filepath}': it is gone")
+        tar_writer.add(filepath, arcname, stat_result, link_to=duplicates.get(arcname))
+    tar_writer.close()
+
+    if tar_writer.link_count:
+        emit.debug(
+            f"Stored {tar_writer.link_count} hard links in the layer, "
+            f"saving {tar_writer.linked_size} bytes"
+        )
+    if deduplicate:
+        saved = sum(
+            cast(os.stat_result, stat_cache.lstat(layer_paths[name])).st_size
+            for name in duplicates
+        )
+        emit.progress(
+            f"Deduplicated {len(duplicates)} files in the layer, saving {saved} bytes"
+        )
 
 
-def prune_prime_files(prime_dir: Path, files: set[str], base_layer_dir: Path) -> None:
+def layer_fingerprint(
+    new_layer_dir: Path,
+    base_layer_dir: Path | None = None,
+    *,
+    source_date_epoch: int | None = None,
+    deduplicate: bool = False,
+    paths: Collection[str] | None = None,
+    content_digests: Mapping[str, str] | None = None,
+) -> str:
+    """Fingerprint the content of a new layer, without archiving it.
+
+    See ``write_layer()`` for the parameters. The fingerprint covers the name,
+    type, mode, owner, size, modification time and link target of every path
+    in the layer, and the options that change the layer tarball. Files are not
+    read: like with ``make``, a file changed without updating its size or
+    modification time keeps the same fingerprint.
+
+    With ``source_date_epoch``, the fingerprint only covers what ends up in the
+    layer tarball, since it is kept in the image manifest and the same content
+    must give the same manifest: modification times are clamped like in the
+    tarball and, as they no longer tell changed files apart, the contents of
+    the regular files are hashed.
+
+    :param content_digests: The digests of the contents of the regular files,
+        by name, as collected by ``write_layer()``. Only the files missing
+        from it are read.
+    :returns: The hex sha256 digest of the attributes of the layer.
+    """
+    stat_cache = StatCache()
+    layer_paths = _collect_layer_paths(new_layer_dir, base_layer_dir, paths, stat_cache)
+
+    hasher = hashlib.sha256(
+        json.dumps([_FINGERPRINT_VERSION, source_date_epoch, deduplicate]).encode()
+    )
+    inodes: dict[tuple[int, int], str] = {}
+    for arcname in sorted(layer_paths):
+        filepath = layer_paths[arcname]
+        stat_result = stat_cache.lstat(filepath)
+        if stat_result is None:
+            raise errors.LayerArchivingError(f"Cannot add '{filepath}': it is gone")
+        linkname = hard_link = ""
+        if stat.S_ISLNK(stat_result.st_mode):
+            linkname = os.readlink(filepath)  # noqa: PTH115 (keep it a str)
+        elif stat.S_ISREG(stat_result.st_mode) and stat_result.st_nlink > 1:
+            inode = (stat_result.st_ino, stat_result.st_dev)
+            hard_link = inodes.setdefault(inode, arcname)
+        mtime = stat_result.st_mtime_ns
+        digest = ""
+        if source_date_epoch is not None:
+            mtime = min(int(stat_result.st_mtime), source_date_epoch)
+            if stat.S_ISREG(stat_result.st_mode) and hard_link in ("", arcname):
+                digest = (content_digests or {}).get(arcname, "")
+                if not digest:
+                    with filepath.open("rb") as file:
+                        digest = content_digest(file)
+        entry = [
+            arcname,
+            stat_result.st_mode,
+            stat_result.st_uid,
+            stat_result.st_gid,
+            stat_result.st_size if stat.S_ISREG(stat_result.st_mode) else 0,
+            mtime,
+            stat_result.st_rdev,
+            linkname,
+            hard_link,
+            digest,
+        ]
+        hasher.update(json.dumps(entry).encode() + b"\n")
+    return hasher.hexdigest()
+
+
+def _collect_layer_paths(
+    new_layer_dir: Path,
+    base_layer_dir: Path | None,
+    paths: Collection[str] | None,
+    stat_cache: StatCache,
+) -> dict[str, Path]:
+    """Get the path to add for each name in a new layer.
+
+    See ``write_layer()`` for the parameters.
+    """
+    candidates = _gather_layer_paths(new_layer_dir, base_layer_dir, stat_cache)
+    if paths is not None:
+        candidates = _select_layer_paths(candidates, new_layer_dir, paths)
+    return _merge_layer_paths(candidates, stat_cache)
+
+
+def _find_duplicate_files(
+    layer_paths: dict[str, Path], stat_cache: StatCache
+) -> dict[str, str]:
+    """Find the regular files of a layer that duplicate an earlier one.
+
+    Files are first grouped by size, mode and owner, and only the files in
+    groups of several inodes are read and hashed. Paths to the same inode are
+    already archived as hard links, so they are hashed once.
+
+    :param layer_paths: The paths of the layer, by name in the layer.
+    :param stat_cache: The cache of ``lstat()`` results of the paths.
+    :return: A dict mapping the names of duplicate files to the name of the
+        first file, in archive order, with the same contents and attributes.
+    """
+    # The names of the paths to each inode, in archive order.
+    inode_names: dict[tuple[int, int], list[str]] = {}
+    groups: defaultdict[tuple[int, int, int, int], list[tuple[int, int]]] = defaultdict(
+        list
+    )
+    for name in sorted(layer_paths):
+        stat_result = stat_cache.lstat(layer_paths[name])
+        if (
+            stat_result is None
+            or not stat.S_ISREG(stat_result.st_mode)
+            or not stat_result.st_size
+        ):
+            continue
+        inode = (stat_result.st_ino, stat_result.st_dev)
+        names = inode_names.get(inode)
+        if names is None:
+            inode_names[inode] = names = []
+            key = (
+                stat_result.st_size,
+                stat_result.st_mode,
+                stat_result.st_uid,
+                stat_result.st_gid,
+            )
+            groups[key].append(inode)
+        names.append(name)
+
+    duplicates: dict[str, str] = {}
+    for inodes in groups.values():
+        if len(inodes) < 2:  # noqa: PLR2004
+            continue
+        first_names: dict[str, str] = {}
+        for inode in inodes:
+            names = inode_names[inode]
+            try:
+                with layer_paths[names[0]].open("rb") as file:
+                    digest = content_digest(file)
+            except OSError as err:
+                emit.debug(f"Not deduplicating {layer_paths[names[0]]}: {err}")
+                continue
+            first_name = first_names.setdefault(digest, names[0])
+            if first_name != names[0]:
+                duplicates.update(dict.fromkeys(names, first_name))
+
+    return duplicates
+
+
+def content_digest(file: IO[bytes], *, pkgconfig: bool = False) -> str:
+    """Get the hex SHA-256 digest of the contents of a file.
+
+    :param file: The file, opened for reading.
+    :param pkgconfig: Whether the file is a pkg-config file. The values of
+        their ``prefix`` variable depend on where they were built, so they are
+        left out, like craft-parts does when comparing these files.
+    """
+    digest = hashlib.sha256()
+    if pkgconfig:
+        for line in file:
+            digest.update(b"prefix=\n" if line.startswith(b"prefix=") else line)
+    else:
+        while chunk := file.read(_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prune_prime_files(
+    prime_dir: Path,
+    files: set[str],
+    base_layer_dir: Path,
+    base_index: "RootfsIndex | None" = None,
+) -> None:
     """Remove (prune) files in a prime directory if they exist in the base layer.
 
     Given a set of filenames ``files``, this function will remove (prune) all those
@@ -71,27 +405,151 @@ def prune_prime_files(prime_dir: Path, files: set[str], base_layer_dir: Path) ->
     :param files: The set of filenames added to ``prime_dir``, as provided by
         the corresponding post_step lifecycle callback.
     :param base_layer_dir: The directory where the base layer was extracted.
+    :param base_index: The index of the base layer. If set, files are compared
+        with the index, and ``base_layer_dir`` may only be a partial extraction
+        of the base (see ``RootfsIndex.extract_to()``).
     """
     emit.debug("Pruning primed files that already exist on base layer...")
-    for filename in files:
-        base_layer_file = base_layer_dir / filename
-        if base_layer_file.is_file():
-            prime_file = prime_dir / filename
-            if _all_compatible_files([base_layer_file, prime_file]):
-                emit.debug(f"Pruning: {prime_file} as it exists on the base")
-                prime_file.unlink()
-            else:
-                emit.debug(
-                    f"{prime_file} exists on the base but with different contents or permissions"
-                )
+    stat_cache = StatCache()
+    if base_index is None:
+        filenames = [f for f in sorted(files) if stat_cache.is_file(base_layer_dir / f)]
+    else:
+        filenames = [f for f in sorted(files) if base_index.is_file(f)]
+
+    def same_attributes(filename: str) -> bool:
+        if base_index is None:
+            return _same_file_attributes(
+                base_layer_dir / filename, prime_dir / filename, stat_cache
+            )
+        return _same_indexed_attributes(
+            base_index, filename, prime_dir / filename, stat_cache
+        )
+
+    def same_contents(filename: str) -> bool:
+        if base_index is None:
+            return _same_file_contents(
+                base_layer_dir / filename, prime_dir / filename, stat_cache
+            )
+        return _same_indexed_contents(base_index, filename, prime_dir / filename)
+
+    # Files are first compared by their attributes, already stat'ed. Only the
+    # ones that may be identical are read, on several threads.
+    candidates = [filename for filename in filenames if same_attributes(filename)]
+    with ThreadPoolExecutor(thread_name_prefix="rockcraft-prune") as executor:
+        same = dict(zip(candidates, executor.map(same_contents, candidates)))
+
+    for filename in filenames:
+        prime_file = prime_dir / filename
+        if same.get(filename, False):
+            emit.debug(f"Pruning: {prime_file} as it exists on the base")
+            prime_file.unlink()
+        else:
+            emit.debug(
+                f"{prime_file} exists on the base but with different contents or permissions"
+            )
+
+
+def _same_file_attributes(
+    base_file: Path, prime_file: Path, stat_cache: StatCache
+) -> bool:
+    """Whether two files may be identical, according to their ``lstat()`` results.
+
+    Regular files must have the same size (except for pkg-config files), mode
+    and owner, as checked by ``_all_compatible_files()``; symlinks are left to
+    ``_same_file_contents()``.
+    """
+    if not stat_cache.is_file(prime_file):
+        return False
+    base_stat = cast(os.stat_result, stat_cache.lstat(base_file))
+    prime_stat = cast(os.stat_result, stat_cache.lstat(prime_file))
+    if not (stat.S_ISREG(base_stat.st_mode) and stat.S_ISREG(prime_stat.st_mode)):
+        return True
+    return (
+        (base_stat.st_size == prime_stat.st_size or _is_pkgconfig(prime_file))
+        and base_stat.st_mode == prime_stat.st_mode
+        and base_stat.st_uid == prime_stat.st_uid
+        and base_stat.st_gid == prime_stat.st_gid
+    )
+
+
+def _same_indexed_attributes(
+    base_index: "RootfsIndex", filename: str, prime_file: Path, stat_cache: StatCache
+) -> bool:
+    """Whether a file may be identical to one in the base, from their attributes.
+
+    This is ``_same_file_attributes()`` for a base described by an index.
+    Symlinks must also have the same target, and point to files with the same
+    mode and owner.
+    """
+    prime_stat = stat_cache.lstat(prime_file)
+    if prime_stat is None or not stat_cache.is_file(prime_file):
+        return False
+    base_entry = cast("RootfsEntry", base_index.lookup(filename, follow_symlinks=False))
+    if base_entry.is_symlink != stat.S_ISLNK(prime_stat.st_mode):
+        return False
+    if base_entry.is_symlink:
+        if base_entry.linkname != os.readlink(prime_file):  # noqa: PTH115
+            return False
+        base_entry = cast("RootfsEntry", base_index.lookup(filename))
+        prime_stat = cast(os.stat_result, stat_cache.stat(prime_file))
+    elif base_entry.size != prime_stat.st_size and not _is_pkgconfig(filename):
+        return False
+    return (
+        base_entry.mode == stat.S_IMODE(prime_stat.st_mode)
+        and base_entry.uid == prime_stat.st_uid
+        and base_entry.gid == prime_stat.st_gid
+    )
+
+
+def _same_indexed_contents(
+    base_index: "RootfsIndex", filename: str, prime_file: Path
+) -> bool:
+    """Whether a file has the same contents as the one in the base, from its index.
+
+    Symlinks to files with the same attributes are the same file.
+    """
+    base_entry = cast("RootfsEntry", base_index.lookup(filename, follow_symlinks=False))
+    if base_entry.is_symlink:
+        return True
+    with prime_file.open("rb") as prime:
+        digest = content_digest(prime, pkgconfig=filename.endswith(".pc"))
+    return digest == base_entry.digest
+
+
+def _same_file_contents(
+    base_file: Path, prime_file: Path, stat_cache: StatCache
+) -> bool:
+    """Whether two files with the same attributes have the same contents.
+
+    Regular files are compared in large chunks, stopping at the first
+    difference. Symlinks and pkg-config files, whose prefix may differ, are
+    compared like ``_all_compatible_files()`` does.
+    """
+    if (
+        stat_cache.is_symlink(base_file)
+        or stat_cache.is_symlink(prime_file)
+        or base_file.name.endswith(".pc")
+    ):
+        return _all_compatible_files([base_file, prime_file], stat_cache)
+
+    with base_file.open("rb") as base, prime_file.open("rb") as prime:
+        while True:
+            base_chunk = base.read(_READ_SIZE)
+            if base_chunk != prime.read(_READ_SIZE):
+                return False
+            if not base_chunk:
+                return True
 
 
 def _gather_layer_paths(
-    new_layer_dir: Path, base_layer_dir: Path | None = None
+    new_layer_dir: Path,
+    base_layer_dir: Path | None = None,
+    stat_cache: StatCache | None = None,
 ) -> dict[str, list[Path]]:
     """Map paths in ``new_layer_dir`` to names in a layer file.
 
-    See ``_archive_layer()`` for the parameters.
+    See ``_archive_layer()`` for the parameters. The ``lstat()`` result of
+    every path in ``new_layer_dir`` is recorded in ``stat_cache``.
 
     :return:
       A dict where the value is a path (file or dir) in ``new_layer_dir`` and the
@@ -131,15 +589,12 @@ def _gather_layer_paths(
                 return Path(str_path.replace(self.upper_prefix, self.lower_prefix, 1))
             return path
 
+    if stat_cache is None:
+        stat_cache = StatCache()
+
     layer_linker = LayerLinker()
     result: defaultdict[str, list[Path]] = defaultdict(list)
-    for dirpath, subdirs, filenames in os.walk(new_layer_dir):
-        # Sort `subdirs` in-place, to ensure that `os.walk()` iterates on
-        # them in sorted order.
-        subdirs.sort()
-
-        upper_subpath = Path(dirpath)
-
+    for upper_subpath, _subdirs, filenames in _walk(new_layer_dir, stat_cache):
         # The path with `new_layer_dir` as the "root"
         relative_path = upper_subpath.relative_to(new_layer_dir)
 
@@ -149,9 +604,9 @@ def _gather_layer_paths(
         # - The directory's exists on ``base_layer_dir`` as a symlink to another
         #   directory (like in usrmerge).
         if upper_subpath != new_layer_dir:
-            upper_is_not_opaque_dir = not overlays.is_oci_opaque_dir(upper_subpath)
+            upper_is_not_opaque_dir = _OCI_OPAQUE_MARKER not in filenames
             lower_symlink_target = _symlink_target_in_base_layer(
-                relative_path, base_layer_dir
+                relative_path, base_layer_dir, stat_cache
             )
             lower_is_symlink = lower_symlink_target is not None
 
@@ -164,23 +619,354 @@ def _gather_layer_paths(
                 lower_path = layer_linker.get_target_path(relative_path)
                 result[f"{lower_path}"].append(upper_subpath)
 
-        # Add each file in the directory.
+        # Add each file in the directory, including symlinks to directories
+        # (which are not walked into).
         for name in filenames:
             archive_path = layer_linker.get_target_path(relative_path / name)
             result[f"{archive_path}"].append(upper_subpath / name)
 
-        # Add each subdir in the directory if it's a symlink, because the os.walk()
-        # call will not enter them.
-        for subdir in subdirs:
-            upper_subdir_path = upper_subpath / subdir
-            if upper_subdir_path.is_symlink():
-                archive_path = layer_linker.get_target_path(relative_path / subdir)
-                result[f"{archive_path}"].append(upper_subdir_path)
+    return result
+
 
+def _select_layer_paths(
+    candidate_paths: dict[str, list[Path]],
+    new_layer_dir: Path,
+    paths: Collection[str],
+) -> dict[str, list[Path]]:
+    """Keep the candidate paths that are in ``paths``, or contain one of them.
+
+    Paths are selected by their location in ``new_layer_dir``, before they are
+    moved under the symlinks of the base layer.
+    """
+    selected: set[str] = set()
+    for path in paths:
+        parts = Path(path).parts
+        selected.update("/".join(parts[:end]) for end in range(1, len(parts) + 1))
+
+    result: dict[str, list[Path]] = {}
+    for name, upper_paths in candidate_paths.items():
+        kept = [
+            path
+            for path in upper_paths
+            if path.relative_to(new_layer_dir).as_posix() in selected
+        ]
+        if kept:
+            result[name] = kept
     return result
 
 
-def _merge_layer_paths(candidate_paths: dict[str, list[Path]]) -> dict[str, Path]:
+def _walk(
+    top: Path, stat_cache: StatCache
+) -> Iterator[tuple[Path, list[str], list[str]]]:
+    """Walk a directory tree top-down, like ``os.walk()``, with one lstat per entry.
+
+    Each directory is listed with ``os.scandir()``, and the ``lstat()`` result
+    of each of its entries is recorded in ``stat_cache``.
+
+    :returns: An iterator of (directory, subdirectories, other entries) tuples.
+        Subdirectories are sorted and walked in that order; symlinks to
+        directories are not followed, and are listed with the other entries.
+    """
+    pending = [top]
+    while pending:
+        directory = pending.pop()
+        subdirs: list[str] = []
+        others: list[str] = []
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as err:
+            # Like os.walk(), skip the directories that cannot be listed.
+            emit.debug(f"Cannot list {directory}: {err}")
+            continue
+        for entry in entries:
+            stat_result = entry.stat(follow_symlinks=False)
+            stat_cache.add(entry.path, stat_result)
+            if stat.S_ISDIR(stat_result.st_mode):
+                subdirs.append(entry.name)
+            else:
+                others.append(entry.name)
+
+        subdirs.sort()
+        yield directory, subdirs, others
+        pending.extend(directory / subdir for subdir in reversed(subdirs))
+
+
+class _LayerTarWriter:
+    """Write a layer tarball, with entries built from known ``lstat()`` results.
+
+    The archive is equivalent to one written by ``tarfile`` in the PAX format,
+    but headers are packed directly into a buffer and file contents are copied
+    in large chunks. If the output is a raw file, large file contents are
+    copied within the kernel instead (see ``utils.copy_file_data()``).
+
+    Regular files with several links are stored once: later paths to the same
+    inode are added as hard links to the first one in the archive.
+
+    Timestamps are stored in whole seconds, so that entries only need PAX
+    headers if their names or attributes don't fit in the ustar format.
+
+    :param output: Where the tarball is written.
+    :param source_date_epoch: If set, later timestamps are clamped to it.
+    :param content_digests: If set, the digests of the contents of the regular
+        files are added to it, by name. Contents are then always copied
+        through memory, to be hashed.
+    """
+
+    def __init__(
+        self,
+        output: BinaryWriter,
+        *,
+        source_date_epoch: int | None = None,
+        content_digests: dict[str, str] | None = None,
+    ) -> None:
+        self._output = output
+        self._content_digests = content_digests
+        # Later timestamps are clamped to SOURCE_DATE_EPOCH, if set.
+        self._max_mtime = (
+            sys.maxsize if source_date_epoch is None else source_date_epoch
+        )
+        self._output_fd = output.fileno() if isinstance(output, io.FileIO) else None
+        self._pending = bytearray()
+        self._offset = 0
+        # The names of the regular files in the archive, by inode.
+        self._inodes: dict[tuple[int, int], str] = {}
+        # The hard links in the archive, and the size of the file contents
+        # that they avoided storing again.
+        self.link_count = 0
+        self.linked_size = 0
+
+    def add(
+        self,
+        path: Path,
+        arcname: str,
+        stat_result: os.stat_result,
+        *,
+        link_to: str | None = None,
+    ) -> None:
+        """Add a single path to the archive, like ``TarFile.add(recursive=False)``.
+
+        :param path: The path to add.
+        :param arcname: The name of the entry in the archive.
+        :param stat_result: The ``lstat()`` result of ``path``.
+        :param link_to: If set, the name of a regular file already in the
+            archive, with the same contents; ``path`` is added as a hard link to it.
+        """
+        mode = stat_result.st_mode
+        linkname = ""
+        size = 0
+        if stat.S_ISREG(mode):
+            linkname = link_to or self._hard_link_target(arcname, stat_result)
+            if linkname:
+                member_type = tarfile.LNKTYPE
+            else:
+                member_type = tarfile.REGTYPE
+                size = stat_result.st_size
+        elif stat.S_ISDIR(mode):
+            member_type = tarfile.DIRTYPE
+        elif stat.S_ISFIFO(mode):
+            member_type = tarfile.FIFOTYPE
+        elif stat.S_ISLNK(mode):
+            member_type = tarfile.SYMTYPE
+            # Not Path.readlink(), which would normalize the target.
+            linkname = os.readlink(path)  # noqa: PTH115
+        elif stat.S_ISCHR(mode):
+            member_type = tarfile.CHRTYPE
+        elif stat.S_ISBLK(mode):
+            member_type = tarfile.BLKTYPE
+        else:
+            emit.debug(f"Skipping {path}: unsupported file type")
+            return
+
+        name = arcname.lstrip("/")
+        if member_type == tarfile.DIRTYPE and not name.endswith("/"):
+            name += "/"
+        is_device = member_type in (tarfile.CHRTYPE, tarfile.BLKTYPE)
+        self._write(
+            _tar_header(
+                name=name,
+                mode=mode,
+                uid=stat_result.st_uid,
+                gid=stat_result.st_gid,
+                size=size,
+                mtime=min(int(stat_result.st_mtime), self._max_mtime),
+                member_type=member_type,
+                linkname=linkname,
+                devmajor=os.major(stat_result.st_rdev) if is_device else 0,
+                devminor=os.minor(stat_result.st_rdev) if is_device else 0,
+            )
+        )
+        if size:
+            self._write_file(path, arcname, size)
+        elif member_type == tarfile.REGTYPE and self._content_digests is not None:
+            self._content_digests[arcname] = hashlib.sha256().hexdigest()
+
+    def _hard_link_target(self, arcname: str, stat_result: os.stat_result) -> str:
+        """Get the name of the file already in the archive with the same inode.
+
+        :returns: The name of that file, or an empty string if there is none
+            and the regular file ``arcname`` is about to be added.
+        """
+        inode = (stat_result.st_ino, stat_result.st_dev)
+        previous = self._inodes.get(inode)
+        if stat_result.st_nlink > 1 and previous and previous != arcname:
+            self.link_count += 1
+            self.linked_size += stat_result.st_size
+            return previous
+        if inode[0]:
+            self._inodes[inode] = arcname
+        return ""
+
+    def close(self) -> None:
+        """Write the end-of-archive marker, and the padding of the last record."""
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(self._offset + len(self._pending) + end) % tarfile.RECORDSIZE
+        self._pending += bytes(end)
+        self._flush()
+
+    def _write(self, data: bytes) -> None:
+        self._pending += data
+        if len(self._pending) >= _WRITE_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._pending:
+            return
+        data = bytes(self._pending)
+        self._pending.clear()
+        written = self._output.write(data)
+        while written < len(data):
+            # Only raw files write partially.
+            written += self._output.write(data[written:])
+        self._offset += len(data)
+
+    def _write_file(self, path: Path, arcname: str, size: int) -> None:
+        """Write the contents of a regular file, and the padding of its last block."""
+        hasher = None if self._content_digests is None else hashlib.sha256()
+        with path.open("rb", buffering=0) as file:
+            if (
+                self._output_fd is not None
+                and size >= _KERNEL_COPY_MIN_SIZE
+                and hasher is None
+            ):
+                self._flush()
+                try:
+                    utils.copy_file_data(file.fileno(), self._output_fd, size)
+                except errors.RockcraftError as err:
+                    raise errors.LayerArchivingError(
+                        f"Cannot add '{path}': {err}"
+                    ) from err
+                self._offset += size
+            else:
+                remaining = size
+                while remaining:
+                    data = file.read(min(remaining, _WRITE_SIZE))
+                    if not data:
+                        raise errors.LayerArchivingError(
+                            f"Cannot add '{path}': it shrank while being archived"
+                        )
+                    remaining -= len(data)
+                    if hasher is not None:
+                        hasher.update(data)
+                    if len(data) >= _WRITE_SIZE:
+                        self._flush()
+                        self._output.write(data)
+                        self._offset += len(data)
+                    else:
+                        self._write(data)
+
+        if hasher is not None and self._content_digests is not None:
+            self._content_digests[arcname] = hasher.hexdigest()
+        self._write(bytes(-size % tarfile.BLOCKSIZE))
+
+
+def _tar_header(  # noqa: PLR0913 (too many arguments)
+    *,
+    name: str,
+    mode: int,
+    uid: int,
+    gid: int,
+    size: int,
+    mtime: int,
+    member_type: bytes,
+    linkname: str,
+    devmajor: int,
+    devminor: int,
+) -> bytes:
+    """Pack the header block(s) of a tar entry, like ``TarInfo.tobuf()``."""
+    uname = _get_user_name(uid)
+    gname = _get_group_name(gid)
+    try:
+        fields = [
+            _ustar_string(name, 100),
+            _ustar_number(mode & 0o7777, 8),
+            _ustar_number(uid, 8),
+            _ustar_number(gid, 8),
+            _ustar_number(size, 12),
+            _ustar_number(mtime, 12),
+            b"        ",  # The checksum, computed below
+            member_type,
+            _ustar_string(linkname, 100),
+            tarfile.POSIX_MAGIC,
+            _ustar_string(uname, 32),
+            _ustar_string(gname, 32),
+        ]
+        if member_type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            fields += [_ustar_number(devmajor, 8), _ustar_number(devminor, 8)]
+    except ValueError:
+        # Long or non-ASCII names, or huge numbers, need PAX headers.
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mode = mode
+        tarinfo.uid = uid
+        tarinfo.gid = gid
+        tarinfo.size = size
+        tarinfo.mtime = mtime
+        tarinfo.type = member_type
+        tarinfo.linkname = linkname
+        tarinfo.uname = uname
+        tarinfo.gname = gname
+        tarinfo.devmajor = devmajor
+        tarinfo.devminor = devminor
+        return tarinfo.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+    header = b"".join(fields).ljust(tarfile.BLOCKSIZE, b"\0")
+    checksum = b"%06o\0" % sum(header)
+    return header[:148] + checksum + header[155:]
+
+
+def _ustar_string(value: str, length: int) -> bytes:
+    """Encode a string field of a ustar header, if it fits."""
+    data = value.encode("ascii")
+    if len(data) > length:
+        raise ValueError(f"{value!r} does not fit in {length} bytes")
+    return data.ljust(length, b"\0")
+
+
+def _ustar_number(value: int, digits: int) -> bytes:
+    """Encode a numeric field of a ustar header, if it fits."""
+    if not 0 <= value < 8 ** (digits - 1):
+        raise ValueError(f"{value} does not fit in {digits} digits")
+    return b"%0*o\0" % (digits - 1, value)
+
+
+@functools.cache
+def _get_user_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@functools.cache
+def _get_group_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def _merge_layer_paths(
+    candidate_paths: dict[str, list[Path]], stat_cache: StatCache | None = None
+) -> dict[str, Path]:
     """Merge ``candidate_paths`` into a single path per name.
 
     This function handles the case where multiple paths refer to the same name
@@ -192,6 +978,8 @@ def _merge_layer_paths(candidate_paths: dict[str, list[Path]]) -> dict[str, Path
         A dict where the values are Paths and the keys are the names those paths
         correspond to in the new layer.
     """
+    if stat_cache is None:
+        stat_cache = StatCache()
     result: dict[str, Path] = {}
 
     for name, paths in candidate_paths.items():
@@ -199,14 +987,14 @@ def _merge_layer_paths(candidate_paths: dict[str, list[Path]]) -> dict[str, Path
             result[name] = paths[0]
             continue
 
-        if _all_compatible_directories(paths):
+        if _all_compatible_directories(paths, stat_cache):
             emit.debug(
                 f"Multiple directories pointing to '{name}': {', '.join(map(str, paths))}"
             )
             result[name] = paths[0]
             continue
 
-        if _all_compatible_files(paths):
+        if _all_compatible_files(paths, stat_cache):
             emit.debug(
                 f"Multiple files pointing to '{name}': {', '.join(map(str, paths))}"
             )
@@ -224,7 +1012,7 @@ def _merge_layer_paths(candidate_paths: dict[str, list[Path]]) -> dict[str, Path
 
 
 def _symlink_target_in_base_layer(
-    relative_path: Path, base_layer_dir: Path | None
+    relative_path: Path, base_layer_dir: Path | None, stat_cache: StatCache
 ) -> Path | None:
     """If `relative_path` is a dir symlink in `base_layer_dir`, return its 'target'.
 
@@ -234,33 +1022,35 @@ def _symlink_target_in_base_layer(
 
     :param relative_path: The subpath to check.
     :param base_layer_dir: The directory with the contents of the base layer.
+    :param stat_cache: The cache of ``lstat()`` results to use.
     """
     if base_layer_dir is None:
         return None
 
     lower_path = base_layer_dir / relative_path
 
-    if lower_path.is_symlink():
+    if stat_cache.is_symlink(lower_path):
         return lower_path.readlink()
 
     return None
 
 
-def _all_compatible_directories(paths: list[Path]) -> bool:
+def _all_compatible_directories(paths: list[Path], stat_cache: StatCache) -> bool:
     """Whether ``paths`` contains only directories with the same ownership and permissions."""
-    if not all(p.is_dir() for p in paths):
+    if not all(stat_cache.is_dir(p) for p in paths):
         return False
 
     if len(paths) < 2:  # noqa: PLR2004
         return True
 
-    def stat_props(stat: os.stat_result) -> tuple[int, int, int]:
-        return stat.st_uid, stat.st_gid, stat.st_mode
+    def stat_props(path: Path) -> tuple[int, int, int]:
+        stat_result = cast(os.stat_result, stat_cache.stat(path))
+        return stat_result.st_uid, stat_result.st_gid, stat_result.st_mode
 
-    first_stat = stat_props(paths[0].stat())
+    first_stat = stat_props(paths[0])
 
     for other_path in paths[1:]:
-        other_stat = stat_props(other_path.stat())
+        other_stat = stat_props(other_path)
         if first_stat != other_stat:
             emit.debug(
                 f"Path attributes differ for '{paths[0]}' and '{other_path}': "
@@ -271,20 +1061,34 @@ def _all_compatible_directories(paths: list[Path]) -> bool:
     return True
 
 
-def _all_compatible_files(paths: list[Path]) -> bool:
+def _all_compatible_files(paths: list[Path], stat_cache: StatCache) -> bool:
     """Whether ``paths`` contains only files with the same attributes and contents."""
-    if not all(p.is_file() for p in paths):
+    if not all(stat_cache.is_file(p) for p in paths):
         return False
 
     if len(paths) < 2:  # noqa: PLR2004
         return True
 
     first_file = paths[0]
+    first_stat = cast(os.stat_result, stat_cache.lstat(first_file))
+    inode = (first_stat.st_ino, first_stat.st_dev)
+    if all(_inode(p, stat_cache) == inode for p in paths[1:]):
+        # Hard links to the same file, which is trivially compatible.
+        return True
 
-    permissions_first = [_get_permissions(first_file)]
+    permissions_first = [_get_permissions(first_file, stat_cache)]
 
     for other_file in paths[1:]:
-        permissions_other = [_get_permissions(other_file)]
+        other_stat = cast(os.stat_result, stat_cache.lstat(other_file))
+        if (
+            stat.S_ISREG(first_stat.st_mode)
+            and stat.S_ISREG(other_stat.st_mode)
+            and first_stat.st_size != other_stat.st_size
+            and not _is_pkgconfig(first_file)
+        ):
+            # Different contents, without reading them.
+            return False
+        permissions_other = [_get_permissions(other_file, stat_cache)]
         if paths_collide(
             str(first_file), str(other_file), permissions_first, permissions_other
         ):
@@ -293,7 +1097,26 @@ def _all_compatible_files(paths: list[Path]) -> bool:
     return True
 
 
-def _get_permissions(filename: Path) -> Permissions:
+def _is_pkgconfig(path: Path | str) -> bool:
+    """Whether ``path`` is a pkg-config file, compared without its ``prefix`` line.
+
+    Such files can have the same contents with different sizes, as the
+    prefix has any length.
+    """
+    return str(path).endswith(".pc")
+
+
+def _inode(path: Path, stat_cache: StatCache) -> tuple[int, int]:
+    """Get the inode number and device of ``path``, which must exist."""
+    stat_result = cast(os.stat_result, stat_cache.lstat(path))
+    return stat_result.st_ino, stat_result.st_dev
+
+
+def _get_permissions(filename: Path, stat_cache: StatCache) -> Permissions:
     """Create a Permissions object for a given Path."""
-    stat = filename.stat()
-    return Permissions(owner=stat.st_uid, group=stat.st_gid, mode=oct(stat.st_mode))
+    stat_result = cast(os.stat_result, stat_cache.stat(filename))
+    return Permissions(
+        owner=stat_result.st_uid,
+        group=stat_result.st_gid,
+        mode=oct(stat_result.st_mode),
+    )
@@ -16,26 +16,34 @@
 
 """OCI image manipulation helpers."""
 
+import contextlib
+import dataclasses
+import functools
 import hashlib
 import json
 import logging
 import os
 import shutil
 import subprocess
+import tarfile
 import tempfile
-from dataclasses import dataclass
-from datetime import datetime
+from collections.abc import Collection, Iterator, Mapping, Sequence
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO
 
 import yaml
 from craft_cli import emit
+from typing_extensions import Self
 
-from rockcraft import errors, layers
+from rockcraft import errors, layers, processes, timings
 from rockcraft.architectures import SUPPORTED_ARCHS
+from rockcraft.compression import GZIP_LAYER_MEDIA_TYPE, LayerCompression
 from rockcraft.constants import ROCK_CONTROL_DIR
+from rockcraft.layer_cache import FINGERPRINT_ANNOTATION, LayerCache
 from rockcraft.pebble import Pebble
-from rockcraft.utils import get_snap_command_path
+from rockcraft.utils import copy_file_data, get_snap_command_path
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +58,16 @@ MAX_DOWNLOAD_RETRIES = 5
 
 MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
 
+INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+
+_REF_NAME_ANNOTATION = "org.opencontainers.image.ref.name"
+
+_OCI_LAYOUT = b'{"imageLayoutVersion": "1.0.0"}'
+
+
+# Written into runtime bundles once they are completely extracted.
+_BUNDLE_MARKER = ".rockcraft-bundle.json"
+
 
 @dataclass(frozen=True)
 class Image:
@@ -57,18 +75,31 @@ class Image:
 
     :param image_name: The name of this image in ``name:tag`` format.
     :param path: The path to this image in the local filesystem.
+    :param compression: How the layers added to this image are compressed.
+    :param source_date_epoch: If set, the timestamps of the layers and history
+        entries added to this image, as seconds since the epoch, so that the
+        same content always gives the same image. Newer file timestamps in new
+        layers are clamped to it.
+    :param layer_cache: If set, the layers of earlier builds to reuse when a
+        new layer has the same fingerprint; new layers are then annotated with
+        their fingerprint.
     """
 
     image_name: str
     path: Path
+    compression: LayerCompression = field(default_factory=LayerCompression)
+    source_date_epoch: int | None = None
+    layer_cache: LayerCache | None = None
 
     @classmethod
+    @timings.timed("oci")
     def from_docker_registry(
         cls,
         image_name: str,
         *,
         image_dir: Path,
         arch: str,
+        digest: str | None = None,
     ) -> tuple["Image", str]:
         """Obtain an image from a docker registry.
 
@@ -76,9 +107,10 @@ class Image:
 
         :param image_name: The image to retrieve, in ``name@tag`` format.
         :param image_dir: The directory to store local OCI images.
-        :param arch: The architecture of the Docker image to fetch, in Debian format.
-        :param variant: The variant, if any, of the Docker image to fetch.
-
+        :param arch: The architecture of the Docker image to fetch, in Debian
+            format; the variant, if any, is derived from it.
+        :param digest: If set, fetch the image with this digest instead of the
+            one currently tagged; it is still stored locally with the tag.
 
         :returns: The downloaded image and it's corresponding source image
         """
@@ -90,7 +122,11 @@ class Image:
         image_dir.mkdir(parents=True, exist_ok=True)
         image_target = image_dir / image_name
 
-        source_image = f"docker://{REGISTRY_URL}/{image_name}"
+        if digest:
+            name = image_name.split(":", maxsplit=1)[0]
+            source_image = f"docker://{REGISTRY_URL}/{name}@{digest}"
+        else:
+            source_image = f"docker://{REGISTRY_URL}/{image_name}"
         copy_params = ["--retry-times", str(MAX_DOWNLOAD_RETRIES)]
 
         mapping = SUPPORTED_ARCHS[arch]
@@ -112,6 +148,7 @@ class Image:
         return cls(image_name=image_name, path=image_dir), source_image
 
     @classmethod
+    @timings.timed("oci")
     def new_oci_image(
         cls,
         image_name: str,
@@ -122,8 +159,8 @@ class Image:
 
         :param image_name: The image to initiate, in ``name@tag`` format.
         :param image_dir: The directory to store the local OCI image.
-        :param arch: The architecture of the OCI image to create, in Debian format.
-        :param variant: The variant, if any, of the OCI image to create.
+        :param arch: The architecture of the OCI image to create, in Debian
+            format; the variant, if any, is derived from it.
 
         :returns: The new image object and it's corresponding source image
         """
@@ -159,6 +196,7 @@ class Image:
             f"oci:{str(image_target)}",
         )
 
+    @timings.timed("oci")
     def copy_to(self, image_name: str, *, image_dir: Path) -> "Image":
         """Make a copy of the current image.
 
@@ -171,11 +209,51 @@ class Image:
         dest_path = image_dir / image_name
         _copy_image(f"oci:{str(src_path)}", f"oci:{str(dest_path)}")
 
-        return Image(image_name=image_name, path=image_dir)
+        return dataclasses.replace(self, image_name=image_name, path=image_dir)
+
+    def with_compression(self, compression: LayerCompression) -> "Image":
+        """Get this image, compressing the layers added to it as specified.
+
+        :param compression: How to compress new layers.
+
+        :returns: The same image, with the new layer compression settings.
+        """
+        return dataclasses.replace(self, compression=compression)
+
+    def with_source_date_epoch(self, source_date_epoch: int | None) -> "Image":
+        """Get this image, timestamping the changes made to it as specified.
 
+        :param source_date_epoch: The timestamp for new layers and history
+            entries, or None to use the current time.
+
+        :returns: The same image, with the new timestamp settings.
+        """
+        return dataclasses.replace(self, source_date_epoch=source_date_epoch)
+
+    def with_layer_cache(self, archive: Path | None = None) -> "Image":
+        """Get this image, reusing the layers of earlier builds when possible.
+
+        New layers are fingerprinted; if a layer of an image in the same OCI
+        layout, or in ``archive``, has the same fingerprint, its blob is reused.
+
+        :param archive: An optional OCI archive, like a previous rock, with more
+            layers to reuse.
+
+        :returns: The same image, with the layers to reuse.
+        """
+        layer_cache = LayerCache()
+        layer_cache.add_layout(self.path / self.image_name.split(":", 1)[0])
+        if archive is not None:
+            layer_cache.add_archive(archive)
+        emit.debug(f"Found {len(layer_cache)} layers to reuse")
+        return dataclasses.replace(self, layer_cache=layer_cache)
+
+    @timings.timed("oci")
     def extract_to(self, bundle_dir: Path, *, rootless: bool = False) -> Path:
         """Unpack the image to an OCI runtime bundle.
 
+        A bundle previously extracted from the same manifest is reused as is.
+
         :param bundle_dir: The directory to store runtime bundles.
         :param rootless: Whether the image should be unpacked even without
             root; won't necessarily preserve ownership but is useful for
@@ -184,6 +262,15 @@ class Image:
         bundle_dir.mkdir(parents=True, exist_ok=True)
         bundle_path = bundle_dir / self.image_name.replace(":", "-")
         image_path = self.path / self.image_name
+
+        try:
+            digest: str | None = self.manifest_digest()
+        except (OSError, ValueError, KeyError, errors.RockcraftError):
+            digest = None
+        if digest and bundle_matches(bundle_path, digest, rootless=rootless):
+            emit.debug(f"Reusing {bundle_path}, already extracted from {digest}")
+            return bundle_path / "rootfs"
+
         shutil.rmtree(bundle_path, ignore_errors=True)
         command = ["umoci", "unpack"]
         if rootless:
@@ -191,13 +278,38 @@ class Image:
         command.extend(["--image", str(image_path), str(bundle_path)])
         _process_run(command)
 
+        if digest:
+            _write_bundle_marker(bundle_path, digest, rootless=rootless)
+
         return bundle_path / "rootfs"
 
+    def manifest_digest(self) -> str:
+        """Get the digest of this image's manifest in its local OCI layout."""
+        return str(get_manifest_descriptor(self.path / self.image_name)["digest"])
+
+    def layer_blobs(self) -> list[tuple[Path, str]]:
+        """Get the layers of this image in its local OCI layout, bottom first.
+
+        :returns: The path and media type of each layer blob.
+        """
+        manifest = _ImageManifest.load(self.path / self.image_name)
+        return [
+            (
+                manifest.blobs_path / layer["digest"].split(":")[-1],
+                layer.get("mediaType", GZIP_LAYER_MEDIA_TYPE),
+            )
+            for layer in manifest.manifest.get("layers", [])
+        ]
+
+    @timings.timed("oci")
     def add_layer(
         self,
         tag: str,
         new_layer_dir: Path,
         base_layer_dir: Path | None = None,
+        *,
+        deduplicate: bool = False,
+        paths: Collection[str] | None = None,
     ) -> "Image":
         """Add a layer to the image.
 
@@ -205,21 +317,28 @@ class Image:
         :param new_layer_dir: The path to the new layer root filesystem.
         :param base_layer_dir: An optional path to the extracted contents of the
           new layer's base layer. Used to preserve lower-layer symlinks.
+        :param deduplicate: Whether to store identical files in the layer as
+          hard links to a single copy (see ``layers.archive_layer()``).
+        :param paths: If set, only these paths of ``new_layer_dir`` and their
+          parent directories are added to the layer (see ``layers.write_layer()``).
         """
         image_path = self.path / self.image_name
-
-        temp_file = Path(self.path, f".temp_layer.{os.getpid()}.tar")
-        temp_file.unlink(missing_ok=True)
-
-        try:
-            layers.archive_layer(new_layer_dir, temp_file, base_layer_dir)
-            _add_layer_into_image(image_path, temp_file, **{"--tag": tag})
-        finally:
-            temp_file.unlink(missing_ok=True)
+        _add_layer_into_image(
+            image_path,
+            new_layer_dir,
+            self.compression,
+            base_layer_dir,
+            tag=tag,
+            source_date_epoch=self.source_date_epoch,
+            deduplicate=deduplicate,
+            paths=paths,
+            layer_cache=self.layer_cache,
+        )
 
         name = self.image_name.split(":", 1)[0]
-        return self.__class__(image_name=f"{name}:{tag}", path=self.path)
+        return dataclasses.replace(self, image_name=f"{name}:{tag}")
 
+    @timings.timed("oci")
     def add_user(
         self,
         prime_dir: Path,
@@ -228,7 +347,7 @@ class Image:
         username: str,
         uid: int,
     ) -> None:
-        """Create a new rock user.
+        """Create a new rock user, in a new layer.
 
         :param prime_dir: Path to the user-defined parts' primed content.
         :param base_layer_dir: Path to the base layer's root filesystem.
@@ -237,6 +356,32 @@ class Image:
         :param uid: UID of the username to be created. Same as GID.
         """
         # pylint: disable=too-many-arguments
+        with tempfile.TemporaryDirectory() as tmpfs:
+            self.write_user_files(
+                Path(tmpfs),
+                prime_dir=prime_dir,
+                base_layer_dir=base_layer_dir,
+                username=username,
+                uid=uid,
+            )
+            self.add_layer(tag, Path(tmpfs))
+
+    @timings.timed("oci")
+    def write_user_files(
+        self,
+        layer_dir: Path,
+        *,
+        prime_dir: Path,
+        base_layer_dir: Path,
+        username: str,
+        uid: int,
+    ) -> None:
+        """Write the files that create a new rock user into a layer directory.
+
+        See ``add_user()`` for the other parameters.
+
+        :param layer_dir: The root of the new layer's content.
+        """
         user_files = {"passwd": "", "group": "", "shadow": ""}
 
         prime_dir_etc = prime_dir / "etc"
@@ -277,28 +422,29 @@ class Image:
         )
         user_files["group"] += f"{username}:x:{uid}:\n"
 
-        with tempfile.TemporaryDirectory() as tmpfs:
-            tmpfs_etc = Path(tmpfs) / "etc"
-            tmpfs_etc.mkdir(parents=True, exist_ok=True)
-            with (tmpfs_etc / "passwd").open("a+") as passwdf:
-                passwdf.write(user_files["passwd"])
-
-            with (tmpfs_etc / "group").open("a+") as groupf:
-                groupf.write(user_files["group"])
-
-            if user_files["shadow"]:
-                days_since_epoch = (datetime.utcnow() - datetime(1970, 1, 1)).days  # type: ignore[reportDeprecated]
-
-                # only add the shadow file if there's already one in the base image
-                with (tmpfs_etc / "shadow").open("a+") as shadowf:
-                    shadowf.write(
-                        user_files["shadow"]
-                        + f"{username}:!:{days_since_epoch}::::::\n"
-                    )
+        layer_dir_etc = layer_dir / "etc"
+        layer_dir_etc.mkdir(parents=True, exist_ok=True)
+        with (layer_dir_etc / "passwd").open("a+") as passwdf:
+            passwdf.write(user_files["passwd"])
 
-            emit.progress(f"Adding user {username}:{uid} with group {username}:{uid}")
-            self.add_layer(tag, Path(tmpfs))
+        with (layer_dir_etc / "group").open("a+") as groupf:
+            groupf.write(user_files["group"])
+
+        if user_files["shadow"]:
+            created = creation_time(self.source_date_epoch)
+            days_since_epoch = (
+                created - datetime(1970, 1, 1, tzinfo=timezone.utc)
+            ).days
 
+            # only add the shadow file if there's already one in the base image
+            with (layer_dir_etc / "shadow").open("a+") as shadowf:
+                shadowf.write(
+                    user_files["shadow"] + f"{username}:!:{days_since_epoch}::::::\n"
+                )
+
+        emit.progress(f"Adding user {username}:{uid} with group {username}:{uid}")
+
+    @timings.timed("oci")
     def stat(self) -> dict[str, Any]:
         """Obtain the image statistics, as reported by "umoci stat --json"."""
         image_path = self.path / self.image_name
@@ -318,13 +464,23 @@ class Image:
         return result
 
     @staticmethod
+    @timings.timed("oci")
     def digest(source_image: str) -> bytes:
         """Obtain the image digest, given its full form name {transport}:{name}.
 
+        The digest of an image in a local OCI layout is read from the layout
+        itself; other images are inspected with skopeo, which may query their
+        registry.
+
         :param source_image: the source image name, it its full form (e.g. docker://ubuntu:22.04)
         :returns: The image digest bytes.
         """
-        output = subprocess.check_output(
+        if source_image.startswith("oci:"):
+            image_path = Path(source_image.removeprefix("oci:"))
+            digest = get_manifest_descriptor(image_path)["digest"]
+            return bytes.fromhex(digest.split(":", 1)[-1])
+
+        output = processes.run(
             [
                 get_snap_command_path("skopeo"),
                 "inspect",
@@ -333,11 +489,14 @@ class Image:
                 "-n",
                 source_image,
             ],
+            stdout=subprocess.PIPE,
+            check=True,
             text=True,
-        )
+        ).stdout
         parts = output.split(":", 1)
         return bytes.fromhex(parts[-1])
 
+    @timings.timed("oci")
     def to_docker_daemon(self, tag: str) -> None:
         """Export the current image to the local docker daemon.
 
@@ -347,65 +506,66 @@ class Image:
         src_path = self.path / f"{name}:{tag}"
         _copy_image(f"oci:{str(src_path)}", f"docker-daemon:{name}:{tag}")
 
+    @timings.timed("oci")
     def to_oci_archive(self, tag: str, filename: str) -> None:
         """Export the current image to a tar archive in OCI format.
 
+        The archive is an OCI layout with only the blobs of the tagged image,
+        written in one pass straight from the local layout.
+
         :param tag: The tag to export.
+        :param filename: The path of the archive.
         """
         name = self.image_name.split(":", 1)[0]
         src_path = self.path / f"{name}:{tag}"
-        _copy_image(f"oci:{str(src_path)}", f"oci-archive:{filename}:{tag}")
+        _write_oci_archive(src_path, Path(filename))
 
+    @contextlib.contextmanager
+    def config_transaction(self) -> Iterator["ConfigTransaction"]:
+        """Batch several configuration edits into a single update of the image.
+
+        The edits are gathered in memory, and the new config, manifest and index
+        are only written once the context exits without errors.
+        """
+        transaction = ConfigTransaction(
+            self.path / self.image_name, source_date_epoch=self.source_date_epoch
+        )
+        yield transaction
+        transaction.commit()
+
+    @timings.timed("oci")
     def set_default_user(self, userid: int, username: str) -> None:
         """Set the default runtime user for the OCI image.
 
         :param userid: userid of the default user (must already exist)
         :param username: username of the default user (must already exist)
         """
-        image_path = self.path / self.image_name
-        params = ["--clear=config.entrypoint", "--config.user", str(userid)]
-        _config_image(image_path, params)
-        emit.progress(f"Default user set to {userid} ({username})")
+        with self.config_transaction() as config:
+            config.set_default_user(userid, username)
 
+    @timings.timed("oci")
     def set_entrypoint(self, entrypoint: list[str]) -> None:
         """Set the OCI image entrypoint. It is always Pebble."""
-        emit.progress("Configuring entrypoint...")
-        image_path = self.path / self.image_name
-
-        params = ["--clear=config.entrypoint"]
-        for entry in entrypoint:
-            params.extend(["--config.entrypoint", entry])
-
-        params.extend(["--clear=config.cmd"])
-        _config_image(image_path, params)
-        emit.progress(f"Entrypoint set to {entrypoint}")
+        with self.config_transaction() as config:
+            config.set_entrypoint(entrypoint)
 
+    @timings.timed("oci")
     def set_cmd(self, command: list[str]) -> None:
         """Set the OCI image CMD."""
-        emit.progress("Configuring CMD...")
-        image_path = self.path / self.image_name
-        cmd_params = ["--clear=config.cmd"]
-
-        for arg in command:
-            cmd_params.extend(["--config.cmd", arg])
-        _config_image(image_path, cmd_params)
-        emit.progress(f"CMD set to {command}")
+        with self.config_transaction() as config:
+            config.set_cmd(command)
 
+    @timings.timed("oci")
     def set_default_path(self, base: str) -> None:
         """Set the default PATH on the image (only for bare rocks)."""
         if base != "bare":
             emit.debug(f"Not setting a PATH on the image as base is {base!r}")
             return
 
-        # Follow Pebble's lead here: if PATH is empty, use the standard one.
-        # This means that containers that bypass the pebble entrypoint will
-        # have the same behavior as PATH-less pebble services.
-        pebble_path = Pebble.DEFAULT_ENV_PATH
-        image_path = self.path / self.image_name
-
-        emit.debug(f"Setting bare-based rock PATH to {pebble_path!r}")
-        _config_image(image_path, ["--config.env", f"PATH={pebble_path}"])
+        with self.config_transaction() as config:
+            config.set_default_path(base)
 
+    @timings.timed("oci")
     def set_pebble_layer(
         self,
         services: dict[str, Any],
@@ -418,6 +578,8 @@ class Image:
     ) -> None:
         """Write the provided services and checks into a Pebble layer in the filesystem.
 
+        The Pebble layer file is added to the image in a new layer.
+
         :param services: The Pebble services
         :param checks: The Pebble checks
         :param name: The name of the rock
@@ -427,6 +589,37 @@ class Image:
         :param base_layer_dir: Path to the base layer's root filesystem
         """
         # pylint: disable=too-many-arguments
+        with tempfile.TemporaryDirectory() as tmpfs:
+            tmpfs_path = Path(tmpfs)
+            self.write_pebble_layer(
+                tmpfs_path,
+                services=services,
+                checks=checks,
+                name=name,
+                summary=summary,
+                description=description,
+                base_layer_dir=base_layer_dir,
+            )
+            self.add_layer(tag, tmpfs_path)
+
+    @timings.timed("oci")
+    def write_pebble_layer(
+        self,
+        layer_dir: Path,
+        *,
+        services: dict[str, Any],
+        checks: dict[str, Any],
+        name: str,
+        summary: str,
+        description: str,
+        base_layer_dir: Path,
+    ) -> None:
+        """Write the Pebble layer file of the rock into a layer directory.
+
+        See ``set_pebble_layer()`` for the other parameters.
+
+        :param layer_dir: The root of the new layer's content.
+        """
         pebble_layer_content: dict[str, Any] = {
             "summary": summary,
             "description": description,
@@ -443,43 +636,52 @@ class Image:
             pebble_layer_content["checks"] = checks
 
         pebble = Pebble()
-        with tempfile.TemporaryDirectory() as tmpfs:
-            tmpfs_path = Path(tmpfs)
-            pebble.define_pebble_layer(
-                tmpfs_path, base_layer_dir, pebble_layer_content, name
-            )
-
-            emit.progress("Writing new Pebble layer file")
-            self.add_layer(tag, tmpfs_path)
+        pebble.define_pebble_layer(
+            layer_dir, base_layer_dir, pebble_layer_content, name
+        )
+        emit.progress("Writing new Pebble layer file")
 
+    @timings.timed("oci")
     def set_environment(self, env: dict[str, str]) -> None:
         """Set the OCI image environment.
 
         :param env: A dictionary mapping environment variables to
             their values.
         """
-        emit.progress("Configuring OCI environment...")
-        image_path = self.path / self.image_name
-        params: list[str] = []
-        env_list: list[str] = []
-
-        for name, value in env.items():
-            env_item = f"{name}={value}"
-            env_list.append(env_item)
-            params.extend(["--config.env", env_item])
-        _config_image(image_path, params)
-        emit.progress(f"Environment set to {env_list}")
+        with self.config_transaction() as config:
+            config.set_environment(env)
 
+    @timings.timed("oci")
     def set_control_data(self, metadata: dict[str, Any]) -> None:
-        """Create and populate the rock's control data folder.
+        """Create and populate the rock's control data folder, in a new layer.
 
         :param metadata: content for the rock's metadata YAML file
         """
         emit.progress("Setting the rock's control data")
         local_control_data_path = Path(tempfile.mkdtemp())
 
+        try:
+            self.write_control_data(local_control_data_path, metadata)
+            _add_layer_into_image(
+                self.path / self.image_name,
+                local_control_data_path,
+                self.compression,
+                source_date_epoch=self.source_date_epoch,
+            )
+        finally:
+            shutil.rmtree(local_control_data_path)
+
+        emit.progress("Control data written")
+
+    @timings.timed("oci")
+    def write_control_data(self, layer_dir: Path, metadata: dict[str, Any]) -> None:
+        """Write the rock's control data folder into a layer directory.
+
+        :param layer_dir: The root of the new layer's content.
+        :param metadata: content for the rock's metadata YAML file
+        """
         # the rock control data structure starts with the folder ".rock"
-        control_data_rock_folder = local_control_data_path / ROCK_CONTROL_DIR
+        control_data_rock_folder = layer_dir / ROCK_CONTROL_DIR
         control_data_rock_folder.mkdir()
 
         rock_metadata_file = control_data_rock_folder / "metadata.yaml"
@@ -487,17 +689,110 @@ class Image:
             yaml.dump(metadata, rock_meta)
         rock_metadata_file.chmod(0o644)
 
-        temp_tar_file = Path(self.path, f".temp_layer.control_data.{os.getpid()}.tar")
-        temp_tar_file.unlink(missing_ok=True)
+    @timings.timed("oci")
+    def set_annotations(self, annotations: dict[str, Any]) -> None:
+        """Add the given annotations to the final image.
 
-        try:
-            layers.archive_layer(local_control_data_path, temp_tar_file)
-            _add_layer_into_image(self.path / self.image_name, temp_tar_file)
-        finally:
-            temp_tar_file.unlink(missing_ok=True)
+        :param annotations: A dictionary with each annotation/label and its value
+        """
+        with self.config_transaction() as config:
+            config.set_annotations(annotations)
 
-        emit.progress("Control data written")
-        shutil.rmtree(local_control_data_path)
+    @timings.timed("oci")
+    def set_media_type(
+        self,
+    ) -> None:
+        """Set the media type in the target image's manifest."""
+        with self.config_transaction() as config:
+            config.set_media_type()
+
+
+class ConfigTransaction:
+    """A set of configuration edits to an OCI image, written all at once.
+
+    Each edit mirrors the equivalent ``umoci config`` call, but is only applied
+    to the in-memory config and manifest; ``commit()`` then writes a single new
+    config blob, manifest blob and ``index.json``.
+
+    :param image_path: The path to the image, in the format <image>:<tag>.
+    :param source_date_epoch: The timestamp of the history entry for the edits,
+        as seconds since the epoch; if not set, the current time is used.
+    """
+
+    def __init__(
+        self, image_path: Path, *, source_date_epoch: int | None = None
+    ) -> None:
+        self._image_path = image_path
+        self._source_date_epoch = source_date_epoch
+        self._edits: list[str] = []
+        self._manifest: _ImageManifest | None = None
+
+    @property
+    def _image(self) -> "_ImageManifest":
+        if self._manifest is None:
+            self._manifest = _ImageManifest.load(self._image_path)
+        return self._manifest
+
+    @property
+    def _config(self) -> dict[str, Any]:
+        config: dict[str, Any] = self._image.config.setdefault("config", {})
+        return config
+
+    def set_default_user(self, userid: int, username: str) -> None:
+        """Set the default runtime user for the OCI image.
+
+        :param userid: userid of the default user (must already exist)
+        :param username: username of the default user (must already exist)
+        """
+        self._config.pop("Entrypoint", None)
+        self._config["User"] = str(userid)
+        self._edits.append("user")
+        emit.progress(f"Default user set to {userid} ({username})")
+
+    def set_entrypoint(self, entrypoint: list[str]) -> None:
+        """Set the OCI image entrypoint. It is always Pebble."""
+        emit.progress("Configuring entrypoint...")
+        _set_config_list(self._config, "Entrypoint", entrypoint)
+        self._config.pop("Cmd", None)
+        self._edits.append("entrypoint")
+        emit.progress(f"Entrypoint set to {entrypoint}")
+
+    def set_cmd(self, command: list[str]) -> None:
+        """Set the OCI image CMD."""
+        emit.progress("Configuring CMD...")
+        _set_config_list(self._config, "Cmd", command)
+        self._edits.append("cmd")
+        emit.progress(f"CMD set to {command}")
+
+    def set_default_path(self, base: str) -> None:
+        """Set the default PATH on the image (only for bare rocks)."""
+        if base != "bare":
+            emit.debug(f"Not setting a PATH on the image as base is {base!r}")
+            return
+
+        # Follow Pebble's lead here: if PATH is empty, use the standard one.
+        # This means that containers that bypass the pebble entrypoint will
+        # have the same behavior as PATH-less pebble services.
+        pebble_path = Pebble.DEFAULT_ENV_PATH
+
+        emit.debug(f"Setting bare-based rock PATH to {pebble_path!r}")
+        _set_config_env(self._config, "PATH", pebble_path)
+        self._edits.append("env")
+
+    def set_environment(self, env: dict[str, str]) -> None:
+        """Set the OCI image environment.
+
+        :param env: A dictionary mapping environment variables to
+            their values.
+        """
+        emit.progress("Configuring OCI environment...")
+        env_list: list[str] = []
+
+        for name, value in env.items():
+            env_list.append(f"{name}={value}")
+            _set_config_env(self._config, name, value)
+        self._edits.append("env")
+        emit.progress(f"Environment set to {env_list}")
 
     def set_annotations(self, annotations: dict[str, Any]) -> None:
         """Add the given annotations to the final image.
@@ -505,31 +800,37 @@ class Image:
         :param annotations: A dictionary with each annotation/label and its value
         """
         emit.progress("Configuring labels and annotations...")
-        image_path = self.path / self.image_name
-        label_params = ["--clear=config.labels"]
-        annotation_params = ["--clear=manifest.annotations"]
-
-        labels_list: list[str] = []
-        for label_key, label_value in annotations.items():
-            label_item = f"{label_key}={label_value}"
-            labels_list.append(label_item)
-            label_params.extend(["--config.label", label_item])
-            annotation_params.extend(["--manifest.annotation", label_item])
+        labels = {key: f"{value}" for key, value in annotations.items()}
+
         # Set the labels
-        _config_image(image_path, label_params)
+        _set_config_map(self._config, "Labels", labels)
         # Set the annotations as a copy of these labels (for OCI compliance only)
-        _config_image(image_path, annotation_params)
+        _set_config_map(self._image.manifest, "annotations", labels)
+        self._edits.append("labels")
+        labels_list = [f"{key}={value}" for key, value in labels.items()]
         emit.progress(f"Labels and annotations set to {labels_list}")
 
-    def set_media_type(
-        self,
-    ) -> None:
+    def set_media_type(self) -> None:
         """Set the media type in the target image's manifest."""
-        image_path = self.path / self.image_name
-        _inject_oci_fields(
-            image_path,
-            arch_variant=None,
-        )
+        self._image.manifest.setdefault("mediaType", MANIFEST_MEDIA_TYPE)
+
+    @timings.timed("oci")
+    def commit(self) -> None:
+        """Write the edited config and manifest back into the image."""
+        if self._manifest is None:
+            return
+
+        if self._edits:
+            self._manifest.config.setdefault("history", []).append(
+                {
+                    "created": _history_timestamp(self._source_date_epoch),
+                    "created_by": f"rockcraft config: {', '.join(self._edits)}",
+                    "empty_layer": True,
+                }
+            )
+        self._manifest.commit()
+        self._manifest = None
+        self._edits = []
 
 
 def _copy_image(
@@ -557,28 +858,495 @@ def _copy_image(
     )
 
 
+def _write_oci_archive(image_path: Path, archive_path: Path) -> None:
+    """Write a tagged image from a local OCI layout into an OCI archive.
+
+    This is equivalent to ``skopeo copy oci:... oci-archive:...``, without
+    reading and hashing every blob again: blobs are content-addressed, and
+    their data is copied within the kernel with ``copy_file_range()`` (or
+    ``sendfile()``), never going through Python buffers.
+
+    :param image_path: path of the OCI image, in the format <image>:<tag>
+    :param archive_path: The path of the archive to write.
+    """
+    layout_dir, tag = str(image_path).split(":", maxsplit=1)
+    blobs_path = Path(layout_dir) / "blobs" / "sha256"
+    descriptor = get_manifest_descriptor(image_path)
+    descriptor["annotations"] = {
+        **descriptor.get("annotations", {}),
+        _REF_NAME_ANNOTATION: tag,
+    }
+    index = {"schemaVersion": 2, "manifests": [descriptor]}
+
+    with archive_path.open("wb", buffering=0) as archive:
+        _write_archive_entry(archive, "oci-layout", data=_OCI_LAYOUT)
+        _write_archive_entry(archive, "index.json", data=json.dumps(index).encode())
+        _write_archive_entry(archive, "blobs/", directory=True)
+        _write_archive_entry(archive, "blobs/sha256/", directory=True)
+        for digest in _reachable_blobs(blobs_path, descriptor):
+            with (blobs_path / digest).open("rb", buffering=0) as blob:
+                _write_archive_entry(archive, f"blobs/sha256/{digest}", file=blob)
+
+        # End-of-archive marker, padded to a full record like tarfile does.
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(archive.tell() + end) % tarfile.RECORDSIZE
+        archive.write(bytes(end))
+
+
+@timings.timed("oci")
+def merge_oci_archives(
+    archive_paths: Sequence[Path], output_path: Path, *, tag: str | None = None
+) -> None:
+    """Write a multi-architecture OCI archive from the images in other archives.
+
+    The new archive has an image index with the manifest of each image, and
+    the platform of each manifest from its config. Blobs are copied as they
+    are, without recompressing them, and blobs shared by several images
+    are stored once. Archives with an image index, like the ones written
+    here, are merged too.
+
+    :param archive_paths: The archives to merge, like rocks for several platforms.
+    :param output_path: The path of the new archive, replaced if it exists.
+    :param tag: The tag of the image index; by default, the tag of the first
+        image.
+    :raises RockcraftError: If an archive cannot be read, if an image is for an
+        unsupported platform, or if two images are for the same platform.
+    """
+    manifests: list[dict[str, Any]] = []
+    blobs: dict[str, _ArchiveBlob] = {}
+    platforms: dict[str, Path] = {}
+    for archive_path in archive_paths:
+        try:
+            archive = _ArchiveImages(archive_path)
+        except (OSError, tarfile.TarError, ValueError, KeyError) as err:
+            raise errors.RockcraftError(
+                f"Cannot read the OCI archive {str(archive_path)!r}: {err}",
+                resolution="Make sure the file is a rock or an OCI archive.",
+            ) from err
+
+        for descriptor, config in archive.manifests:
+            platform = _get_platform(config, archive_path)
+            platform_name = "/".join(
+                platform[key]
+                for key in ("os", "architecture", "variant")
+                if key in platform
+            )
+            if platform_name in platforms:
+                raise errors.RockcraftError(
+                    f"Both {str(platforms[platform_name])!r} and {str(archive_path)!r} "
+                    f"have an image for {platform_name}."
+                )
+            platforms[platform_name] = archive_path
+
+            annotations = descriptor.pop("annotations", {})
+            if tag is None:
+                tag = annotations.get(_REF_NAME_ANNOTATION)
+            annotations.pop(_REF_NAME_ANNOTATION, None)
+            if annotations:
+                descriptor["annotations"] = annotations
+            manifests.append({**descriptor, "platform": platform})
+        for digest, blob in archive.blobs.items():
+            blobs.setdefault(digest, blob)
+
+    if not manifests:
+        raise errors.RockcraftError("There are no images to merge.")
+
+    index = {"schemaVersion": 2, "mediaType": INDEX_MEDIA_TYPE, "manifests": manifests}
+    index_data = json.dumps(index).encode()
+    index_digest = hashlib.sha256(index_data).hexdigest()
+    top_index = {
+        "schemaVersion": 2,
+        "manifests": [
+            {
+                "mediaType": INDEX_MEDIA_TYPE,
+                "digest": f"sha256:{index_digest}",
+                "size": len(index_data),
+                "annotations": {_REF_NAME_ANNOTATION: tag or "latest"},
+            }
+        ],
+    }
+
+    # The archives to merge may include the output.
+    temp_path = output_path.with_name(f".{output_path.name}.tmp")
+    try:
+        with temp_path.open("wb", buffering=0) as output:
+            _write_archive_entry(output, "oci-layout", data=_OCI_LAYOUT)
+            _write_archive_entry(
+                output, "index.json", data=json.dumps(top_index).encode()
+            )
+            _write_archive_entry(output, "blobs/", directory=True)
+            _write_archive_entry(output, "blobs/sha256/", directory=True)
+            _write_archive_entry(
+                output, f"blobs/sha256/{index_digest}", data=index_data
+            )
+            for digest, blob in blobs.items():
+                with blob.path.open("rb", buffering=0) as source:
+                    source.seek(blob.offset)
+                    _write_archive_entry(
+                        output, f"blobs/sha256/{digest}", file=source, size=blob.size
+                    )
+
+            end = 2 * tarfile.BLOCKSIZE
+            end += -(output.tell() + end) % tarfile.RECORDSIZE
+            output.write(bytes(end))
+        temp_path.replace(output_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+@dataclass(frozen=True)
+class _ArchiveBlob:
+    """Where a blob is in an OCI archive: a range of the archive file."""
+
+    path: Path
+    offset: int
+    size: int
+
+
+class _ArchiveImages:
+    """The image manifests in an OCI archive, and the blobs they refer to.
+
+    :param archive_path: The path of the archive.
+    """
+
+    def __init__(self, archive_path: Path) -> None:
+        self.manifests: list[tuple[dict[str, Any], dict[str, Any]]] = []
+        self.blobs: dict[str, _ArchiveBlob] = {}
+
+        with tarfile.open(archive_path, "r:") as archive:
+            self._members = {
+                member.name.removeprefix("./"): member
+                for member in archive
+                if member.isreg()
+            }
+            self._archive = archive
+            index = json.loads(self._read("index.json"))
+            for descriptor in index.get("manifests", []):
+                self._add_descriptor(archive_path, descriptor)
+
+    def _add_descriptor(self, archive_path: Path, descriptor: dict[str, Any]) -> None:
+        """Add a manifest, or the manifests of an image index, and their blobs."""
+        digest = descriptor["digest"].split(":")[-1]
+        content = json.loads(self._read(f"blobs/sha256/{digest}"))
+        if descriptor.get("mediaType") == INDEX_MEDIA_TYPE:
+            for manifest in content.get("manifests", []):
+                # The tag of the image index applies to its manifests.
+                if _REF_NAME_ANNOTATION in descriptor.get("annotations", {}):
+                    manifest.setdefault("annotations", {})[_REF_NAME_ANNOTATION] = (
+                        descriptor["annotations"][_REF_NAME_ANNOTATION]
+                    )
+                self._add_descriptor(archive_path, manifest)
+            return
+
+        config_digest = content["config"]["digest"].split(":")[-1]
+        config = json.loads(self._read(f"blobs/sha256/{config_digest}"))
+        descriptor = {
+            key: value for key, value in descriptor.items() if key != "platform"
+        }
+        self.manifests.append((descriptor, config))
+        for blob_descriptor in [descriptor, content["config"], *content["layers"]]:
+            blob_digest = blob_descriptor["digest"].split(":")[-1]
+            member = self._members[f"blobs/sha256/{blob_digest}"]
+            self.blobs[blob_digest] = _ArchiveBlob(
+                archive_path, member.offset_data, member.size
+            )
+
+    def _read(self, name: str) -> bytes:
+        file = self._archive.extractfile(self._members[name])
+        return file.read() if file else b""
+
+
+def _get_platform(config: dict[str, Any], archive_path: Path) -> dict[str, str]:
+    """Get the platform of an image for an image index, from its config.
+
+    The variant of architectures that need one, like arm64, is set even if the
+    config does not have it.
+    """
+    architecture = config.get("architecture")
+    for mapping in SUPPORTED_ARCHS.values():
+        if mapping.go_arch == architecture and config.get("variant") in (
+            None,
+            mapping.go_variant,
+        ):
+            platform = {
+                "architecture": mapping.go_arch,
+                "os": config.get("os", "linux"),
+            }
+            if mapping.go_variant:
+                platform["variant"] = mapping.go_variant
+            return platform
+    variant = f"/{config['variant']}" if config.get("variant") else ""
+    raise errors.RockcraftError(
+        f"The image in {str(archive_path)!r} is for an unsupported "
+        f"architecture: {architecture}{variant}."
+    )
+
+
+def _reachable_blobs(blobs_path: Path, descriptor: dict[str, Any]) -> list[str]:
+    """Get the hex digests of the blobs an index or manifest refers to.
+
+    :param blobs_path: The blobs directory of the layout.
+    :param descriptor: The descriptor of the index or manifest.
+    :returns: The digests, each only once, in the order they are referred to.
+    """
+    digests: dict[str, None] = {}
+    pending = [descriptor]
+    while pending:
+        current = pending.pop(0)
+        digest = current["digest"].split(":")[-1]
+        if digest in digests:
+            continue
+        digests[digest] = None
+        # The top level descriptor always refers to a manifest or an index.
+        if current is descriptor or current.get("mediaType") in (
+            MANIFEST_MEDIA_TYPE,
+            INDEX_MEDIA_TYPE,
+        ):
+            content = json.loads((blobs_path / digest).read_bytes())
+            pending.extend(content.get("manifests", []))
+            if "config" in content:
+                pending.append(content["config"])
+            pending.extend(content.get("layers", []))
+    return list(digests)
+
+
+def _write_archive_entry(
+    archive: BinaryIO,
+    name: str,
+    *,
+    data: bytes | None = None,
+    file: BinaryIO | None = None,
+    size: int | None = None,
+    directory: bool = False,
+) -> None:
+    """Write a tar entry with a regular file, or a directory, into ``archive``.
+
+    Entries are owned by root, with fixed modes and timestamps. The data of a
+    ``file`` is copied from its current offset, up to ``size`` bytes if set,
+    or to its end otherwise.
+    """
+    info = tarfile.TarInfo(name)
+    if directory:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    elif file is not None:
+        info.size = os.fstat(file.fileno()).st_size if size is None else size
+        info.mode = 0o644
+    else:
+        info.size = len(data or b"")
+        info.mode = 0o644
+    archive.write(info.tobuf(format=tarfile.PAX_FORMAT))
+
+    if file is not None:
+        copy_file_data(file.fileno(), archive.fileno(), info.size)
+    elif data:
+        archive.write(data)
+    archive.write(bytes(-info.size % tarfile.BLOCKSIZE))
+
+
 def _config_image(image_path: Path, params: list[str]) -> None:
     """Configure the OCI image."""
     _process_run(["umoci", "config", "--image", str(image_path), *params])
 
 
-def _add_layer_into_image(
-    image_path: Path, archived_content: Path, **kwargs: str
+def _add_layer_into_image(  # noqa: PLR0913 (too many arguments)
+    image_path: Path,
+    new_layer_dir: Path,
+    compression: LayerCompression,
+    base_layer_dir: Path | None = None,
+    tag: str | None = None,
+    *,
+    source_date_epoch: int | None = None,
+    deduplicate: bool = False,
+    paths: Collection[str] | None = None,
+    layer_cache: LayerCache | None = None,
 ) -> None:
-    """Add raw layer (archived) into the OCI image.
+    """Archive a directory as a new layer of the OCI image.
+
+    The layer is archived, compressed and hashed in a single pass, and only
+    the compressed blob is written, straight into the image's blob store.
+
+    :param image_path: path of the OCI image, in the format <image>:<tag>
+    :param new_layer_dir: path to the content to be archived into a layer
+    :param compression: how to compress the new layer
+    :param base_layer_dir: optional path to the extracted base below the new layer
+    :param tag: the tag for the image with the new layer. If not set, the
+        image in ``image_path`` is updated in place.
+    :param source_date_epoch: optional timestamp for the new layer, to which the
+        timestamps of its files are clamped
+    :param deduplicate: whether to store identical files as hard links
+    :param paths: optional paths of ``new_layer_dir`` to limit the layer to
+    :param layer_cache: optional layers of earlier builds, reused instead of
+        archiving the layer when their fingerprint is the same
+    """
+    image = _ImageManifest.load(image_path)
+    created = _history_timestamp(source_date_epoch)
+
+    fingerprint_layer = functools.partial(
+        _layer_fingerprint,
+        new_layer_dir,
+        base_layer_dir,
+        compression,
+        source_date_epoch=source_date_epoch,
+        deduplicate=deduplicate,
+        paths=paths,
+    )
+    fingerprint = None
+    content_digests: dict[str, str] | None = None
+    if layer_cache is not None:
+        if source_date_epoch is not None and len(layer_cache) == 0:
+            # There is nothing to reuse: the files, which the fingerprint
+            # hashes, are hashed while they are archived instead of being
+            # read twice.
+            content_digests = {}
+        else:
+            fingerprint = fingerprint_layer()
+            cached = layer_cache.fetch(fingerprint, image.blobs_path)
+            if cached is not None:
+                image.add_layer(
+                    diff_id=cached.diff_id,
+                    digest=cached.digest,
+                    size=cached.size,
+                    media_type=cached.media_type,
+                    created=created,
+                    fingerprint=fingerprint,
+                )
+                image.commit(tag=tag)
+                emit.progress("Reused an unchanged layer from an earlier build")
+                emit.debug(f"Reused layer sha256:{cached.digest}")
+                return
+
+    with _LayerBlobWriter(image.blobs_path, compression) as blob:
+        layers.write_layer(
+            new_layer_dir,
+            blob,
+            base_layer_dir,
+            source_date_epoch=source_date_epoch,
+            deduplicate=deduplicate,
+            paths=paths,
+            content_digests=content_digests,
+        )
+    if content_digests is not None:
+        fingerprint = fingerprint_layer(content_digests=content_digests)
+
+    image.add_layer(
+        diff_id=blob.diff_id,
+        digest=blob.digest,
+        size=blob.size,
+        media_type=compression.media_type,
+        created=created,
+        fingerprint=fingerprint,
+    )
+    image.commit(tag=tag)
+    emit.debug(f"Added layer sha256:{blob.digest} (diff_id sha256:{blob.diff_id})")
+
+
+def _layer_fingerprint(
+    new_layer_dir: Path,
+    base_layer_dir: Path | None,
+    compression: LayerCompression,
+    *,
+    source_date_epoch: int | None,
+    deduplicate: bool,
+    paths: Collection[str] | None,
+    content_digests: Mapping[str, str] | None = None,
+) -> str:
+    """Fingerprint a new layer blob, see ``layers.layer_fingerprint()``."""
+    content = layers.layer_fingerprint(
+        new_layer_dir,
+        base_layer_dir,
+        source_date_epoch=source_date_epoch,
+        deduplicate=deduplicate,
+        paths=paths,
+        content_digests=content_digests,
+    )
+    # The same content compressed differently is a different blob.
+    return hashlib.sha256(
+        f"{compression.media_type} {compression.level} {content}".encode()
+    ).hexdigest()
+
+
+class _LayerBlobWriter:
+    """A file object that turns an uncompressed layer into a compressed blob.
+
+    Data written to it is hashed (for the layer's diff_id), compressed, and
+    hashed again (for the blob's digest) on its way to a temporary file in the
+    blob store. On exit, the temporary file is renamed after its digest.
 
-    :param image_path: path of the OCI image, in the format <image>:<tar>
-    :param archived_content: path to the archived content to be added
+    :param blobs_path: The directory containing the image's blobs.
+    :param compression: How to compress the blob.
     """
-    cmd = [
-        "umoci",
-        "raw",
-        "add-layer",
-        "--image",
-        str(image_path),
-        str(archived_content),
-    ] + [arg_val for k, v in kwargs.items() for arg_val in [k, v]]
-    _process_run([*cmd, "--history.created_by", " ".join(cmd)])
+
+    def __init__(self, blobs_path: Path, compression: LayerCompression) -> None:
+        self._blobs_path = blobs_path
+        self._compression = compression
+        self.diff_id = ""
+        self.digest = ""
+        self.size = 0
+
+    def __enter__(self) -> Self:
+        # pylint: disable=consider-using-with
+        self._blob_file = tempfile.NamedTemporaryFile(
+            dir=self._blobs_path, prefix=".layer.", delete=False
+        )
+        self._compressed = _HashingWriter(self._blob_file)
+        self._compressor = self._compression.open(self._compressed)
+        self._uncompressed = _HashingWriter(self._compressor)
+        return self
+
+    def write(self, data: bytes) -> int:
+        """Add ``data`` to the uncompressed layer."""
+        return self._uncompressed.write(data)
+
+    def flush(self) -> None:
+        """Do nothing; flushing the compressor early would hurt compression."""
+
+    def __exit__(self, exc_type: type[BaseException] | None, *args: object) -> None:
+        temp_blob = Path(self._blob_file.name)
+        finished = False
+        try:
+            if exc_type is None:
+                self._compressor.close()
+                finished = True
+            else:
+                # The blob is deleted: don't compress the rest of the stream.
+                self._compressor.abort()
+        finally:
+            self._blob_file.close()
+            if not finished:
+                temp_blob.unlink(missing_ok=True)
+
+        if not finished:
+            return
+
+        self.diff_id = self._uncompressed.hexdigest()
+        self.digest = self._compressed.hexdigest()
+        self.size = self._compressed.size
+        temp_blob.chmod(0o644)
+        temp_blob.replace(self._blobs_path / self.digest)
+
+
+class _HashingWriter:
+    """A write-only file object that hashes everything written to it."""
+
+    def __init__(self, output: layers.BinaryWriter) -> None:
+        self._output = output
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        """Hash ``data`` and forward it to the output."""
+        self._hash.update(data)
+        self.size += len(data)
+        return self._output.write(data)
+
+    def flush(self) -> None:
+        """Flush the output."""
+        self._output.flush()
+
+    def hexdigest(self) -> str:
+        """Get the hex digest of all the data written so far."""
+        return self._hash.hexdigest()
 
 
 def _inject_oci_fields(image_path: Path, arch_variant: str | None = None) -> None:
@@ -587,66 +1355,317 @@ def _inject_oci_fields(image_path: Path, arch_variant: str | None = None) -> Non
     :param image_path: path of the OCI image
     :param arch_variant: name of the variant to inject in the OCI config
     """
-    image_path_no_tag, image_tag = str(image_path).split(":", maxsplit=1)
-    # pylint: disable=too-many-locals
-    blobs_path = Path(image_path_no_tag) / "blobs" / "sha256"
-    # Get the top level OCI index
-    tl_index_path = Path(image_path_no_tag) / "index.json"
-    tl_index = json.loads(tl_index_path.read_bytes())
-
-    # The manifest of the image being built contains both the base image
-    # and the target image. We need to find the manifest that matches the
-    # tag of the target image, and ensure the tag is not ambiguous.
-    manifest_digests: list[tuple[str, int]] = [
-        (manifest["digest"].split(":")[-1], i)
-        for i, manifest in enumerate(tl_index["manifests"])
-        if (a := manifest.get("annotations"))
-        and a.get("org.opencontainers.image.ref.name") == image_tag
-    ]
-    if not manifest_digests:
-        raise errors.RockcraftError(
-            f"Cannot find manifest for {image_tag} in {tl_index_path}"
-        )
-    if len(manifest_digests) > 1:
-        raise errors.RockcraftError(
-            f"Found multiple manifests for {image_tag} in {tl_index_path}"
-        )
-    manifest_digest, idx = manifest_digests[0]
-    manifest_path = blobs_path / manifest_digest
-    manifest_content = json.loads(manifest_path.read_bytes())
+    image = _ImageManifest.load(image_path)
 
-    if "mediaType" not in manifest_content:
+    if "mediaType" not in image.manifest:
         # Set the mediaType
-        manifest_content["mediaType"] = MANIFEST_MEDIA_TYPE
+        image.manifest["mediaType"] = MANIFEST_MEDIA_TYPE
 
     if arch_variant:
-        # Get the current OCI Image Config
-        image_config_digest = manifest_content["config"]["digest"].split(":")[-1]
-        image_config_path = blobs_path / image_config_digest
-        image_config_content = json.loads(image_config_path.read_bytes())
         # Set the variant
-        image_config_content["variant"] = arch_variant
+        image.config["variant"] = arch_variant
+
+    image.commit()
+
+
+class _ImageManifest:
+    """The manifest and config of a tagged image in a local OCI layout.
+
+    Both are loaded into memory to be edited; ``commit()`` writes them back as
+    new blobs and updates the top level index to point to the new manifest.
+    """
+
+    def __init__(
+        self, layout_dir: Path, tag: str, index: dict[str, Any], position: int
+    ) -> None:
+        self.layout_dir = layout_dir
+        self.tag = tag
+        self.blobs_path = layout_dir / "blobs" / "sha256"
+        self._index = index
+        self._position = position
+        self._manifest_digest = index["manifests"][position]["digest"].split(":")[-1]
+        self.manifest: dict[str, Any] = json.loads(
+            (self.blobs_path / self._manifest_digest).read_bytes()
+        )
+        self._config: dict[str, Any] | None = None
+
+    @classmethod
+    def load(cls, image_path: Path) -> "_ImageManifest":
+        """Load the manifest of the image tagged in ``image_path``.
+
+        :param image_path: path of the OCI image, in the format <image>:<tag>
+        """
+        layout_dir, image_tag = str(image_path).split(":", maxsplit=1)
+        # Get the top level OCI index
+        tl_index_path = Path(layout_dir) / "index.json"
+        tl_index = json.loads(tl_index_path.read_bytes())
+
+        # The manifest of the image being built contains both the base image
+        # and the target image. We need to find the manifest that matches the
+        # tag of the target image, and ensure the tag is not ambiguous.
+        positions = _find_tagged_manifests(tl_index, image_tag)
+        if not positions:
+            raise errors.RockcraftError(
+                f"Cannot find manifest for {image_tag} in {tl_index_path}"
+            )
+        if len(positions) > 1:
+            raise errors.RockcraftError(
+                f"Found multiple manifests for {image_tag} in {tl_index_path}"
+            )
+        return cls(Path(layout_dir), image_tag, tl_index, positions[0])
+
+    @property
+    def descriptor(self) -> dict[str, Any]:
+        """The descriptor of the manifest in the top level index."""
+        return self._index["manifests"][self._position]
+
+    @property
+    def config(self) -> dict[str, Any]:
+        """The OCI Image Config of the image, loaded on first access."""
+        if self._config is None:
+            config_digest = self.manifest["config"]["digest"].split(":")[-1]
+            self._config = json.loads((self.blobs_path / config_digest).read_bytes())
+        return self._config
+
+    def write_blob(self, content: bytes) -> tuple[str, int]:
+        """Store ``content`` as a blob in the image layout.
+
+        :returns: The hex digest and the size of the new blob.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = self.blobs_path / digest
+        # Blobs are content-addressed: an existing one already has this content,
+        # and may be a link to a blob shared with other layouts.
+        if not blob_path.exists():
+            blob_path.write_bytes(content)
+        return digest, len(content)
+
+    def add_layer(
+        self,
+        *,
+        diff_id: str,
+        digest: str,
+        size: int,
+        media_type: str,
+        created: str,
+        fingerprint: str | None = None,
+    ) -> None:
+        """Append a layer blob, already in the blob store, to the image.
+
+        :param diff_id: The hex digest of the uncompressed layer.
+        :param digest: The hex digest of the compressed layer blob.
+        :param size: The size of the compressed layer blob.
+        :param media_type: The media type of the compressed layer blob.
+        :param created: The creation timestamp of the layer, and of the image.
+        :param fingerprint: The fingerprint of the content of the layer, to
+            reuse it in later builds (see ``LayerCache``).
+        """
+        descriptor: dict[str, Any] = {
+            "mediaType": media_type,
+            "digest": f"sha256:{digest}",
+            "size": size,
+        }
+        if fingerprint:
+            descriptor["annotations"] = {FINGERPRINT_ANNOTATION: fingerprint}
+        self.manifest.setdefault("layers", []).append(descriptor)
+        rootfs = self.config.setdefault("rootfs", {"type": "layers"})
+        rootfs.setdefault("diff_ids", []).append(f"sha256:{diff_id}")
+        self.config["created"] = created
+        self.config.setdefault("history", []).append(
+            {
+                "created": created,
+                "created_by": "rockcraft add-layer",
+            }
+        )
 
-        # The OCI image config has changed, so now we need to
-        # regenerate the digests
-        new_image_config_bytes = json.dumps(image_config_content).encode("utf-8")
-        new_image_config_digest = hashlib.sha256(new_image_config_bytes).hexdigest()
-        new_image_config_path = blobs_path / new_image_config_digest
-        new_image_config_path.write_bytes(new_image_config_bytes)
-        image_config_path.unlink()
+    def commit(self, tag: str | None = None) -> None:
+        """Write the (possibly edited) config and manifest, and update the index.
 
-        manifest_content["config"]["digest"] = f"sha256:{new_image_config_digest}"
-        manifest_content["config"]["size"] = len(new_image_config_bytes)
+        :param tag: The tag to point to the new manifest. If not set or equal
+            to the current tag, the image is updated in place; otherwise the
+            current tag is left untouched.
+        """
+        old_config_digest = self.manifest["config"]["digest"].split(":")[-1]
+        new_config_digest = old_config_digest
+        if self._config is not None:
+            # The OCI image config has changed, so now we need to
+            # regenerate the digests
+            new_config_digest, config_size = self.write_blob(
+                json.dumps(self._config).encode("utf-8")
+            )
+            self.manifest["config"]["digest"] = f"sha256:{new_config_digest}"
+            self.manifest["config"]["size"] = config_size
+
+        new_manifest_digest, manifest_size = self.write_blob(
+            json.dumps(self.manifest).encode("utf-8")
+        )
+
+        manifests = self._index["manifests"]
+        descriptor = {
+            **manifests[self._position],
+            "digest": f"sha256:{new_manifest_digest}",
+            "size": manifest_size,
+        }
+        if tag is None or tag == self.tag:
+            manifests[self._position] = descriptor
+        else:
+            # Like "umoci raw add-layer --tag", point (or re-point) the new tag
+            # to the new manifest.
+            descriptor["annotations"] = {
+                **descriptor.get("annotations", {}),
+                _REF_NAME_ANNOTATION: tag,
+            }
+            replaced = _find_tagged_manifests(self._index, tag)
+            manifests[:] = [m for i, m in enumerate(manifests) if i not in replaced]
+            manifests.append(descriptor)
+            self._position = len(manifests) - 1
+            self.tag = tag
+
+        (self.layout_dir / "index.json").write_bytes(
+            json.dumps(self._index).encode("utf-8")
+        )
+
+        # Remove the blobs that were replaced, unless something else still
+        # refers to them.
+        old_manifest_digest = self._manifest_digest
+        self._manifest_digest = new_manifest_digest
+        if old_manifest_digest == new_manifest_digest or any(
+            manifest["digest"].endswith(old_manifest_digest) for manifest in manifests
+        ):
+            return
+        (self.blobs_path / old_manifest_digest).unlink()
+        if old_config_digest != new_config_digest:
+            (self.blobs_path / old_config_digest).unlink()
+
+
+def bundle_matches(bundle_path: Path, digest: str, *, rootless: bool) -> bool:
+    """Whether a runtime bundle was fully extracted from a given image manifest.
+
+    :param bundle_path: The directory of the bundle.
+    :param digest: The digest of the image's manifest.
+    :param rootless: Whether the bundle must have been extracted rootless.
+    """
+    try:
+        marker = json.loads((bundle_path / _BUNDLE_MARKER).read_bytes())
+    except (OSError, ValueError):
+        return False
+    return (
+        marker == {"digest": digest, "rootless": rootless}
+        and (bundle_path / "rootfs").is_dir()
+    )
+
+
+def _write_bundle_marker(bundle_path: Path, digest: str, *, rootless: bool) -> None:
+    """Record that a bundle was fully extracted from an image manifest."""
+    marker = {"digest": digest, "rootless": rootless}
+    (bundle_path / _BUNDLE_MARKER).write_text(json.dumps(marker))
+
+
+def get_manifest_descriptor(image_path: Path) -> dict[str, Any]:
+    """Get the index descriptor of the manifest of a tagged image.
+
+    :param image_path: path of the OCI image, in the format <image>:<tag>
+    :returns: The descriptor, without the tag annotation.
+    """
+    descriptor = dict(_ImageManifest.load(image_path).descriptor)
+    annotations = {
+        key: value
+        for key, value in descriptor.pop("annotations", {}).items()
+        if key != _REF_NAME_ANNOTATION
+    }
+    if annotations:
+        descriptor["annotations"] = annotations
+    return descriptor
 
-    new_manifest_bytes = json.dumps(manifest_content).encode("utf-8")
-    new_manifest_digest = hashlib.sha256(new_manifest_bytes).hexdigest()
-    new_manifest_path = blobs_path / new_manifest_digest
-    new_manifest_path.write_bytes(new_manifest_bytes)
-    manifest_path.unlink()
 
-    tl_index["manifests"][idx]["digest"] = f"sha256:{new_manifest_digest}"
-    tl_index["manifests"][idx]["size"] = len(new_manifest_bytes)
-    tl_index_path.write_bytes(json.dumps(tl_index).encode("utf-8"))
+def set_manifest_descriptor(image_path: Path, descriptor: dict[str, Any]) -> None:
+    """Tag a manifest whose blobs are already in a local OCI layout.
+
+    The layout is initialized if needed, and any manifest previously tagged
+    with the same tag is untagged.
+
+    :param image_path: path of the OCI image, in the format <image>:<tag>
+    :param descriptor: The descriptor of the manifest to tag.
+    """
+    layout_str, tag = str(image_path).split(":", maxsplit=1)
+    layout_dir = Path(layout_str)
+    (layout_dir / "blobs" / "sha256").mkdir(parents=True, exist_ok=True)
+
+    layout_file = layout_dir / "oci-layout"
+    if not layout_file.exists():
+        layout_file.write_text(json.dumps({"imageLayoutVersion": "1.0.0"}))
+
+    index_path = layout_dir / "index.json"
+    if index_path.exists():
+        index = json.loads(index_path.read_bytes())
+    else:
+        index = {"schemaVersion": 2, "manifests": []}
+
+    replaced = _find_tagged_manifests(index, tag)
+    manifests = [m for i, m in enumerate(index["manifests"]) if i not in replaced]
+    manifests.append(
+        {
+            **descriptor,
+            "annotations": {
+                **descriptor.get("annotations", {}),
+                _REF_NAME_ANNOTATION: tag,
+            },
+        }
+    )
+    index["manifests"] = manifests
+    index_path.write_bytes(json.dumps(index).encode("utf-8"))
+
+
+def _find_tagged_manifests(index: dict[str, Any], tag: str) -> list[int]:
+    """Get the positions of the manifests in ``index`` with the given tag."""
+    return [
+        i
+        for i, manifest in enumerate(index["manifests"])
+        if (a := manifest.get("annotations")) and a.get(_REF_NAME_ANNOTATION) == tag
+    ]
+
+
+def creation_time(source_date_epoch: int | None = None) -> datetime:
+    """Get the creation time of new image content.
+
+    :param source_date_epoch: A fixed creation time, as seconds since the epoch;
+        if not set, the current time is used.
+    """
+    if source_date_epoch is None:
+        return datetime.now(timezone.utc)
+    return datetime.fromtimestamp(source_date_epoch, timezone.utc)
+
+
+def _history_timestamp(source_date_epoch: int | None = None) -> str:
+    """Get the creation timestamp for new image history entries."""
+    return creation_time(source_date_epoch).isoformat()
+
+
+def _set_config_list(config: dict[str, Any], key: str, values: list[str]) -> None:
+    """Set a list in the image config, dropping it if empty (like umoci does)."""
+    if values:
+        config[key] = list(values)
+    else:
+        config.pop(key, None)
+
+
+def _set_config_map(config: dict[str, Any], key: str, values: dict[str, str]) -> None:
+    """Replace a mapping in the image config, dropping it if empty."""
+    if values:
+        config[key] = dict(values)
+    else:
+        config.pop(key, None)
+
+
+def _set_config_env(config: dict[str, Any], name: str, value: str) -> None:
+    """Set an environment variable in the image config, replacing existing values."""
+    env: list[str] = config.setdefault("Env", [])
+    item = f"{name}={value}"
+    for i, existing in enumerate(env):
+        if existing.split("=", 1)[0] == name:
+            env[i] = item
+            return
+    env.append(item)
 
 
 def _process_run(command: list[str], **kwargs: Any) -> subprocess.CompletedProcess[Any]:
@@ -657,7 +1676,7 @@ def _process_run(command: list[str], **kwargs: Any) -> subprocess.CompletedProce
 
     emit.trace(f"Execute process: {command!r}, kwargs={kwargs!r}")
     try:
-        return subprocess.run(
+        return processes.run(
             command,
             **kwargs,
             capture_output=True,
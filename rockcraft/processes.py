@@ -0,0 +1,209 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Accounting of the external commands that rockcraft runs, like skopeo and umoci."""
+
+import contextlib
+import subprocess
+import threading
+import time
+from collections.abc import Iterator, Sequence
+from pathlib import PurePath
+from typing import Any, NamedTuple
+
+from rockcraft import timings
+
+
+class ProcessRecord(NamedTuple):
+    """An external command that was run.
+
+    :param command: The summary of the command: the tool and its subcommand,
+        like "umoci config".
+    :param argv: The full command line.
+    :param duration: The wall time of the command, in seconds.
+    :param returncode: The exit status of the command, or None if it could
+        not be started.
+    :param stdout_size: The size of the captured standard output.
+    :param stderr_size: The size of the captured standard error.
+    """
+
+    command: str
+    argv: tuple[str, ...]
+    duration: float
+    returncode: int | None
+    stdout_size: int
+    stderr_size: int
+
+
+class ProcessTotals(NamedTuple):
+    """The totals of the runs of a command.
+
+    :param runs: How many times the command was run.
+    :param failures: How many runs could not start, or had a non-zero exit status.
+    :param duration: The total wall time of the runs, in seconds.
+    :param stdout_size: The total size of the captured standard output.
+    :param stderr_size: The total size of the captured standard error.
+    """
+
+    runs: int
+    failures: int
+    duration: float
+    stdout_size: int
+    stderr_size: int
+
+
+class ProcessLog:
+    """The external commands run while the log is being recorded."""
+
+    def __init__(self) -> None:
+        self._records: list[ProcessRecord] = []
+        self._lock = threading.Lock()
+
+    @property
+    def records(self) -> list[ProcessRecord]:
+        """The commands that were run, in the order they ended."""
+        with self._lock:
+            return list(self._records)
+
+    def add(self, record: ProcessRecord) -> None:
+        """Add a command that was run."""
+        with self._lock:
+            self._records.append(record)
+
+    def totals(self) -> dict[str, ProcessTotals]:
+        """Get the totals of each command, by command summary."""
+        totals: dict[str, ProcessTotals] = {}
+        for record in self.records:
+            current = totals.get(record.command, ProcessTotals(0, 0, 0.0, 0, 0))
+            totals[record.command] = ProcessTotals(
+                runs=current.runs + 1,
+                failures=current.failures + (record.returncode != 0),
+                duration=current.duration + record.duration,
+                stdout_size=current.stdout_size + record.stdout_size,
+                stderr_size=current.stderr_size + record.stderr_size,
+            )
+        return totals
+
+    def format_totals(self) -> str:
+        """Describe the totals of each command, one per line, slowest first."""
+        totals = self.totals()
+        lines = [
+            (
+                f"Ran {sum(t.runs for t in totals.values())} external commands "
+                f"in {sum(t.duration for t in totals.values()):.3f}s"
+            )
+        ]
+        for command, command_totals in sorted(
+            totals.items(), key=lambda item: item[1].duration, reverse=True
+        ):
+            line = (
+                f"  {command}: {command_totals.runs} runs, "
+                f"{command_totals.duration:.3f}s, "
+                f"{command_totals.stdout_size} bytes of output"
+            )
+            if command_totals.failures:
+                line += f", {command_totals.failures} failed"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+_active_logs: list[ProcessLog] = []
+_active_logs_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def recording() -> Iterator[ProcessLog]:
+    """Record the external commands run in the context, from any thread.
+
+    Recordings can be nested; each command is added to all of them.
+    """
+    log = ProcessLog()
+    with _active_logs_lock:
+        _active_logs.append(log)
+    try:
+        yield log
+    finally:
+        with _active_logs_lock:
+            _active_logs.remove(log)
+
+
+def run(command: Sequence[str], **kwargs: Any) -> subprocess.CompletedProcess[Any]:
+    """Run an external command with ``subprocess.run()``, accounting for it.
+
+    The command is added to the active recordings, and to the build timeline.
+
+    :param command: The command line.
+    :param kwargs: The arguments for ``subprocess.run()``.
+    """
+    summary = summarize(command)
+    returncode: int | None = None
+    stdout: str | bytes | None = None
+    stderr: str | bytes | None = None
+    start = time.perf_counter()
+    try:
+        with timings.span(summary, "process"):
+            result = subprocess.run(command, check=kwargs.pop("check", False), **kwargs)
+        returncode, stdout, stderr = result.returncode, result.stdout, result.stderr
+    except subprocess.CalledProcessError as err:
+        returncode, stdout, stderr = err.returncode, err.stdout, err.stderr
+        raise
+    finally:
+        record = ProcessRecord(
+            command=summary,
+            argv=tuple(command),
+            duration=time.perf_counter() - start,
+            returncode=returncode,
+            stdout_size=len(stdout or ""),
+            stderr_size=len(stderr or ""),
+        )
+        with _active_logs_lock:
+            for log in _active_logs:
+                log.add(record)
+    return result
+
+
+# The global options that take a value, which comes before the subcommand.
+_GLOBAL_VALUE_OPTIONS = {
+    "skopeo": frozenset(
+        {
+            "--command-timeout",
+            "--override-arch",
+            "--override-os",
+            "--override-variant",
+            "--policy",
+            "--registries.d",
+            "--tmpdir",
+        }
+    ),
+    "umoci": frozenset({"--log"}),
+}
+
+
+def summarize(command: Sequence[str]) -> str:
+    """Summarize a command line as the tool and its subcommand, like "umoci config"."""
+    if not command:
+        return ""
+    tool = PurePath(command[0]).name
+    value_options = _GLOBAL_VALUE_OPTIONS.get(tool, frozenset())
+    words = [tool]
+    args = iter(command[1:])
+    for arg in args:
+        if arg in value_options:
+            next(args, None)
+        elif not arg.startswith("-"):
+            words.append(arg)
+            break
+    return " ".join(words)
@@ -0,0 +1,380 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""An index of the paths in the root filesystem of a base image."""
+
+import base64
+import io
+import json
+import os
+import posixpath
+import shutil
+import stat
+import tarfile
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from craft_cli import emit
+
+from rockcraft import compression, layers, oci
+from rockcraft.pebble import Pebble
+
+# Bumped when indexes of the same image change, so that cached ones are rebuilt.
+INDEX_VERSION = 2
+
+# The files whose contents are kept in the index, because rockcraft reads them
+# from the base when packing a rock.
+_CONTENT_FILES = frozenset({"etc/passwd", "etc/group", "etc/shadow"})
+_CONTENT_DIRS = (f"{Pebble.PEBBLE_LAYERS_PATH}/",)
+
+_WHITEOUT_PREFIX = ".wh."
+_OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+# Like Linux, give up resolving a path after this many symlinks.
+_MAX_SYMLINKS = 40
+
+
+class RootfsEntry(NamedTuple):
+    """The attributes of a path in a root filesystem.
+
+    :param type: The tar member type of the path, like ``tarfile.REGTYPE``.
+    :param mode: The permission bits of the path.
+    :param uid: The owner of the path.
+    :param gid: The group of the path.
+    :param size: The size of a regular file.
+    :param digest: The digest of the contents of a regular file, from
+        ``layers.content_digest()``.
+    :param linkname: The target of a symlink.
+    """
+
+    type: str
+    mode: int
+    uid: int
+    gid: int
+    size: int
+    digest: str
+    linkname: str
+
+    @property
+    def is_file(self) -> bool:
+        """Whether the path is a regular file."""
+        return self.type == tarfile.REGTYPE.decode()
+
+    @property
+    def is_dir(self) -> bool:
+        """Whether the path is a directory."""
+        return self.type == tarfile.DIRTYPE.decode()
+
+    @property
+    def is_symlink(self) -> bool:
+        """Whether the path is a symlink."""
+        return self.type == tarfile.SYMTYPE.decode()
+
+
+# The attributes of the directories that are not in the layers, but contain
+# some of their entries.
+_IMPLICIT_DIRECTORY = RootfsEntry(
+    type=tarfile.DIRTYPE.decode(),
+    mode=0o755,
+    uid=0,
+    gid=0,
+    size=0,
+    digest="",
+    linkname="",
+)
+
+
+class RootfsIndex:
+    """The paths in the root filesystem of an image, without their contents.
+
+    The index is built by reading the layers of the image once, and is much
+    smaller and faster to load than an extracted root filesystem. It is enough
+    to compare files with the base and to resolve its symlinks; the contents
+    of the few files that rockcraft reads from the base are kept as well, so
+    that a partial root filesystem can be created with ``extract_to()``.
+
+    :param entries: The attributes of each path, relative to the root.
+    :param contents: The contents of the files rockcraft reads from the base.
+    """
+
+    def __init__(
+        self,
+        entries: dict[str, RootfsEntry] | None = None,
+        contents: dict[str, bytes] | None = None,
+    ) -> None:
+        self._entries: dict[str, RootfsEntry] = {}
+        self._contents = contents or {}
+        # The names of the entries in each directory, so that removing a
+        # directory only visits what is under it.
+        self._children: dict[str, set[str]] = {}
+        # The paths added by the layer being read, which its whiteouts keep.
+        self._layer_paths: set[str] = set()
+        for name, entry in (entries or {}).items():
+            self._set_entry(name, entry)
+
+    @classmethod
+    def from_image(cls, image: oci.Image) -> "RootfsIndex":
+        """Index the root filesystem of an image in a local OCI layout.
+
+        The layers are read in order, applying their whiteouts to the lower
+        layers, like ``umoci unpack`` does.
+
+        :param image: The image to index.
+        """
+        index = cls()
+        for blob_path, media_type in image.layer_blobs():
+            index._layer_paths = set()
+            with (
+                blob_path.open("rb") as blob,
+                compression.open_layer_reader(blob, media_type) as reader,
+                tarfile.open(fileobj=reader, mode="r|") as tar,
+            ):
+                for member in tar:
+                    index._add_member(tar, member)
+        return index
+
+    @classmethod
+    def load(cls, path: Path) -> "RootfsIndex | None":
+        """Load an index saved with ``save()``.
+
+        :param path: The path of the index file.
+        :returns: The index, or None if the file is missing or unusable.
+        """
+        try:
+            data: dict[str, Any] = json.loads(path.read_bytes())
+            if data.get("version") != INDEX_VERSION:
+                return None
+            entries = {
+                name: RootfsEntry(*values) for name, values in data["entries"].items()
+            }
+            contents = {
+                name: base64.b64decode(value)
+                for name, value in data["contents"].items()
+            }
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            emit.debug(f"Cannot load the rootfs index {str(path)!r}: {err}")
+            return None
+        return cls(entries, contents)
+
+    def save(self, path: Path) -> None:
+        """Write the index to a file, replacing it only once it is complete.
+
+        :param path: The path of the index file.
+        """
+        data = {
+            "version": INDEX_VERSION,
+            "entries": {name: list(entry) for name, entry in self._entries.items()},
+            "contents": {
+                name: base64.b64encode(value).decode()
+                for name, value in self._contents.items()
+            },
+        }
+        temp_path = path.with_name(f".{path.name}.tmp")
+        temp_path.write_text(json.dumps(data, separators=(",", ":")))
+        temp_path.replace(path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(
+        self, path: str | os.PathLike[str], *, follow_symlinks: bool = True
+    ) -> RootfsEntry | None:
+        """Get the attributes of a path, resolving the symlinks on the way.
+
+        :param path: The path, relative to the root of the filesystem.
+        :param follow_symlinks: Whether to resolve the path itself if it is a
+            symlink, like ``stat()``; otherwise, like ``lstat()``.
+        :returns: The attributes, or None if the path does not exist.
+        """
+        pending = _split(os.fspath(path))
+        resolved: list[str] = []
+        entry: RootfsEntry | None = None
+        links = 0
+        while pending:
+            name = pending.pop(0)
+            if name == "..":
+                if resolved:
+                    resolved.pop()
+                continue
+            entry = self._entries.get("/".join([*resolved, name]))
+            if entry is None:
+                return None
+            if entry.is_symlink and (pending or follow_symlinks):
+                links += 1
+                if links > _MAX_SYMLINKS:
+                    return None
+                if entry.linkname.startswith("/"):
+                    resolved = []
+                pending = _split(entry.linkname) + pending
+                continue
+            if pending and not entry.is_dir:
+                return None
+            resolved.append(name)
+        return entry
+
+    def is_file(self, path: str | os.PathLike[str]) -> bool:
+        """Whether ``path`` is a regular file, or a symlink to one."""
+        entry = self.lookup(path)
+        return entry is not None and entry.is_file
+
+    def extract_to(self, rootfs: Path) -> None:
+        """Create a partial root filesystem from the index.
+
+        The root filesystem has all the directories and symlinks of the
+        image, and only the regular files whose contents are in the index.
+        Ownership is not kept.
+
+        :param rootfs: The directory of the root filesystem, replaced if it
+            already exists.
+        """
+        shutil.rmtree(rootfs, ignore_errors=True)
+        rootfs.mkdir(parents=True)
+        # Parents are always sorted before their children.
+        for name in sorted(self._entries):
+            entry = self._entries[name]
+            path = rootfs / name
+            if entry.is_dir:
+                path.mkdir(parents=True, exist_ok=True)
+                path.chmod(entry.mode | stat.S_IRWXU)
+            elif entry.is_symlink:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.symlink_to(entry.linkname)
+            elif name in self._contents:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(self._contents[name])
+                path.chmod(entry.mode)
+
+    def _add_member(self, tar: tarfile.TarFile, member: tarfile.TarInfo) -> None:
+        """Apply a member of a layer tarball to the index."""
+        name = _normalize(member.name)
+        if not name:
+            return
+        dirname, basename = posixpath.split(name)
+        # Whiteouts only hide the paths of the lower layers, wherever they
+        # are in the layer.
+        if basename == _OPAQUE_WHITEOUT:
+            self._remove(dirname, keep_path=True, lower_only=True)
+            return
+        if basename.startswith(_WHITEOUT_PREFIX):
+            self._remove(
+                posixpath.join(dirname, basename[len(_WHITEOUT_PREFIX) :]),
+                lower_only=True,
+            )
+            return
+
+        previous = self._entries.get(name)
+        if previous is not None and not (previous.is_dir and member.isdir()):
+            self._remove(name)
+        self._add_parents(dirname)
+        self._layer_paths.add(name)
+
+        if member.islnk():
+            target = _normalize(member.linkname)
+            if target in self._entries:
+                self._set_entry(name, self._entries[target])
+                if target in self._contents:
+                    self._contents[name] = self._contents[target]
+            return
+
+        digest = ""
+        if member.isreg():
+            digest = self._read_member(tar, member, name)
+        self._set_entry(
+            name,
+            RootfsEntry(
+                type=member.type.decode(),
+                mode=member.mode,
+                uid=member.uid,
+                gid=member.gid,
+                size=member.size if member.isreg() else 0,
+                digest=digest,
+                linkname=member.linkname if member.issym() else "",
+            ),
+        )
+
+    def _read_member(
+        self, tar: tarfile.TarFile, member: tarfile.TarInfo, name: str
+    ) -> str:
+        """Hash the contents of a regular file, keeping them if needed."""
+        file = tar.extractfile(member)
+        if file is None:  # pragma: no cover (only for non-regular members)
+            return ""
+        if _keeps_contents(name):
+            self._contents[name] = file.read()
+            file = io.BytesIO(self._contents[name])
+        return layers.content_digest(file, pkgconfig=name.endswith(".pc"))
+
+    def _add_parents(self, dirname: str) -> None:
+        """Add the missing parent directories of an entry, like tar extracts them."""
+        missing: list[str] = []
+        while dirname and dirname not in self._entries:
+            missing.append(dirname)
+            dirname = posixpath.dirname(dirname)
+        for path in missing:
+            self._set_entry(path, _IMPLICIT_DIRECTORY)
+            self._layer_paths.add(path)
+
+    def _remove(
+        self, path: str, *, keep_path: bool = False, lower_only: bool = False
+    ) -> None:
+        """Remove a path and everything under it from the index.
+
+        :param keep_path: Whether to only remove what is under the path.
+        :param lower_only: Whether to keep the paths added by the current layer.
+        """
+        names: list[str] = []
+        pending = [path]
+        while pending:
+            children = self._children.get(pending.pop(), ())
+            names.extend(children)
+            pending.extend(children)
+        if not keep_path:
+            names.append(path)
+        for name in names:
+            if lower_only and name in self._layer_paths:
+                continue
+            self._pop_entry(name)
+
+    def _set_entry(self, name: str, entry: RootfsEntry) -> None:
+        """Add or replace the entry of a path."""
+        self._entries[name] = entry
+        self._children.setdefault(posixpath.dirname(name), set()).add(name)
+
+    def _pop_entry(self, name: str) -> None:
+        """Remove the entry of a path, but not the entries under it."""
+        self._entries.pop(name, None)
+        self._contents.pop(name, None)
+        dirname = posixpath.dirname(name)
+        siblings = self._children.get(dirname)
+        if siblings is not None:
+            siblings.discard(name)
+            if not siblings:
+                del self._children[dirname]
+
+
+def _keeps_contents(name: str) -> bool:
+    return name in _CONTENT_FILES or name.startswith(_CONTENT_DIRS)
+
+
+def _split(path: str) -> list[str]:
+    """Split a path into its components, dropping empty and "." ones."""
+    return [part for part in path.split("/") if part not in ("", ".")]
+
+
+def _normalize(name: str) -> str:
+    """Normalize the name of a tar member, relative to the root ("" for the root)."""
+    name = posixpath.normpath("/" + name).lstrip("/")
+    return "" if name == "." else name
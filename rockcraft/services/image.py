@@ -28,16 +28,23 @@ from craft_application import (
 )
 from craft_cli import emit
 
-from rockcraft import oci
+from rockcraft import base_lock, image_cache, oci, timings
+from rockcraft.parts import part_has_overlay
+from rockcraft.rootfs_index import RootfsIndex
 
 
 @dataclass(frozen=True)
 class ImageInfo:
-    """Metadata about a fetched OCI Image."""
+    """Metadata about a fetched OCI Image.
+
+    If the project has no overlay parts, ``base_layer_dir`` is only a partial
+    root filesystem, and ``base_index`` describes the complete one.
+    """
 
     base_image: oci.Image
     base_layer_dir: Path
     base_digest: bytes
+    base_index: RootfsIndex | None = None
 
 
 class RockcraftImageService(ProjectService):
@@ -55,11 +62,43 @@ class RockcraftImageService(ProjectService):
 
         self._work_dir = work_dir
         self._image_info: ImageInfo | None = None
+        self._refresh_base = False
+        self._update_lock = False
+
+    @property
+    def refresh_base(self) -> bool:
+        """Whether the base tag is resolved again, even if cached and fresh."""
+        return self._refresh_base
+
+    @refresh_base.setter
+    def refresh_base(self, refresh: bool) -> None:
+        self._refresh_base = refresh
+
+    @property
+    def update_lock(self) -> bool:
+        """Whether the base digests pinned in the lock file are resolved again."""
+        return self._update_lock
+
+    @update_lock.setter
+    def update_lock(self, update: bool) -> None:
+        self._update_lock = update
+
+    def get_cache(self) -> image_cache.BaseImageCache:
+        """Get the host-wide cache of base images, as configured."""
+        config = self._services.get("config")
+        return image_cache.BaseImageCache(
+            image_cache.get_cache_dir(
+                self._app.name, config.get("base_image_cache_dir")
+            ),
+            max_size=config.get("base_image_cache_max_size"),
+            tag_ttl=config.get("base_image_tag_ttl"),
+        )
 
     def obtain_image(self) -> ImageInfo:
         """Return the ImageInfo for the project's base, possibly fetching it."""
         if self._image_info is None:
-            self._image_info = self._create_image_info()
+            with timings.span("obtain base image", "image"):
+                self._image_info = self._create_image_info()
 
         return self._image_info
 
@@ -75,33 +114,73 @@ class RockcraftImageService(ProjectService):
         build_for = build_plan[0].build_for
         project = self._services.get("project").get()
         base = cast(str, project.base)
-        if base == "bare":
-            base_image, source_image = oci.Image.new_oci_image(
-                f"{base}@latest",
-                image_dir=image_dir,
-                arch=build_for,
-            )
-        else:
-            emit.progress(f"Retrieving base {base} for {build_for}")
-            base_image, source_image = oci.Image.from_docker_registry(
-                base,
-                image_dir=image_dir,
-                arch=build_for,
-            )
-            emit.progress(f"Retrieved base {base} for {build_for}")
+        with timings.span("fetch base", "image", base=base, build_for=build_for):
+            base_image, base_digest = self._fetch_base(base, build_for, image_dir)
 
-        emit.progress(f"Extracting {base_image.image_name}")
-        rootfs = base_image.extract_to(bundle_dir)
-        emit.progress(f"Extracted {base_image.image_name}")
+        rootfs_cache = image_cache.RootfsCache(
+            image_cache.get_rootfs_cache_dir(self._app.name)
+        )
+        base_index = None
+        if any(part_has_overlay(part) for part in (project.parts or {}).values()):
+            # Overlays are mounted on top of the complete base.
+            emit.progress(f"Extracting {base_image.image_name}")
+            with timings.span("extract base", "image"):
+                rootfs = rootfs_cache.extract(base_image, bundle_dir)
+            emit.progress(f"Extracted {base_image.image_name}")
+        else:
+            emit.progress(f"Indexing {base_image.image_name}")
+            with timings.span("index base", "image"):
+                rootfs, base_index = rootfs_cache.extract_index(base_image, bundle_dir)
+            emit.progress(f"Indexed {base_image.image_name}")
 
         project_base_image = base_image.copy_to(
             f"{project.name}:rockcraft-base", image_dir=image_dir
         )
 
-        base_digest = project_base_image.digest(source_image)
-
         return ImageInfo(
             base_image=project_base_image,
             base_layer_dir=rootfs,
             base_digest=base_digest,
+            base_index=base_index,
         )
+
+    def _fetch_base(
+        self, base: str, build_for: str, image_dir: Path
+    ) -> tuple[oci.Image, bytes]:
+        """Get the base image for ``build_for``, from the cache or the registry.
+
+        :returns: The base image, and the digest of its source image.
+        """
+        if base == "bare":
+            base_image, source_image = oci.Image.new_oci_image(
+                f"{base}@latest",
+                image_dir=image_dir,
+                arch=build_for,
+            )
+            base_digest = oci.Image.digest(source_image)
+        else:
+            emit.progress(f"Retrieving base {base} for {build_for}")
+            cache = self.get_cache()
+            lock = base_lock.BaseLock.load(self._project_dir)
+            pinned = None if self._update_lock else lock.get(base, build_for)
+            if pinned:
+                emit.debug(f"Using {base} for {build_for} pinned in {lock.path}")
+                base_image, _ = cache.get_image(
+                    base, image_dir=image_dir, arch=build_for, digest=pinned
+                )
+                base_digest = bytes.fromhex(pinned.removeprefix("sha256:"))
+            else:
+                base_image, _ = cache.get_image(
+                    base,
+                    image_dir=image_dir,
+                    arch=build_for,
+                    refresh=self._refresh_base or self._update_lock,
+                )
+                base_digest = cache.get_source_digest(base, arch=build_for)
+                # Projects only get a lock file when they ask for one; once
+                # they have one, new bases and platforms are pinned too.
+                if self._update_lock or lock.path.exists():
+                    lock.set(base, build_for, f"sha256:{base_digest.hex()}")
+                    lock.save()
+            emit.progress(f"Retrieved base {base} for {build_for}")
+        return base_image, base_digest
@@ -16,21 +16,31 @@
 
 """Rockcraft Lifecycle service."""
 
+import contextlib
 import re
 from pathlib import Path
-from typing import cast
+from typing import TYPE_CHECKING, cast
 
 from craft_application import LifecycleService
+from craft_parts import Part, Step, callbacks
+from craft_parts.errors import CallbackRegistrationError
 from craft_parts.infos import StepInfo
+from craft_parts.parts import sort_parts
+from craft_parts.state_manager import states
 from overrides import override  # type: ignore[reportUnknownVariableType]
 
-from rockcraft import layers
+from rockcraft import layers, timings
 from rockcraft.plugins.python_common import get_python_plugins
 
+if TYPE_CHECKING:
+    from rockcraft.services import RockcraftImageService
+
 
 class RockcraftLifecycleService(LifecycleService):
     """Rockcraft-specific lifecycle service."""
 
+    _step_spans: dict[tuple[str, Step], timings.Span]
+
     @override
     def setup(self) -> None:
         """Initialize the LifecycleManager with previously-set arguments."""
@@ -63,6 +73,67 @@ class RockcraftLifecycleService(LifecycleService):
         )
         super().setup()
 
+        self._step_spans = {}
+        if timings.get_timeline() is not None:
+            # Registered after post_prime(), so that the span of the prime
+            # step includes the pruning and fixups.
+            with contextlib.suppress(CallbackRegistrationError):
+                callbacks.register_pre_step(self._start_step_span)
+                callbacks.register_post_step(self._finish_step_span)
+
+    @override
+    def run(self, step_name: str | None, part_names: list[str] | None = None) -> None:
+        """Run the lifecycle, recording it on the build timeline."""
+        with timings.span("lifecycle", "lifecycle", step=step_name):
+            super().run(step_name, part_names)
+
+    def _start_step_span(self, step_info: StepInfo) -> bool:
+        """Start the span of a step of a part."""
+        if step_info.step is not None:
+            span = timings.start_span(
+                f"{step_info.step.name.lower()} {step_info.part_name}",
+                "lifecycle",
+                part=step_info.part_name,
+                step=step_info.step.name.lower(),
+            )
+            if span:
+                self._step_spans[(step_info.part_name, step_info.step)] = span
+        return True
+
+    def _finish_step_span(self, step_info: StepInfo) -> bool:
+        """Finish the span of a step of a part."""
+        if step_info.step is not None:
+            span = self._step_spans.pop((step_info.part_name, step_info.step), None)
+            if span:
+                span.finish()
+        return True
+
+    def get_primed_paths(self) -> dict[str, set[str]]:
+        """Get the paths that each part primed, from its prime state.
+
+        Parts are listed in lifecycle order, so a part always comes after the
+        parts listed in its ``after`` key. Paths that were pruned afterwards
+        are still listed.
+
+        :returns: A dict mapping the name of each part to the files and
+            directories it primed, relative to the prime directory.
+        """
+        project = self._services.get("project").get()
+        part_list = [
+            # Only the keys that order the parts are needed to find their state.
+            Part(
+                name,
+                {"after": data.get("after", [])},
+                project_dirs=self.project_info.dirs,
+            )
+            for name, data in (project.parts or {}).items()
+        ]
+        primed: dict[str, set[str]] = {}
+        for part in sort_parts(part_list):
+            state = states.load_step_state(part, Step.PRIME)
+            primed[part.name] = state.files | state.directories if state else set()
+        return primed
+
     @override
     def post_prime(self, step_info: StepInfo) -> bool:
         """Perform base-layer pruning on primed files."""
@@ -71,10 +142,16 @@ class RockcraftLifecycleService(LifecycleService):
         files: set[str]
 
         files = step_info.state.files if step_info.state else set()
-        layers.prune_prime_files(prime_dir, files, base_layer_dir)
-
-        _python_usrmerge_fix(step_info)
-        _python_v2_shebang_fix(step_info)
+        image_service = cast("RockcraftImageService", self._services.get("image"))
+        image_info = image_service.obtain_image()
+        with timings.span("prune", "lifecycle", part=step_info.part_name):
+            layers.prune_prime_files(
+                prime_dir, files, base_layer_dir, base_index=image_info.base_index
+            )
+
+        with timings.span("prime fixups", "lifecycle", part=step_info.part_name):
+            _python_usrmerge_fix(step_info)
+            _python_v2_shebang_fix(step_info)
 
         return True
 
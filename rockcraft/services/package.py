@@ -16,25 +16,86 @@
 
 """Rockcraft Package service."""
 
-import datetime
+import dataclasses
+import os
 import pathlib
+import posixpath
+import tempfile
 import typing
 from typing import cast
 
-from craft_application import PackageService, errors, models
+from craft_application import AppMetadata, PackageService, errors, models
 from craft_cli import emit
+from craft_parts import overlays
 from overrides import override  # type: ignore[reportUnknownVariableType]
 
-from rockcraft import oci
+from rockcraft import oci, timings
+from rockcraft.compression import LayerCompression
 from rockcraft.models import Project
 from rockcraft.pebble import Pebble
 from rockcraft.usernames import SUPPORTED_GLOBAL_USERNAMES
 from rockcraft.utils import parse_command
 
+if typing.TYPE_CHECKING:
+    from craft_application import ServiceFactory
+
+    from rockcraft.services import RockcraftLifecycleService
+
+# How the primed files are split into the layers of the rock: all in a single
+# layer, one layer per part, or one layer per group of parts with the same
+# depth in the "after" dependencies of the project.
+LAYER_MODES = ("single", "parts", "groups")
+
+# The name of the markers of opaque directories, like the ones of overlays.
+_OPAQUE_MARKER = overlays.oci_opaque_dir(pathlib.Path()).name
+
+
+@dataclasses.dataclass(frozen=True)
+class PackOptions:
+    """Options that tune how rocks are packed.
+
+    :param compression: How the layers of the rock are compressed.
+    :param source_date_epoch: If set, the creation time of the rock as seconds
+        since the epoch, usually from ``SOURCE_DATE_EPOCH``. The rock is then
+        reproducible: packing the same content again gives the same digests.
+    :param deduplicate_files: Whether to store the files of the rock with the
+        same contents, mode and owner as hard links to a single copy.
+    :param layers: How the primed files are split into layers, one of
+        ``LAYER_MODES``.
+    :param layer_cache_from: An optional rock, or OCI archive, of an earlier
+        build whose unchanged layers are reused.
+    :param squash_synthetic_layers: Whether the files rockcraft adds on top of
+        the payload (the rock user, the Pebble layer and the control data) are
+        added in a single layer, instead of one layer each.
+    """
+
+    compression: LayerCompression = dataclasses.field(default_factory=LayerCompression)
+    source_date_epoch: int | None = None
+    deduplicate_files: bool = False
+    layers: str = "single"
+    layer_cache_from: pathlib.Path | None = None
+    squash_synthetic_layers: bool = True
+
 
 class RockcraftPackageService(PackageService):
     """Package service subclass for Rockcraft."""
 
+    def __init__(self, app: AppMetadata, services: "ServiceFactory") -> None:
+        super().__init__(app, services)
+        self._options = PackOptions()
+
+    @property
+    def options(self) -> PackOptions:
+        """The options used when packing."""
+        return self._options
+
+    def set_options(self, options: PackOptions) -> None:
+        """Set the options used when packing.
+
+        :param options: The new pack options.
+        """
+        self._options = options
+
     @override
     def pack(self, prime_dir: pathlib.Path, dest: pathlib.Path) -> list[pathlib.Path]:
         """Create one or more packages as appropriate.
@@ -56,16 +117,29 @@ class RockcraftPackageService(PackageService):
 
         platform = build_plan[0].platform
         build_for = build_plan[0].build_for
-
-        archive_name = _pack(
-            prime_dir=prime_dir,
-            project=cast(Project, self._services.get("project").get()),
-            project_base_image=image_info.base_image,
-            base_digest=image_info.base_digest,
-            rock_suffix=platform,
-            build_for=build_for,
-            base_layer_dir=image_info.base_layer_dir,
-        )
+        project = cast(Project, self._services.get("project").get())
+
+        part_layers = None
+        if self._options.layers != "single":
+            lifecycle = cast(
+                "RockcraftLifecycleService", self._services.get("lifecycle")
+            )
+            part_layers = _get_part_layers(
+                lifecycle.get_primed_paths(), project, self._options.layers
+            )
+
+        with timings.span("pack", "package", platform=platform):
+            archive_name = _pack(
+                prime_dir=prime_dir,
+                project=project,
+                project_base_image=image_info.base_image,
+                base_digest=image_info.base_digest,
+                rock_suffix=platform,
+                build_for=build_for,
+                base_layer_dir=image_info.base_layer_dir,
+                options=self._options,
+                part_layers=part_layers,
+            )
 
         return [dest / archive_name]
 
@@ -84,7 +158,7 @@ class RockcraftPackageService(PackageService):
         return models.BaseMetadata()
 
 
-def _pack(
+def _pack(  # noqa: PLR0913 (too many arguments)
     *,
     prime_dir: pathlib.Path,
     project: Project,
@@ -93,11 +167,18 @@ def _pack(
     rock_suffix: str,
     build_for: str,
     base_layer_dir: pathlib.Path,
+    options: PackOptions,
+    part_layers: list[tuple[list[str], set[str]]] | None = None,
 ) -> str:
     """Create the rock image for a given architecture.
 
-    :param lifecycle:
-      The lifecycle object containing the primed payload for the rock.
+    The payload and synthetic layers are added first, then the whole image
+    configuration is set in a single config transaction.
+
+    :param prime_dir:
+      The directory containing the primed payload for the rock.
+    :param project:
+      The project of the rock, for its metadata and OCI configuration.
     :param project_base_image:
       The Image for the base over which the payload was primed.
     :param base_digest:
@@ -108,90 +189,286 @@ def _pack(
       The architecture of the built rock, to add as metadata.
     :param base_layer_dir:
       The directory where the rock's base image was extracted.
+    :param options:
+      The options that tune how the rock is packed.
+    :param part_layers:
+      If set, the names of the parts and the paths they primed for each layer,
+      from the bottom one up, instead of a single layer for the whole payload.
+    :returns: The file name of the rock archive.
     """
-    emit.progress("Creating new layer")
-
     # At this point the version must be set, otherwise it would have failed earlier.
     version = cast(str, project.version)
 
-    new_image = project_base_image.add_layer(
+    image = (
+        project_base_image.with_compression(options.compression)
+        .with_source_date_epoch(options.source_date_epoch)
+        .with_layer_cache(options.layer_cache_from)
+    )
+    new_image = _add_payload_layers(
+        image,
+        prime_dir=prime_dir,
+        base_layer_dir=base_layer_dir,
         tag=version,
-        new_layer_dir=prime_dir,
+        options=options,
+        part_layers=part_layers,
+    )
+    # Set annotations and metadata, both dynamic and the ones based on user-provided properties
+    # Also include the "created" timestamp, just before packing the image
+    emit.progress("Adding metadata")
+    oci_annotations, rock_metadata = project.generate_metadata(
+        oci.creation_time(options.source_date_epoch).isoformat(),
+        base_digest,
+        build_for,
+    )
+    _add_synthetic_layers(
+        new_image,
+        project=project,
+        prime_dir=prime_dir,
         base_layer_dir=base_layer_dir,
+        tag=version,
+        rock_metadata=rock_metadata,
+        squash=options.squash_synthetic_layers,
     )
-    emit.progress("Created new layer")
-    if project.run_user:
-        emit.progress(f"Creating new user {project.run_user}")
-        userid = SUPPORTED_GLOBAL_USERNAMES[project.run_user]["uid"]
-        new_image.add_user(
-            prime_dir=prime_dir,
-            base_layer_dir=base_layer_dir,
-            tag=version,
-            username=project.run_user,
-            uid=userid,
-        )
 
-        emit.progress(f"Setting the default OCI user to be {project.run_user}")
-        new_image.set_default_user(userid, project.run_user)
+    # All the layers are in place; apply every configuration change to the
+    # image in a single update of its config and manifest.
+    with new_image.config_transaction() as config:
+        if project.run_user:
+            emit.progress(f"Setting the default OCI user to be {project.run_user}")
+            userid = SUPPORTED_GLOBAL_USERNAMES[project.run_user]["uid"]
+            config.set_default_user(userid, project.run_user)
+
+        if project.entrypoint_command:
+            emit.progress("Setting OCI entrypoint")
+            entrypoint, cmd = parse_command(project.entrypoint_command)
+        else:
+            emit.progress("Adding Pebble entrypoint")
+
+            entrypoint = Pebble.get_entrypoint(project.build_base or project.base)
+            cmd = []
+
+            if project.entrypoint_service:
+                entrypoint.extend(["--args", project.entrypoint_service])
+
+            if project.services and project.entrypoint_service in project.services:
+                command = project.services[project.entrypoint_service].command
+                cmd = parse_command(command or "")[1]
+
+        config.set_entrypoint(entrypoint)
+        config.set_cmd(cmd)
+        config.set_default_path(project.base)
+
+        if project.environment:
+            config.set_environment(project.environment)
+
+        config.set_annotations(oci_annotations)
+        emit.progress("Metadata added")
+
+        # Set the media type in the target images's manifest.
+        # This is different than calling _inject_oci_fields in oci.Image.new_oci_image,
+        # since _inject_oci_fields is called in the context of creating the base image.
+        emit.progress("Adding manifest media type")
+        config.set_media_type()
+    emit.progress("Manifest media type added")
 
-    if project.entrypoint_command:
-        emit.progress("Setting OCI entrypoint")
-        entrypoint, cmd = parse_command(project.entrypoint_command)
-    else:
-        emit.progress("Adding Pebble entrypoint")
+    emit.progress("Exporting to OCI archive")
+    archive_name = f"{project.name}_{project.version}_{rock_suffix}.rock"
+    new_image.to_oci_archive(tag=version, filename=archive_name)
+    emit.progress(f"Exported to OCI archive '{archive_name}'")
 
-        entrypoint = Pebble.get_entrypoint(project.build_base or project.base)
-        cmd = []
+    return archive_name
 
-        if project.entrypoint_service:
-            entrypoint.extend(["--args", project.entrypoint_service])
 
-        if project.services and project.entrypoint_service in project.services:
-            command = project.services[project.entrypoint_service].command
-            cmd = parse_command(command or "")[1]
+def _add_synthetic_layers(
+    image: oci.Image,
+    *,
+    project: Project,
+    prime_dir: pathlib.Path,
+    base_layer_dir: pathlib.Path,
+    tag: str,
+    rock_metadata: dict[str, typing.Any],
+    squash: bool,
+) -> None:
+    """Add the rock user, the Pebble layer and the control data to the image.
 
-    new_image.set_entrypoint(entrypoint)
-    new_image.set_cmd(cmd)
-    new_image.set_default_path(project.base)
+    Their paths never overlap, so adding them in a single layer gives the same
+    filesystem as adding one layer for each of them.
 
+    See ``_pack()`` for the other parameters.
+
+    :param rock_metadata: The content of the rock's metadata file.
+    :param squash: Whether to add all the files in a single layer.
+    """
     dumped = project.marshal()
     services = cast(dict[str, typing.Any], dumped.get("services", {}))
     checks = cast(dict[str, typing.Any], dumped.get("checks", {}))
 
-    if services or checks:
-        new_image.set_pebble_layer(
-            services=services,
-            checks=checks,
-            name=project.name,
-            tag=version,
-            summary=project.summary,
-            description=project.description,
+    if not squash:
+        if project.run_user:
+            emit.progress(f"Creating new user {project.run_user}")
+            image.add_user(
+                prime_dir=prime_dir,
+                base_layer_dir=base_layer_dir,
+                tag=tag,
+                username=project.run_user,
+                uid=SUPPORTED_GLOBAL_USERNAMES[project.run_user]["uid"],
+            )
+        if services or checks:
+            image.set_pebble_layer(
+                services=services,
+                checks=checks,
+                name=project.name,
+                tag=tag,
+                summary=project.summary,
+                description=project.description,
+                base_layer_dir=base_layer_dir,
+            )
+        image.set_control_data(rock_metadata)
+        return
+
+    with tempfile.TemporaryDirectory() as layer_dir:
+        layer_path = pathlib.Path(layer_dir)
+        if project.run_user:
+            emit.progress(f"Creating new user {project.run_user}")
+            image.write_user_files(
+                layer_path,
+                prime_dir=prime_dir,
+                base_layer_dir=base_layer_dir,
+                username=project.run_user,
+                uid=SUPPORTED_GLOBAL_USERNAMES[project.run_user]["uid"],
+            )
+        if services or checks:
+            image.write_pebble_layer(
+                layer_path,
+                services=services,
+                checks=checks,
+                name=project.name,
+                summary=project.summary,
+                description=project.description,
+                base_layer_dir=base_layer_dir,
+            )
+        image.write_control_data(layer_path, rock_metadata)
+        emit.progress("Adding the rock's user, Pebble layer and control data")
+        image.add_layer(tag, layer_path)
+
+
+def _add_payload_layers(
+    image: oci.Image,
+    *,
+    prime_dir: pathlib.Path,
+    base_layer_dir: pathlib.Path,
+    tag: str,
+    options: PackOptions,
+    part_layers: list[tuple[list[str], set[str]]] | None,
+) -> oci.Image:
+    """Add the primed payload to the image, in one layer or in part layers.
+
+    See ``_pack()`` for the parameters.
+
+    :returns: The image with the new layers, tagged with ``tag``.
+    """
+    if part_layers is None:
+        emit.progress("Creating new layer")
+        image = image.add_layer(
+            tag=tag,
+            new_layer_dir=prime_dir,
             base_layer_dir=base_layer_dir,
+            deduplicate=options.deduplicate_files,
         )
+        emit.progress("Created new layer")
+        return image
+
+    for description, paths in _split_prime_dir(prime_dir, part_layers):
+        emit.progress(f"Creating new layer for {description}")
+        image = image.add_layer(
+            tag=tag,
+            new_layer_dir=prime_dir,
+            base_layer_dir=base_layer_dir,
+            deduplicate=options.deduplicate_files,
+            paths=paths,
+        )
+        emit.progress(f"Created new layer for {description}")
+    return image
 
-    if project.environment:
-        new_image.set_environment(project.environment)
-
-    # Set annotations and metadata, both dynamic and the ones based on user-provided properties
-    # Also include the "created" timestamp, just before packing the image
-    emit.progress("Adding metadata")
-    oci_annotations, rock_metadata = project.generate_metadata(
-        datetime.datetime.now(datetime.timezone.utc).isoformat(), base_digest, build_for
-    )
-    new_image.set_annotations(oci_annotations)
-    new_image.set_control_data(rock_metadata)
-    emit.progress("Metadata added")
-
-    # Set the media type in the target images's manifest.
-    # This is different than calling _inject_oci_fields in oci.Image.new_oci_image,
-    # since _inject_oci_fields is called in the context of creating the base image.
-    emit.progress("Adding manifest media type")
-    new_image.set_media_type()
-    emit.progress("Manifest media type added")
 
-    emit.progress("Exporting to OCI archive")
-    archive_name = f"{project.name}_{project.version}_{rock_suffix}.rock"
-    new_image.to_oci_archive(tag=version, filename=archive_name)
-    emit.progress(f"Exported to OCI archive '{archive_name}'")
+def _get_part_layers(
+    primed_paths: dict[str, set[str]], project: Project, mode: str
+) -> list[tuple[list[str], set[str]]]:
+    """Group the paths primed by each part into layers.
 
-    return archive_name
+    :param primed_paths: The paths primed by each part, in lifecycle order.
+    :param project: The project the parts belong to.
+    :param mode: How to split the paths into layers (see ``LAYER_MODES``).
+    :returns: The names of the parts and the paths they primed for each layer,
+        from the bottom one up. A path primed by several parts is only in the
+        lowest layer.
+    """
+    if mode == "parts":
+        groups = [[name] for name in primed_paths]
+    else:
+        # Parts come after their dependencies, so their levels are known.
+        levels: dict[str, int] = {}
+        for name in primed_paths:
+            after = (project.parts or {}).get(name, {}).get("after", [])
+            levels[name] = 1 + max((levels[dep] for dep in after), default=-1)
+        groups = [
+            [name for name in primed_paths if levels[name] == level]
+            for level in sorted(set(levels.values()))
+        ]
+
+    part_layers: list[tuple[list[str], set[str]]] = []
+    claimed: set[str] = set()
+    for names in groups:
+        paths = set[str]().union(*(primed_paths[name] for name in names)) - claimed
+        claimed.update(paths)
+        part_layers.append((names, paths))
+    return part_layers
+
+
+def _split_prime_dir(
+    prime_dir: pathlib.Path, part_layers: list[tuple[list[str], set[str]]]
+) -> list[tuple[str, set[str]]]:
+    """Get the paths of each layer that are still in the prime directory.
+
+    Layers left empty, because the files of their parts were all pruned, are
+    skipped. The paths that no part primed, like the contents of overlays,
+    are added in a last layer.
+
+    :returns: A description and the paths of each layer, from the bottom one up.
+    """
+    remaining: set[str] = set()
+    for dirpath, dirnames, filenames in os.walk(prime_dir):
+        relative_dir = pathlib.Path(dirpath).relative_to(prime_dir)
+        remaining.update((relative_dir / name).as_posix() for name in dirnames)
+        remaining.update((relative_dir / name).as_posix() for name in filenames)
+
+    layers: list[tuple[str, set[str]]] = []
+    for names, primed in part_layers:
+        paths = primed & remaining
+        if not paths:
+            continue
+        # The parents of the paths are in the layer too.
+        for path in paths:
+            remaining.difference_update(
+                parent.as_posix() for parent in pathlib.PurePosixPath(path).parents
+            )
+        remaining -= paths
+        description = "part" if len(names) == 1 else "parts"
+        layers.append((f"{description} {', '.join(names)}", paths))
+    # An opaque marker hides the contents of its directory in the lower layers,
+    # including the ones of the parts: it goes in the lowest part layer with
+    # paths in that directory instead, to only hide the contents of the base.
+    markers = sorted(
+        path for path in remaining if posixpath.basename(path) == _OPAQUE_MARKER
+    )
+    for marker in markers:
+        directory = pathlib.PurePosixPath(marker).parent
+        for _, paths in layers:
+            if any(directory in pathlib.PurePosixPath(path).parents for path in paths):
+                paths.add(marker)
+                remaining.discard(marker)
+                break
+
+    if remaining:
+        layers.append(("the other primed files", remaining))
+    return layers
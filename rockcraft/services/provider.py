@@ -18,11 +18,28 @@
 
 from __future__ import annotations
 
+import contextlib
 import os
+import subprocess
+from pathlib import Path, PurePosixPath
+from typing import TYPE_CHECKING, Any
 
 from craft_application import ProviderService
+from craft_cli import emit
+from craft_providers import errors as provider_errors
 from overrides import override  # type: ignore[reportUnknownVariableType]
 
+from rockcraft import image_cache
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    import craft_platforms
+    import craft_providers
+
+# Where the host's base image cache is mounted in managed instances.
+_INSTANCE_BASE_IMAGE_CACHE_DIR = PurePosixPath("/root/.cache/rockcraft/base-images")
+
 
 class RockcraftProviderService(ProviderService):
     """ProviderService specialization to configure the APT packages."""
@@ -38,6 +55,58 @@ class RockcraftProviderService(ProviderService):
             "https_proxy",
             "no_proxy",
             "ROCKCRAFT_ENABLE_EXPERIMENTAL_EXTENSIONS",
+            "SOURCE_DATE_EPOCH",
         ]:
             if env_key in os.environ:
                 self.environment[env_key] = os.environ[env_key]
+
+        # The host's base image cache is mounted at a fixed place in the instance.
+        # The environment is set when the instance is launched, before the
+        # mount: if mounting fails, the instance caches base images in its own
+        # filesystem at that place instead, like before the cache was shared.
+        self.environment["ROCKCRAFT_BASE_IMAGE_CACHE_DIR"] = str(
+            _INSTANCE_BASE_IMAGE_CACHE_DIR
+        )
+
+    @contextlib.contextmanager
+    @override
+    def instance(
+        self,
+        build_info: craft_platforms.BuildInfo,
+        *,
+        work_dir: Path,
+        **kwargs: Any,
+    ) -> Iterator[craft_providers.Executor]:
+        """Get a provider instance, sharing the host's base image cache with it.
+
+        Sharing the cache is best effort: if the cache cannot be mounted, the
+        build goes on with a cache private to the instance, and a message says
+        so.
+        """
+        with super().instance(build_info, work_dir=work_dir, **kwargs) as instance:
+            host_cache_dir = image_cache.get_cache_dir(
+                self._app.name,
+                self._services.get("config").get("base_image_cache_dir"),
+            )
+            try:
+                host_cache_dir.mkdir(parents=True, exist_ok=True)
+                instance.execute_run(
+                    ["mkdir", "-p", str(_INSTANCE_BASE_IMAGE_CACHE_DIR)], check=True
+                )
+                instance.mount(
+                    host_source=host_cache_dir,
+                    target=Path(_INSTANCE_BASE_IMAGE_CACHE_DIR),
+                )
+            except (
+                OSError,
+                subprocess.CalledProcessError,
+                provider_errors.ProviderError,
+            ) as err:
+                emit.debug(f"Cannot mount the base image cache: {err}")
+                emit.progress(
+                    "Not sharing the base image cache with the instance; "
+                    "base images are cached in the instance instead",
+                    permanent=True,
+                )
+
+            yield instance
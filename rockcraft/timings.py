@@ -0,0 +1,274 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A timeline of the phases of a build, with their durations and resource usage."""
+
+import contextlib
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Any, NamedTuple, ParamSpec, TypeVar
+
+from craft_cli import emit
+
+_P = ParamSpec("_P")
+_R = TypeVar("_R")
+
+# The file with the I/O counters of the process, on Linux.
+_PROC_IO_PATH = Path("/proc/self/io")
+
+
+class _Usage(NamedTuple):
+    """A snapshot of the resource usage of the process.
+
+    :param wall: The monotonic clock, in nanoseconds.
+    :param cpu: The CPU time of the process and its waited-for children, in seconds.
+    :param read_bytes: The bytes read by the process, or -1 if unknown.
+    :param written_bytes: The bytes written by the process, or -1 if unknown.
+    """
+
+    wall: int
+    cpu: float
+    read_bytes: int
+    written_bytes: int
+
+    @classmethod
+    def now(cls) -> "_Usage":
+        times = os.times()
+        read_bytes, written_bytes = _read_io_counters()
+        return cls(
+            wall=time.perf_counter_ns(),
+            cpu=times.user + times.system + times.children_user + times.children_system,
+            read_bytes=read_bytes,
+            written_bytes=written_bytes,
+        )
+
+
+class Span:
+    """A phase of the build, on the timeline.
+
+    :param name: What the phase is, like "add_layer" or "build my-part".
+    :param category: The kind of phase, like "oci" or "lifecycle".
+    :param args: Details about the phase, like the part or the image.
+    """
+
+    def __init__(
+        self, timeline: "Timeline", name: str, category: str, args: dict[str, Any]
+    ) -> None:
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.get_ident()
+        self._timeline = timeline
+        self._start = _Usage.now()
+
+    def finish(self) -> None:
+        """End the phase, and add it to the timeline."""
+        end = _Usage.now()
+        io_known = self._start.read_bytes >= 0 and end.read_bytes >= 0
+        self._timeline.add(
+            {
+                "name": self.name,
+                "category": self.category,
+                "thread": self.thread,
+                "start": (self._start.wall - self._timeline.origin) / 1000,
+                "duration": (end.wall - self._start.wall) / 1000,
+                "cpu_time": round(end.cpu - self._start.cpu, 6),
+                "max_rss": _max_rss(),
+                "read_bytes": end.read_bytes - self._start.read_bytes
+                if io_known
+                else None,
+                "written_bytes": end.written_bytes - self._start.written_bytes
+                if io_known
+                else None,
+                "args": self.args,
+            }
+        )
+
+
+class Timeline:
+    """The phases of a build, recorded as nested spans.
+
+    Spans can be recorded from any thread. Times are in microseconds since
+    the timeline was created, ``max_rss`` is the peak resident set size of
+    the process or of its largest child, in bytes, when the span ended, and
+    the I/O counters include the bytes read from and written to the page
+    cache, but not the ones of child processes.
+    """
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter_ns()
+        self._spans: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def spans(self) -> list[dict[str, Any]]:
+        """The spans that ended, in the order they ended."""
+        with self._lock:
+            return list(self._spans)
+
+    def add(self, span: dict[str, Any]) -> None:
+        """Add a span that ended."""
+        with self._lock:
+            self._spans.append(span)
+
+    def save(self, path: Path) -> None:
+        """Write the timeline in the Chrome trace event format.
+
+        The file can be loaded in trace viewers like Perfetto. Besides the
+        trace events, it has a summary with the total duration and CPU time
+        of the spans with each name, to compare builds.
+
+        :param path: The path of the file.
+        """
+        spans = self.spans
+        events: list[dict[str, Any]] = [
+            {
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": span["start"],
+                "dur": span["duration"],
+                "pid": os.getpid(),
+                "tid": span["thread"],
+                "args": {
+                    **span["args"],
+                    "cpu_time": span["cpu_time"],
+                    "max_rss": span["max_rss"],
+                    "read_bytes": span["read_bytes"],
+                    "written_bytes": span["written_bytes"],
+                },
+            }
+            for span in sorted(spans, key=lambda span: span["start"])
+        ]
+        summary: dict[str, dict[str, Any]] = {}
+        for span in spans:
+            totals = summary.setdefault(
+                span["name"], {"count": 0, "duration": 0.0, "cpu_time": 0.0}
+            )
+            totals["count"] += 1
+            totals["duration"] += span["duration"]
+            totals["cpu_time"] = round(totals["cpu_time"] + span["cpu_time"], 6)
+
+        data = {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "summary": summary,
+        }
+        path.write_text(json.dumps(data, indent=1))
+
+
+_timeline: Timeline | None = None
+
+
+def get_timeline() -> Timeline | None:
+    """Get the timeline being recorded, if any."""
+    return _timeline
+
+
+@contextlib.contextmanager
+def record(path: Path | None, name: str) -> Iterator[None]:
+    """Record a timeline of everything in the context, if ``path`` is set.
+
+    :param path: Where to write the timeline once the context exits, even
+        if it fails. Nothing is recorded if it is None.
+    :param name: The name of the span of the whole context.
+    """
+    global _timeline  # noqa: PLW0603 (global statement)
+
+    if path is None:
+        yield
+        return
+
+    _timeline = Timeline()
+    try:
+        with span(name, "rockcraft"):
+            yield
+    finally:
+        timeline, _timeline = _timeline, None
+        timeline.save(path)
+        emit.debug(f"Wrote the build timeline to {str(path)!r}")
+
+
+def start_span(name: str, category: str, **args: Any) -> Span | None:
+    """Start a span that is ended explicitly, with ``Span.finish()``.
+
+    :returns: The span, or None if no timeline is being recorded.
+    """
+    timeline = _timeline
+    if timeline is None:
+        return None
+    return Span(timeline, name, category, args)
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[None]:
+    """Record the context as a span, if a timeline is being recorded.
+
+    :param name: What the phase is.
+    :param category: The kind of phase.
+    :param args: Details about the phase.
+    """
+    current = start_span(name, category, **args)
+    try:
+        yield
+    finally:
+        if current:
+            current.finish()
+
+
+def timed(category: str) -> Callable[[Callable[_P, _R]], Callable[_P, _R]]:
+    """Decorate a function to record each call as a span named after it.
+
+    :param category: The kind of phase.
+    """
+
+    def decorator(func: Callable[_P, _R]) -> Callable[_P, _R]:
+        @functools.wraps(func)
+        def wrapper(*args: _P.args, **kwargs: _P.kwargs) -> _R:
+            if _timeline is None:
+                return func(*args, **kwargs)
+            with span(func.__qualname__, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _max_rss() -> int:
+    """Get the peak resident set size of the process or its largest child, in bytes."""
+    # ru_maxrss is in kilobytes on Linux.
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def _read_io_counters() -> tuple[int, int]:
+    """Get the bytes read and written by the process, or -1 if unknown."""
+    try:
+        counters = dict(
+            line.split(": ", 1) for line in _PROC_IO_PATH.read_text().splitlines()
+        )
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, ValueError, KeyError):
+        return -1, -1
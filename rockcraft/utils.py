@@ -16,17 +16,32 @@
 
 """Utilities for rockcraft."""
 
+import errno
+import fcntl
 import logging
 import os
 import pathlib
 import shlex
 import shutil
+import stat
+from collections.abc import Callable
 from typing import NamedTuple
 
 import rockcraft.errors
 
 logger = logging.getLogger(__name__)
 
+# ioctl request to clone a file's extents (a "reflink"), from linux/fs.h.
+_FICLONE = 0x40049409
+
+# Errors from copy_file_range() or sendfile() for which another way to copy
+# may still work, for example across filesystems on older kernels.
+_KERNEL_COPY_FALLBACK_ERRNOS = frozenset(
+    {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+)
+
+_COPY_CHUNK_SIZE = 1024 * 1024
+
 
 class OSPlatform(NamedTuple):
     """Tuple containing the OS platform information."""
@@ -156,3 +171,152 @@ def parse_command(command: str) -> tuple[list[str], list[str]]:
             cmd.append(arg)
 
     return (cmd, args)
+
+
+def link_or_copy(source: pathlib.Path, destination: pathlib.Path) -> None:
+    """Make ``destination`` a copy of the file ``source``, as cheaply as possible.
+
+    The file is cloned if the filesystem supports reflinks (copy-on-write
+    copies, as in btrfs or XFS), or else hard-linked; it is only copied when
+    neither is possible, for example across filesystems.
+
+    :param source: The file to copy.
+    :param destination: The new file, which must not exist.
+    """
+    with source.open("rb") as src, destination.open("xb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            cloned = False
+        else:
+            cloned = True
+
+    if cloned:
+        shutil.copymode(source, destination)
+        return
+
+    destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError as err:
+        logger.debug("Cannot link %s to %s (%s), copying it", source, destination, err)
+        shutil.copy2(source, destination)
+
+
+def link_tree(source: pathlib.Path, destination: pathlib.Path) -> None:
+    """Make ``destination`` a copy of the directory tree ``source``, cheaply.
+
+    Regular files are copied with ``link_or_copy()``; directories and symlinks
+    are recreated. The ownership, permissions, modification times and extended
+    attributes of the entries that are not hard-linked are copied as well, so
+    the destination must only be read, never modified in place.
+
+    :param source: The directory to copy.
+    :param destination: The new directory, which must not exist.
+    :raises OSError: If the tree cannot be copied faithfully, for example if
+        it contains device nodes or files owned by other users.
+    """
+    destination.mkdir()
+    directories = [(source, destination)]
+
+    for dirpath, dirnames, filenames in os.walk(source):
+        src_dir = pathlib.Path(dirpath)
+        dst_dir = destination / src_dir.relative_to(source)
+        for name in [*dirnames, *filenames]:
+            src = src_dir / name
+            dst = dst_dir / name
+            src_stat = src.lstat()
+            if stat.S_ISLNK(src_stat.st_mode):
+                dst.symlink_to(src.readlink())
+            elif stat.S_ISDIR(src_stat.st_mode):
+                dst.mkdir()
+                directories.append((src, dst))
+                continue
+            elif stat.S_ISREG(src_stat.st_mode):
+                link_or_copy(src, dst)
+            else:
+                raise OSError(f"Cannot copy special file {str(src)!r}")
+            if dst.lstat().st_ino != src_stat.st_ino:
+                _copy_metadata(src, dst, src_stat)
+
+    # Directories last, since creating their entries changes their mtimes.
+    for src, dst in reversed(directories):
+        _copy_metadata(src, dst, src.lstat())
+
+
+def _copy_metadata(
+    source: pathlib.Path, destination: pathlib.Path, source_stat: os.stat_result
+) -> None:
+    """Copy the ownership, mode, times and xattrs of ``source``."""
+    dst_stat = destination.lstat()
+    if (dst_stat.st_uid, dst_stat.st_gid) != (source_stat.st_uid, source_stat.st_gid):
+        os.chown(
+            destination, source_stat.st_uid, source_stat.st_gid, follow_symlinks=False
+        )
+    is_link = stat.S_ISLNK(source_stat.st_mode)
+    for name in os.listxattr(source, follow_symlinks=False):
+        value = os.getxattr(source, name, follow_symlinks=False)
+        os.setxattr(destination, name, value, follow_symlinks=False)
+    if not is_link:
+        # After chown(), which may clear the setuid and setgid bits.
+        destination.chmod(stat.S_IMODE(source_stat.st_mode))
+    os.utime(
+        destination,
+        ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns),
+        follow_symlinks=False,
+    )
+
+
+def copy_file_data(in_fd: int, out_fd: int, size: int) -> None:
+    """Copy ``size`` bytes between the current offsets of two files.
+
+    The data is copied within the kernel if possible: ``copy_file_range()``
+    may even share the extents of the files, and ``sendfile()`` works across
+    filesystems on older kernels. Otherwise it is copied in chunks.
+
+    :raises RockcraftError: If the input ends before ``size`` bytes.
+    """
+    remaining = size
+    for copy in (_kernel_copy_file_range, _kernel_sendfile):
+        remaining = _kernel_copy(copy, in_fd, out_fd, remaining)
+        if not remaining:
+            return
+
+    while remaining:
+        data = os.read(in_fd, min(remaining, _COPY_CHUNK_SIZE))
+        if not data:
+            raise rockcraft.errors.RockcraftError("File shrank while being copied")
+        view = memoryview(data)
+        while view:
+            view = view[os.write(out_fd, view) :]
+        remaining -= len(data)
+
+
+def _kernel_copy(
+    copy: Callable[[int, int, int], int], in_fd: int, out_fd: int, count: int
+) -> int:
+    """Copy data with ``copy`` until done, or until it is not supported.
+
+    :returns: The number of bytes left to copy.
+    """
+    try:
+        while count:
+            copied = copy(in_fd, out_fd, count)
+            if not copied:
+                raise rockcraft.errors.RockcraftError("File shrank while being copied")
+            count -= copied
+    except OSError as err:
+        if err.errno not in _KERNEL_COPY_FALLBACK_ERRNOS:
+            raise
+        logger.debug("Kernel copy not available (%s), trying another way", err)
+    return count
+
+
+def _kernel_copy_file_range(in_fd: int, out_fd: int, count: int) -> int:
+    if not hasattr(os, "copy_file_range"):  # pragma: no cover (not Linux)
+        raise OSError(errno.ENOSYS, "copy_file_range() is not available")
+    return os.copy_file_range(in_fd, out_fd, count)
+
+
+def _kernel_sendfile(in_fd: int, out_fd: int, count: int) -> int:
+    return os.sendfile(out_fd, in_fd, None, count)
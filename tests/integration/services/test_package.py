@@ -31,6 +31,7 @@ def test_media_type_in_packed_image_manifest(fake_services: ServiceFactory):
         rock_suffix="risky",
         build_for=project.platforms["risky"].build_for[0],
         base_layer_dir=Path("base_layer"),
+        options=package.PackOptions(),
     )
 
     manifest = subprocess.check_output(
@@ -40,3 +41,37 @@ def test_media_type_in_packed_image_manifest(fake_services: ServiceFactory):
     manifest_content = json.loads(manifest)
 
     assert manifest_content["mediaType"] == "application/vnd.oci.image.manifest.v1+json"
+
+
+def test_part_layers_opaque_marker(tmp_path):
+    base_image = oci.Image.new_oci_image(
+        image_name="bare@original",
+        image_dir=tmp_path / "images",
+        arch=DebianArchitecture.from_host(),
+    )[0]
+    base_dir = tmp_path / "base"
+    (base_dir / "etc").mkdir(parents=True)
+    (base_dir / "etc/base.conf").write_text("base")
+    base_image = base_image.add_layer("base", base_dir)
+    # An overlay made "etc" opaque, and a part primed a file in it
+    prime_dir = tmp_path / "prime"
+    (prime_dir / "etc").mkdir(parents=True)
+    (prime_dir / "etc/.wh..wh..opq").write_text("")
+    (prime_dir / "etc/app.conf").write_text("app")
+    (prime_dir / "etc/overlay.conf").write_text("overlay")
+
+    # pylint: disable=protected-access
+    image = package._add_payload_layers(
+        base_image,
+        prime_dir=prime_dir,
+        base_layer_dir=base_dir,
+        tag="rock",
+        options=package.PackOptions(layers="parts"),
+        part_layers=[(["app"], {"etc", "etc/app.conf"})],
+    )
+
+    rootfs = image.extract_to(tmp_path / "bundles", rootless=True)
+    assert sorted(path.name for path in (rootfs / "etc").iterdir()) == [
+        "app.conf",
+        "overlay.conf",
+    ]
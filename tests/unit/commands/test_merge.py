@@ -0,0 +1,48 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+from pathlib import Path
+
+import pytest
+from rockcraft import oci
+from rockcraft.commands import MergeCommand
+
+
+@pytest.fixture
+def parser(fake_app_config):
+    parser = argparse.ArgumentParser()
+    MergeCommand(fake_app_config).fill_parser(parser)
+    return parser
+
+
+def test_merge(parser, fake_app_config, emitter, mocker):
+    mock_merge = mocker.patch.object(oci, "merge_oci_archives")
+    parsed_args = parser.parse_args(
+        ["a_amd64.rock", "a_arm64.rock", "--output", "a.rock", "--tag", "1.0"]
+    )
+
+    MergeCommand(fake_app_config).run(parsed_args)
+
+    mock_merge.assert_called_once_with(
+        [Path("a_amd64.rock"), Path("a_arm64.rock")], Path("a.rock"), tag="1.0"
+    )
+    emitter.assert_message("Merged rocks into 'a.rock'")
+
+
+@pytest.mark.parametrize("args", [["a.rock"], ["--output", "a.rock"]])
+def test_merge_missing_args(parser, args):
+    with pytest.raises(SystemExit):
+        parser.parse_args(args)
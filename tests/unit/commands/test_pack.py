@@ -0,0 +1,165 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+from pathlib import Path
+
+import pytest
+from rockcraft import errors
+from rockcraft.commands import PackCommand
+from rockcraft.commands.lifecycle import get_pack_options
+from rockcraft.compression import LayerCompression
+
+
+@pytest.fixture
+def parser(fake_app_config):
+    parser = argparse.ArgumentParser()
+    PackCommand(fake_app_config).fill_parser(parser)
+    return parser
+
+
+def test_compression_threads(parser):
+    parsed_args = parser.parse_args(["--compression-threads", "3"])
+
+    options = get_pack_options(parsed_args)
+
+    assert options.compression == LayerCompression(threads=3)
+
+
+def test_compression_threads_default(parser, mocker):
+    mock_default_threads = mocker.patch("rockcraft.compression.default_threads")
+    parsed_args = parser.parse_args([])
+
+    options = get_pack_options(parsed_args)
+
+    # The default is only resolved when compressing layers
+    assert options.compression.threads is None
+    assert not mock_default_threads.called
+
+
+@pytest.mark.parametrize("value", ["0", "-1", "many"])
+def test_compression_threads_invalid(parser, value):
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--compression-threads", value])
+
+
+def test_compression_zstd(parser):
+    parsed_args = parser.parse_args(
+        ["--compression", "zstd", "--compression-level", "19"]
+    )
+
+    options = get_pack_options(parsed_args)
+
+    assert options.compression.algorithm == "zstd"
+    assert options.compression.level == 19
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [(None, None), ("", None), ("0", 0), ("1700000000", 1700000000)],
+)
+def test_source_date_epoch(parser, monkeypatch, value, expected):
+    if value is None:
+        monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    else:
+        monkeypatch.setenv("SOURCE_DATE_EPOCH", value)
+
+    options = get_pack_options(parser.parse_args([]))
+
+    assert options.source_date_epoch == expected
+
+
+@pytest.mark.parametrize("value", ["-1", "1.5", "yesterday"])
+def test_source_date_epoch_invalid(parser, monkeypatch, value):
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", value)
+
+    with pytest.raises(errors.RockcraftError, match="Invalid SOURCE_DATE_EPOCH"):
+        get_pack_options(parser.parse_args([]))
+
+
+@pytest.mark.parametrize(
+    ("args", "expected"), [([], False), (["--refresh-base"], True)]
+)
+def test_refresh_base(parser, args, expected):
+    parsed_args = parser.parse_args(args)
+
+    assert parsed_args.refresh_base is expected
+
+
+@pytest.mark.parametrize(
+    ("args", "expected"), [([], False), (["--deduplicate-files"], True)]
+)
+def test_deduplicate_files(parser, args, expected):
+    options = get_pack_options(parser.parse_args(args))
+
+    assert options.deduplicate_files is expected
+
+
+@pytest.mark.parametrize(
+    ("args", "expected"),
+    [
+        ([], "single"),
+        (["--layers", "parts"], "parts"),
+        (["--layers", "groups"], "groups"),
+    ],
+)
+def test_layers(parser, args, expected):
+    options = get_pack_options(parser.parse_args(args))
+
+    assert options.layers == expected
+
+
+@pytest.mark.parametrize(
+    ("args", "expected"),
+    [([], None), (["--layer-cache-from", "old.rock"], Path("old.rock"))],
+)
+def test_layer_cache_from(parser, args, expected):
+    options = get_pack_options(parser.parse_args(args))
+
+    assert options.layer_cache_from == expected
+
+
+@pytest.mark.parametrize(
+    ("args", "expected"), [([], True), (["--separate-synthetic-layers"], False)]
+)
+def test_squash_synthetic_layers(parser, args, expected):
+    options = get_pack_options(parser.parse_args(args))
+
+    assert options.squash_synthetic_layers is expected
+
+
+@pytest.mark.parametrize(
+    ("args", "expected"),
+    [
+        ([], None),
+        (["--timings", "timings-{platform}.json"], Path("timings-{platform}.json")),
+    ],
+)
+def test_timings(parser, args, expected):
+    parsed_args = parser.parse_args(args)
+
+    assert parsed_args.timings == expected
+
+
+def test_layers_invalid(parser):
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--layers", "files"])
+
+
+@pytest.mark.parametrize(("args", "expected"), [([], False), (["--update-lock"], True)])
+def test_update_lock(parser, args, expected):
+    parsed_args = parser.parse_args(args)
+
+    assert parsed_args.update_lock is expected
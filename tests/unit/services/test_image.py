@@ -14,8 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 from typing import cast
 
+import pytest
+from rockcraft import timings
+from rockcraft.base_lock import LOCK_FILE_NAME, BaseLock
 from rockcraft.services import RockcraftImageService
 
 
@@ -33,3 +37,73 @@ def test_image_service_cache(default_image_info, mocker, fake_services):
     assert info2 is default_image_info
 
     mock_create.assert_called_once_with()
+
+
+def test_image_service_timings(default_image_info, mocker, fake_services, tmp_path):
+    image_service = cast(RockcraftImageService, fake_services.get("image"))
+    mocker.patch.object(
+        image_service, "_create_image_info", return_value=default_image_info
+    )
+
+    with timings.record(tmp_path / "timings.json", "test"):
+        image_service.obtain_image()
+        image_service.obtain_image()
+
+    data = json.loads((tmp_path / "timings.json").read_text())
+    assert [e["name"] for e in data["traceEvents"]] == ["test", "obtain base image"]
+
+
+def test_image_service_get_cache(fake_services, monkeypatch, tmp_path):
+    monkeypatch.setenv("ROCKCRAFT_BASE_IMAGE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("ROCKCRAFT_BASE_IMAGE_CACHE_MAX_SIZE", "1GiB")
+    monkeypatch.setenv("ROCKCRAFT_BASE_IMAGE_TAG_TTL", "60")
+    image_service = cast(RockcraftImageService, fake_services.get("image"))
+
+    cache = image_service.get_cache()
+
+    assert cache._path == tmp_path / "cache"
+    assert cache._max_size == 1024**3
+    assert cache._tag_ttl == 60
+
+
+@pytest.fixture
+def lock_image_service(fake_services, mocker, monkeypatch, tmp_path):
+    image_service = cast(RockcraftImageService, fake_services.get("image"))
+    monkeypatch.setattr(image_service, "_project_dir", tmp_path)
+    cache = mocker.Mock()
+    cache.get_image.return_value = (mocker.Mock(), "docker://ubuntu:24.04")
+    cache.get_source_digest.return_value = bytes.fromhex("ab" * 32)
+    mocker.patch.object(image_service, "get_cache", return_value=cache)
+    return image_service
+
+
+def test_fetch_base_no_lock_file(lock_image_service, tmp_path):
+    lock_image_service._fetch_base("ubuntu@24.04", "amd64", tmp_path / "images")
+
+    # Projects without a lock file do not get one unless they ask for it
+    assert not (tmp_path / LOCK_FILE_NAME).exists()
+
+
+def test_fetch_base_update_lock(lock_image_service, tmp_path):
+    lock_image_service.update_lock = True
+
+    lock_image_service._fetch_base("ubuntu@24.04", "amd64", tmp_path / "images")
+
+    lock = BaseLock.load(tmp_path)
+    assert lock.get("ubuntu@24.04", "amd64") == "sha256:" + "ab" * 32
+
+
+def test_fetch_base_existing_lock_file(lock_image_service, tmp_path):
+    lock = BaseLock.load(tmp_path)
+    lock.set("ubuntu@24.04", "arm64", "sha256:" + "cd" * 32)
+    lock.save()
+
+    lock_image_service._fetch_base("ubuntu@24.04", "amd64", tmp_path / "images")
+    mtime = (tmp_path / LOCK_FILE_NAME).stat().st_mtime_ns
+    lock_image_service._fetch_base("ubuntu@24.04", "amd64", tmp_path / "images")
+
+    # The new platform is pinned, and the file is left alone when unchanged
+    lock = BaseLock.load(tmp_path)
+    assert lock.get("ubuntu@24.04", "amd64") == "sha256:" + "ab" * 32
+    assert lock.get("ubuntu@24.04", "arm64") == "sha256:" + "cd" * 32
+    assert (tmp_path / LOCK_FILE_NAME).stat().st_mtime_ns == mtime
@@ -35,6 +35,7 @@ from craft_parts import (
     callbacks,
 )
 from craft_parts.state_manager.prime_state import PrimeState
+from rockcraft import timings
 from rockcraft.plugins.python_common import get_python_plugins
 from rockcraft.services import lifecycle as lifecycle_module
 
@@ -246,3 +247,91 @@ def test_usrmerged_by_default(
     assert mock_lifecycle.called
     call = mock_lifecycle.mock_calls[0]
     assert call.kwargs["usrmerged_by_default"] == expected_default
+
+
+@pytest.mark.usefixtures("configured_project", "project_keys")
+@pytest.mark.parametrize(
+    "project_keys",
+    [
+        {
+            "parts": {
+                "app": {"plugin": "nil", "after": ["deps"]},
+                "deps": {"plugin": "nil"},
+                "unprimed": {"plugin": "nil"},
+            }
+        }
+    ],
+)
+def test_get_primed_paths(default_image_info, fake_services, mocker, tmp_path):
+    mocker.patch.object(
+        fake_services.get("image"), "obtain_image", return_value=default_image_info
+    )
+    mocker.patch.object(LifecycleManager, "__init__", return_value=None)
+    lifecycle_service = fake_services.get("lifecycle")
+    project_info = ProjectInfo(
+        application_name="test",
+        cache_dir=tmp_path,
+        project_dirs=ProjectDirs(work_dir=tmp_path),
+    )
+    mocker.patch.object(
+        LifecycleManager,
+        "project_info",
+        new=mock.PropertyMock(return_value=project_info),
+    )
+    for name, files, directories in [
+        ("app", {"bin/app"}, {"bin"}),
+        ("deps", {"lib/dep.so", "bin/dep"}, {"bin", "lib"}),
+    ]:
+        PrimeState(part_properties={}, files=files, directories=directories).write(
+            tmp_path / "parts" / name / "state/prime"
+        )
+
+    primed = lifecycle_service.get_primed_paths()
+
+    # Dependencies come first
+    names = list(primed)
+    assert names.index("deps") < names.index("app")
+    assert primed["deps"] == {"lib/dep.so", "bin/dep", "bin", "lib"}
+    assert primed["app"] == {"bin/app", "bin"}
+    assert primed["unprimed"] == set()
+
+
+@pytest.mark.usefixtures("configured_project")
+def test_step_spans(default_image_info, fake_services, mocker, tmp_path):
+    mocker.patch.object(
+        fake_services.get("image"), "obtain_image", return_value=default_image_info
+    )
+    mocker.patch.object(LifecycleManager, "__init__", return_value=None)
+    mock_pre_step = mocker.patch.object(callbacks, "register_pre_step")
+    mock_post_step = mocker.patch.object(callbacks, "register_post_step")
+    step_info, _ = _create_step_info(tmp_path, "nil", "bare", "ubuntu@24.04")
+
+    with timings.record(tmp_path / "timings.json", "test"):
+        lifecycle_service = fake_services.get("lifecycle")
+        lifecycle_service._start_step_span(step_info)
+        lifecycle_service._finish_step_span(step_info)
+        timeline = timings.get_timeline()
+        assert timeline is not None
+        (span,) = timeline.spans
+
+    mock_pre_step.assert_called_once_with(lifecycle_service._start_step_span)
+    # After the post_prime() registration of the parent class
+    assert mock_post_step.mock_calls[-1] == mock.call(
+        lifecycle_service._finish_step_span
+    )
+    assert span["name"] == "prime p1"
+    assert span["category"] == "lifecycle"
+    assert span["args"] == {"part": "p1", "step": "prime"}
+
+
+@pytest.mark.usefixtures("configured_project")
+def test_step_spans_disabled(default_image_info, fake_services, mocker):
+    mocker.patch.object(
+        fake_services.get("image"), "obtain_image", return_value=default_image_info
+    )
+    mocker.patch.object(LifecycleManager, "__init__", return_value=None)
+    mock_pre_step = mocker.patch.object(callbacks, "register_pre_step")
+
+    fake_services.get("lifecycle")
+
+    mock_pre_step.assert_not_called()
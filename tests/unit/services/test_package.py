@@ -13,14 +13,19 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import json
 from pathlib import Path
 from typing import cast
 
 import pytest
 from craft_application import ServiceFactory
 from craft_platforms import DebianArchitecture
+from rockcraft import oci
+from rockcraft.compression import LayerCompression
 from rockcraft.models import Project
 from rockcraft.oci import Image
+from rockcraft.rootfs_index import RootfsIndex
 from rockcraft.services import RockcraftImageService, package
 
 
@@ -58,10 +63,12 @@ def test_pack(fake_services: ServiceFactory, default_image_info, mocker):
         base_digest=b"deadbeef",
         base_layer_dir=Path(),
         build_for="s390x",
+        options=package.PackOptions(),
         prime_dir=Path("prime"),
         project=fake_services.get("project").get(),
         project_base_image=default_image_info.base_image,
         rock_suffix="bob",
+        part_layers=None,
     )
 
 
@@ -175,10 +182,13 @@ def test_inner_pack(
 
     # Mock the resulting image and the functions called
     image = mocker.create_autospec(Image, instance=True)
+    image.with_compression.return_value = image
+    image.with_source_date_epoch.return_value = image
+    image.with_layer_cache.return_value = image
     image.add_layer.return_value = image
 
     # Mock generate metadata function
-    mocker.patch.object(
+    generate_metadata = mocker.patch.object(
         Project, "generate_metadata", return_value=(annotations, metadata)
     )
 
@@ -187,6 +197,12 @@ def test_inner_pack(
         base_digest=b"deadbeef",
         base_layer_dir=base_layer_dir,
         build_for="amd64",
+        options=package.PackOptions(
+            compression=LayerCompression(threads=3),
+            source_date_epoch=1000,
+            layer_cache_from=Path("previous.rock"),
+            squash_synthetic_layers=False,
+        ),
         prime_dir=prime_dir,
         project=project,
         project_base_image=image,
@@ -194,8 +210,14 @@ def test_inner_pack(
     )
 
     # Assertions
+    image.with_compression.assert_called_once_with(LayerCompression(threads=3))
+    image.with_source_date_epoch.assert_called_once_with(1000)
+    image.with_layer_cache.assert_called_once_with(Path("previous.rock"))
     image.add_layer.assert_called_once_with(
-        tag=tag, new_layer_dir=prime_dir, base_layer_dir=base_layer_dir
+        tag=tag,
+        new_layer_dir=prime_dir,
+        base_layer_dir=base_layer_dir,
+        deduplicate=False,
     )
 
     image.add_user.assert_called_once_with(
@@ -205,10 +227,6 @@ def test_inner_pack(
         username=project.run_user,
         uid=584792,
     )
-    image.set_default_user.assert_called_once_with(584792, project.run_user)
-    image.set_entrypoint.assert_called_once_with(expected_entrypoint)
-    image.set_cmd.assert_called_once_with(expected_cmd)
-    image.set_default_path.assert_called_once_with(project.base)
     image.set_pebble_layer.assert_called_once_with(
         services=project.marshal().get("services", {}),
         checks=project.marshal().get("checks", {}),
@@ -218,10 +236,281 @@ def test_inner_pack(
         description=project.description,
         base_layer_dir=base_layer_dir,
     )
-    image.set_environment.assert_called_once_with(project.environment)
-    image.set_annotations.assert_called_once_with(annotations)
+    generate_metadata.assert_called_once_with(
+        "1970-01-01T00:16:40+00:00", b"deadbeef", "amd64"
+    )
     image.set_control_data.assert_called_once_with(metadata)
-    image.set_media_type.assert_called_once_with()
+
+    # All config edits happen in a single transaction
+    image.config_transaction.assert_called_once_with()
+    config = image.config_transaction.return_value.__enter__.return_value
+    config.set_default_user.assert_called_once_with(584792, project.run_user)
+    config.set_entrypoint.assert_called_once_with(expected_entrypoint)
+    config.set_cmd.assert_called_once_with(expected_cmd)
+    config.set_default_path.assert_called_once_with(project.base)
+    config.set_environment.assert_called_once_with(project.environment)
+    config.set_annotations.assert_called_once_with(annotations)
+    config.set_media_type.assert_called_once_with()
+    image.config_transaction.return_value.__exit__.assert_called_once()
+
+    # The image-level config setters are not used
+    image.set_default_user.assert_not_called()
+    image.set_entrypoint.assert_not_called()
+    image.set_annotations.assert_not_called()
     image.to_oci_archive.assert_called_once_with(
         tag=project.version, filename=f"{project.name}_{project.version}_test-rock.rock"
     )
+
+
+@pytest.mark.usefixtures("fake_project_file", "project_keys")
+@pytest.mark.parametrize(
+    "project_keys",
+    [
+        {
+            "run_user": "_daemon_",
+            "services": {"test": {"override": "replace", "command": "/bin/true"}},
+        }
+    ],
+)
+def test_inner_pack_squash_synthetic_layers(fake_services: ServiceFactory, mocker):
+    fake_services.get("project").configure(platform=None, build_for=None)
+    project = cast(Project, fake_services.get("project").get())
+    tag = cast(str, project.version)
+    base_layer_dir = Path()
+    prime_dir = Path("prime")
+    metadata = {"metadata": "bar"}
+
+    image = mocker.create_autospec(Image, instance=True)
+    image.with_compression.return_value = image
+    image.with_source_date_epoch.return_value = image
+    image.with_layer_cache.return_value = image
+    image.add_layer.return_value = image
+    mocker.patch.object(Project, "generate_metadata", return_value=({}, metadata))
+
+    package._pack(
+        base_digest=b"deadbeef",
+        base_layer_dir=base_layer_dir,
+        build_for="amd64",
+        options=package.PackOptions(),
+        prime_dir=prime_dir,
+        project=project,
+        project_base_image=image,
+        rock_suffix="test-rock",
+    )
+
+    # The user, Pebble layer and control data are written in a single layer
+    layer_dir = image.write_control_data.call_args.args[0]
+    image.write_user_files.assert_called_once_with(
+        layer_dir,
+        prime_dir=prime_dir,
+        base_layer_dir=base_layer_dir,
+        username="_daemon_",
+        uid=584792,
+    )
+    image.write_pebble_layer.assert_called_once_with(
+        layer_dir,
+        services=project.marshal()["services"],
+        checks={},
+        name=project.name,
+        summary=project.summary,
+        description=project.description,
+        base_layer_dir=base_layer_dir,
+    )
+    image.write_control_data.assert_called_once_with(layer_dir, metadata)
+    assert image.add_layer.mock_calls == [
+        mocker.call(
+            tag=tag,
+            new_layer_dir=prime_dir,
+            base_layer_dir=base_layer_dir,
+            deduplicate=False,
+        ),
+        mocker.call(tag, layer_dir),
+    ]
+    assert not layer_dir.exists()
+    image.add_user.assert_not_called()
+    image.set_pebble_layer.assert_not_called()
+    image.set_control_data.assert_not_called()
+
+
+@pytest.mark.usefixtures("fake_project_file", "project_keys")
+@pytest.mark.parametrize(
+    ("project_keys", "mode", "expected"),
+    [
+        (
+            {
+                "parts": {
+                    "deps": {"plugin": "nil"},
+                    "more-deps": {"plugin": "nil"},
+                    "app": {"plugin": "nil", "after": ["deps", "more-deps"]},
+                    "config": {"plugin": "nil", "after": ["app"]},
+                }
+            },
+            "parts",
+            [
+                (["deps"], {"lib", "lib/dep.so"}),
+                (["more-deps"], {"lib/more.so"}),
+                (["app"], {"bin", "bin/app"}),
+                (["config"], {"etc/app.conf"}),
+            ],
+        ),
+        (
+            {
+                "parts": {
+                    "deps": {"plugin": "nil"},
+                    "more-deps": {"plugin": "nil"},
+                    "app": {"plugin": "nil", "after": ["deps", "more-deps"]},
+                    "config": {"plugin": "nil", "after": ["app"]},
+                }
+            },
+            "groups",
+            [
+                (["deps", "more-deps"], {"lib", "lib/dep.so", "lib/more.so"}),
+                (["app"], {"bin", "bin/app"}),
+                (["config"], {"etc/app.conf"}),
+            ],
+        ),
+    ],
+)
+def test_get_part_layers(fake_services, mode, expected):
+    fake_services.get("project").configure(platform=None, build_for=None)
+    project = cast(Project, fake_services.get("project").get())
+    primed_paths = {
+        "deps": {"lib", "lib/dep.so"},
+        "more-deps": {"lib", "lib/more.so"},
+        "app": {"bin", "bin/app", "lib/dep.so"},
+        "config": {"etc/app.conf"},
+    }
+
+    part_layers = package._get_part_layers(primed_paths, project, mode)
+
+    # Paths primed by several parts are only in the lowest layer
+    assert part_layers == expected
+
+
+def test_split_prime_dir(tmp_path):
+    prime_dir = tmp_path / "prime"
+    for path in ("lib/dep.so", "bin/app", "etc/overlay.conf"):
+        (prime_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (prime_dir / path).write_text(path)
+    part_layers = [
+        (["deps"], {"lib", "lib/dep.so"}),
+        (["pruned"], {"lib/pruned.so"}),
+        (["app", "more-app"], {"bin/app"}),
+    ]
+
+    layers = package._split_prime_dir(prime_dir, part_layers)
+
+    assert layers == [
+        ("part deps", {"lib", "lib/dep.so"}),
+        ("parts app, more-app", {"bin/app"}),
+        ("the other primed files", {"etc", "etc/overlay.conf"}),
+    ]
+
+
+def test_split_prime_dir_opaque_marker(tmp_path):
+    prime_dir = tmp_path / "prime"
+    for path in ("etc/.wh..wh..opq", "etc/app.conf", "etc/overlay.conf", "srv/a"):
+        (prime_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (prime_dir / path).write_text(path)
+    (prime_dir / "srv/.wh..wh..opq").write_text("")
+    part_layers = [(["app"], {"etc", "etc/app.conf"})]
+
+    layers = package._split_prime_dir(prime_dir, part_layers)
+
+    # The marker would hide the files of the part, in the last layer
+    assert layers == [
+        ("part app", {"etc", "etc/app.conf", "etc/.wh..wh..opq"}),
+        (
+            "the other primed files",
+            {"etc/overlay.conf", "srv", "srv/a", "srv/.wh..wh..opq"},
+        ),
+    ]
+
+
+@pytest.fixture
+def empty_image(tmp_path) -> Image:
+    """An image, "a:b", with no layers, in a local OCI layout."""
+    blobs_dir = tmp_path / "a/blobs/sha256"
+    blobs_dir.mkdir(parents=True)
+
+    def _write(content: dict) -> dict:
+        data = json.dumps(content).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        (blobs_dir / digest).write_bytes(data)
+        return {"digest": f"sha256:{digest}", "size": len(data)}
+
+    config = {"architecture": "amd64", "os": "linux", "rootfs": {"diff_ids": []}}
+    manifest = {"schemaVersion": 2, "config": _write(config), "layers": []}
+    oci.set_manifest_descriptor(
+        tmp_path / "a:b", {"mediaType": oci.MANIFEST_MEDIA_TYPE, **_write(manifest)}
+    )
+    return Image("a:b", tmp_path)
+
+
+def test_add_payload_layers_opaque_marker(empty_image, tmp_path):
+    base_dir = tmp_path / "base"
+    (base_dir / "etc").mkdir(parents=True)
+    (base_dir / "etc/base.conf").write_text("base")
+    image = empty_image.add_layer("base", base_dir)
+    # An overlay made "etc" opaque, and a part primed a file in it
+    prime_dir = tmp_path / "prime"
+    (prime_dir / "etc").mkdir(parents=True)
+    (prime_dir / "etc/.wh..wh..opq").write_text("")
+    (prime_dir / "etc/app.conf").write_text("app")
+    (prime_dir / "etc/overlay.conf").write_text("overlay")
+
+    image = package._add_payload_layers(
+        image,
+        prime_dir=prime_dir,
+        base_layer_dir=base_dir,
+        tag="rock",
+        options=package.PackOptions(layers="parts"),
+        part_layers=[(["app"], {"etc", "etc/app.conf"})],
+    )
+
+    # Read the layers in order, applying their whiteouts like "umoci unpack"
+    rootfs = RootfsIndex.from_image(image)
+    assert rootfs.is_file("etc/app.conf")
+    assert rootfs.is_file("etc/overlay.conf")
+    assert not rootfs.is_file("etc/base.conf")
+    assert len(image.layer_blobs()) == 3
+
+
+@pytest.mark.usefixtures("fake_project_file")
+def test_inner_pack_part_layers(fake_services, mocker, tmp_path):
+    fake_services.get("project").configure(platform=None, build_for=None)
+    project = cast(Project, fake_services.get("project").get())
+    prime_dir = tmp_path / "prime"
+    (prime_dir / "lib").mkdir(parents=True)
+    (prime_dir / "lib/dep.so").write_text("dep")
+    (prime_dir / "app").write_text("app")
+
+    image = mocker.create_autospec(Image, instance=True)
+    image.with_compression.return_value = image
+    image.with_source_date_epoch.return_value = image
+    image.with_layer_cache.return_value = image
+    image.add_layer.return_value = image
+    mocker.patch.object(Project, "generate_metadata", return_value=({}, {}))
+
+    package._pack(
+        base_digest=b"deadbeef",
+        base_layer_dir=Path(),
+        build_for="amd64",
+        options=package.PackOptions(layers="parts", squash_synthetic_layers=False),
+        prime_dir=prime_dir,
+        project=project,
+        project_base_image=image,
+        rock_suffix="test-rock",
+        part_layers=[(["deps"], {"lib", "lib/dep.so"}), (["app"], {"app"})],
+    )
+
+    assert image.add_layer.mock_calls == [
+        mocker.call(
+            tag=project.version,
+            new_layer_dir=prime_dir,
+            base_layer_dir=Path(),
+            deduplicate=False,
+            paths=paths,
+        )
+        for paths in ({"lib", "lib/dep.so"}, {"app"})
+    ]
@@ -13,8 +13,69 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import contextlib
+from pathlib import Path
+
+from craft_application import ProviderService
+from craft_providers.errors import ProviderError
 
 
 def test_packages(fake_services):
     provider_service = fake_services.get("provider")
     assert provider_service.packages == ["gpg", "dirmngr"]
+
+
+def test_base_image_cache_environment(fake_services, monkeypatch):
+    monkeypatch.setenv("ROCKCRAFT_BASE_IMAGE_CACHE_DIR", "/host/cache")
+    provider_service = fake_services.get("provider")
+
+    # The instance uses its own mount of the host's cache, wherever it is.
+    assert provider_service.environment["ROCKCRAFT_BASE_IMAGE_CACHE_DIR"] == (
+        "/root/.cache/rockcraft/base-images"
+    )
+
+
+def test_base_image_cache_mount(fake_services, monkeypatch, mocker, tmp_path):
+    monkeypatch.setenv("ROCKCRAFT_BASE_IMAGE_CACHE_DIR", str(tmp_path / "cache"))
+    executor = mocker.MagicMock()
+
+    @contextlib.contextmanager
+    def fake_instance(*args, **kwargs):
+        yield executor
+
+    mocker.patch.object(ProviderService, "instance", fake_instance)
+    provider_service = fake_services.get("provider")
+
+    with provider_service.instance(mocker.Mock(), work_dir=tmp_path) as instance:
+        assert instance is executor
+
+    assert (tmp_path / "cache").is_dir()
+    executor.mount.assert_called_once_with(
+        host_source=tmp_path / "cache",
+        target=Path("/root/.cache/rockcraft/base-images"),
+    )
+
+
+def test_base_image_cache_mount_error(
+    fake_services, monkeypatch, mocker, tmp_path, emitter
+):
+    monkeypatch.setenv("ROCKCRAFT_BASE_IMAGE_CACHE_DIR", str(tmp_path / "cache"))
+    executor = mocker.MagicMock()
+    executor.mount.side_effect = ProviderError("no mounts")
+
+    @contextlib.contextmanager
+    def fake_instance(*args, **kwargs):
+        yield executor
+
+    mocker.patch.object(ProviderService, "instance", fake_instance)
+    provider_service = fake_services.get("provider")
+
+    # The build goes on with a cache in the instance, and says so
+    with provider_service.instance(mocker.Mock(), work_dir=tmp_path) as instance:
+        assert instance is executor
+
+    emitter.assert_progress(
+        "Not sharing the base image cache with the instance; "
+        "base images are cached in the instance instead",
+        permanent=True,
+    )
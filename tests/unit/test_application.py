@@ -13,10 +13,17 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import contextlib
+import os
+import subprocess
+from pathlib import PurePosixPath
 from textwrap import dedent
 
+import craft_providers
 import pytest
+from craft_application import Application
 from rockcraft import cli, plugins
+from rockcraft.errors import RockcraftError
 
 
 @pytest.mark.parametrize("build_base", ["ubuntu@20.04", "ubuntu@24.04", "ubuntu@25.10"])
@@ -71,3 +78,109 @@ def test_get_app_plugins_missing_project(tmp_path, monkeypatch, mocker):
     app._configure_early_services()
     _ = app._get_app_plugins()
     spied_get_plugins.assert_called_once_with(None)
+
+
+@pytest.fixture
+def managed_app(tmp_path, monkeypatch, mocker):
+    """A Rockcraft app whose managed instances are mocked, with a 3-platform plan."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("sys.argv", ["rockcraft", "pack"])
+    app = cli._create_app()
+    app._configure_early_services()
+
+    platforms = ["amd64", "arm64", "s390x"]
+    instances = {}
+
+    @contextlib.contextmanager
+    def fake_instance(build_info, *, work_dir, clean_existing, use_base_instance):
+        assert not clean_existing
+        assert use_base_instance
+        instance = mocker.MagicMock()
+        process = instance.execute_popen.return_value.__enter__.return_value
+        process.stdout = [f"Packed {build_info.platform}\n"]
+        process.returncode = {"arm64": 1, "s390x": 2}.get(build_info.platform, 0)
+        instances[build_info.platform] = instance
+        yield instance
+
+    services = {
+        "build_plan": mocker.Mock(),
+        "config": mocker.Mock(),
+        "fetch": mocker.Mock(),
+        "provider": mocker.Mock(instance=fake_instance),
+        "proxy": mocker.Mock(),
+    }
+    services["build_plan"].plan.return_value = [
+        mocker.Mock(platform=platform) for platform in platforms
+    ]
+    services["config"].get.return_value = None
+    services["fetch"].is_active.return_value = False
+    services["proxy"].configure_instance.return_value = {"http_proxy": "proxy"}
+    mocker.patch.object(app.services, "get", side_effect=services.__getitem__)
+    mocker.patch.object(os, "cpu_count", return_value=4)
+    return app, services, instances
+
+
+def test_run_managed_parallel(managed_app, emitter, mocker):
+    app, services, instances = managed_app
+    super_run_managed = mocker.patch.object(Application, "run_managed")
+
+    with pytest.raises(
+        craft_providers.ProviderError, match="for platforms: arm64, s390x"
+    ) as raised:
+        app.run_managed(None, None)
+
+    assert raised.value.details == (
+        "arm64: Failed to execute rockcraft in instance for platform 'arm64' "
+        "(exit code 1).\n"
+        "s390x: Failed to execute rockcraft in instance for platform 's390x' "
+        "(exit code 2)."
+    )
+
+    # Every platform is built, even after a failure
+    assert sorted(instances) == ["amd64", "arm64", "s390x"]
+    super_run_managed.assert_not_called()
+    for platform, instance in instances.items():
+        instance.execute_popen.assert_called_once_with(
+            ["rockcraft", "pack"],
+            cwd=PurePosixPath("/root/project"),
+            env={
+                "CRAFT_PLATFORM": platform,
+                "CRAFT_VERBOSITY_LEVEL": "QUIET",
+                "http_proxy": "proxy",
+            },
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+    emitter.assert_progress("Building 3 platforms, 3 at a time", permanent=True)
+    emitter.assert_message("[s390x] Packed s390x")
+
+
+@pytest.mark.parametrize("option", ["--shell", "--shell-after", "--debug"])
+def test_run_managed_parallel_interactive(managed_app, monkeypatch, option):
+    app, _, instances = managed_app
+    monkeypatch.setattr("sys.argv", ["rockcraft", "pack", option])
+
+    with pytest.raises(RockcraftError, match=f"Cannot use '{option}'"):
+        app.run_managed(None, None)
+
+    assert not instances
+
+
+@pytest.mark.parametrize(
+    ("max_builds", "fetch_active", "fetch_enabled"),
+    [(1, False, False), (None, True, False), (None, False, True)],
+)
+def test_run_managed_sequential(
+    managed_app, mocker, max_builds, fetch_active, fetch_enabled
+):
+    app, services, instances = managed_app
+    services["config"].get.return_value = max_builds
+    services["fetch"].is_active.return_value = fetch_active
+    app._enable_fetch_service = fetch_enabled
+    super_run_managed = mocker.patch.object(Application, "run_managed")
+
+    app.run_managed("amd64", None)
+
+    super_run_managed.assert_called_once_with("amd64", None)
+    assert not instances
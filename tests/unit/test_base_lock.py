@@ -0,0 +1,78 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import pytest
+import yaml
+from rockcraft import errors
+from rockcraft.base_lock import BaseLock
+
+DIGEST_1 = "sha256:" + "1" * 64
+DIGEST_2 = "sha256:" + "2" * 64
+
+
+def test_load_missing(tmp_path):
+    lock = BaseLock.load(tmp_path)
+
+    assert lock.path == tmp_path / "rockcraft.lock"
+    assert lock.get("ubuntu@24.04", "amd64") is None
+
+
+def test_save_and_load(tmp_path):
+    lock = BaseLock.load(tmp_path)
+    lock.set("ubuntu@24.04", "arm64", DIGEST_2)
+    lock.set("ubuntu@24.04", "amd64", DIGEST_1)
+    lock.save()
+
+    data = yaml.safe_load((tmp_path / "rockcraft.lock").read_text())
+    assert data == {"bases": {"ubuntu@24.04": {"amd64": DIGEST_1, "arm64": DIGEST_2}}}
+    assert list(data["bases"]["ubuntu@24.04"]) == ["amd64", "arm64"]
+
+    lock = BaseLock.load(tmp_path)
+    assert lock.get("ubuntu@24.04", "amd64") == DIGEST_1
+    assert lock.get("ubuntu@24.04", "arm64") == DIGEST_2
+    assert lock.get("ubuntu@22.04", "amd64") is None
+
+
+def test_save_unchanged(tmp_path):
+    lock = BaseLock.load(tmp_path)
+    lock.set("ubuntu@24.04", "amd64", DIGEST_1)
+    lock.save()
+    (tmp_path / "rockcraft.lock").unlink()
+
+    lock.set("ubuntu@24.04", "amd64", DIGEST_1)
+    lock.save()
+
+    assert not (tmp_path / "rockcraft.lock").exists()
+
+
+def test_set_bad_digest(tmp_path):
+    lock = BaseLock.load(tmp_path)
+
+    with pytest.raises(ValueError, match="Bad digest"):
+        lock.set("ubuntu@24.04", "amd64", "latest")
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "bases: {ubuntu@24.04: {amd64: latest}}",
+        "bases: [",
+    ],
+)
+def test_load_invalid(tmp_path, content):
+    (tmp_path / "rockcraft.lock").write_text(content)
+
+    with pytest.raises(errors.RockcraftError):
+        BaseLock.load(tmp_path)
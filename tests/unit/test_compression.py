@@ -0,0 +1,161 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import io
+import os
+
+import pytest
+from rockcraft import compression, errors
+from rockcraft.compression import LayerCompression
+
+
+def compress(data: bytes, *, threads: int, chunk_size: int = 65536) -> bytes:
+    output = io.BytesIO()
+    with LayerCompression(threads=threads).open(output) as writer:
+        for start in range(0, len(data), chunk_size):
+            writer.write(data[start : start + chunk_size])
+    return output.getvalue()
+
+
+@pytest.fixture
+def layer_data() -> bytes:
+    # Mix compressible and incompressible data over several blocks.
+    noise = os.urandom(compression.GZIP_BLOCK_SIZE)
+    text = b"rockcraft " * (compression.GZIP_BLOCK_SIZE // 4)
+    return noise + text + noise[:1000]
+
+
+@pytest.mark.parametrize("threads", [1, 2, 8])
+def test_parallel_gzip_round_trip(layer_data, threads):
+    compressed = compress(layer_data, threads=threads)
+
+    assert gzip.decompress(compressed) == layer_data
+
+
+def test_parallel_gzip_thread_independent(layer_data):
+    assert compress(layer_data, threads=1) == compress(layer_data, threads=4)
+
+
+def test_parallel_gzip_ratio(layer_data):
+    # Splitting the stream in blocks must not hurt the compression ratio much.
+    reference = gzip.compress(layer_data, compresslevel=6, mtime=0)
+
+    assert len(compress(layer_data, threads=4)) < len(reference) * 1.01
+
+
+def test_parallel_gzip_empty():
+    assert gzip.decompress(compress(b"", threads=4)) == b""
+
+
+def test_default_threads_on_open(mocker):
+    mock_default_threads = mocker.patch.object(
+        compression, "default_threads", return_value=3
+    )
+    layer_compression = LayerCompression()
+    assert not mock_default_threads.called
+
+    writer = layer_compression.open(io.BytesIO())
+    writer.close()
+
+    mock_default_threads.assert_called_once_with()
+    assert isinstance(writer, compression.ParallelGzipWriter)
+    assert writer._threads == 3
+
+
+def test_parallel_gzip_error_discards(mocker):
+    output = io.BytesIO()
+
+    def _fail() -> None:
+        with LayerCompression(threads=2).open(output) as writer:
+            writer.write(b"data")
+            raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        _fail()
+
+    # Only the header was written; the stream was never finished.
+    assert output.getvalue() == compression._GZIP_HEADER
+
+
+@pytest.mark.parametrize(
+    ("cpu_max", "expected"),
+    [
+        ("max 100000\n", 16),
+        ("200000 100000\n", 2),
+        ("150000 100000\n", 2),
+        ("50000 100000\n", 1),
+        ("garbage\n", 16),
+    ],
+)
+def test_default_threads_cgroup_v2(tmp_path, mocker, cpu_max, expected):
+    cpu_max_path = tmp_path / "cpu.max"
+    cpu_max_path.write_text(cpu_max)
+    mocker.patch.object(compression, "_CGROUP_V2_CPU_MAX", cpu_max_path)
+    mocker.patch("os.sched_getaffinity", return_value=set(range(16)))
+
+    assert compression.default_threads() == expected
+
+
+@pytest.mark.parametrize(
+    ("quota", "expected"),
+    [
+        ("-1", 4),
+        ("300000", 3),
+    ],
+)
+def test_default_threads_cgroup_v1(tmp_path, mocker, quota, expected):
+    quota_path = tmp_path / "cpu.cfs_quota_us"
+    quota_path.write_text(quota)
+    period_path = tmp_path / "cpu.cfs_period_us"
+    period_path.write_text("100000")
+    mocker.patch.object(compression, "_CGROUP_V2_CPU_MAX", tmp_path / "missing")
+    mocker.patch.object(compression, "_CGROUP_V1_CPU_QUOTA", quota_path)
+    mocker.patch.object(compression, "_CGROUP_V1_CPU_PERIOD", period_path)
+    mocker.patch("os.sched_getaffinity", return_value=set(range(4)))
+
+    assert compression.default_threads() == expected
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_zstd_round_trip(layer_data, threads):
+    zstandard = pytest.importorskip("zstandard")
+    output = io.BytesIO()
+    layer_compression = LayerCompression(algorithm="zstd", level=5, threads=threads)
+
+    writer = layer_compression.open(output)
+    writer.write(layer_data)
+    writer.close()
+
+    decompressor = zstandard.ZstdDecompressor()
+    with decompressor.stream_reader(io.BytesIO(output.getvalue())) as reader:
+        assert reader.read() == layer_data
+    assert layer_compression.media_type == compression.ZSTD_LAYER_MEDIA_TYPE
+
+
+def test_zstd_missing(mocker):
+    mocker.patch.dict("sys.modules", {"zstandard": None})
+
+    with pytest.raises(errors.RockcraftError, match="requires the 'zstandard'"):
+        LayerCompression(algorithm="zstd").open(io.BytesIO())
+
+
+@pytest.mark.parametrize(
+    ("algorithm", "level"),
+    [("gzip", 0), ("gzip", 10), ("zstd", 23), ("lzma", None)],
+)
+def test_layer_compression_invalid(algorithm, level):
+    with pytest.raises(errors.RockcraftError):
+        LayerCompression(algorithm=algorithm, level=level)
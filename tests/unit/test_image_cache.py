@@ -0,0 +1,499 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import fcntl
+import hashlib
+import json
+from pathlib import Path
+
+import pytest
+from rockcraft import image_cache, oci
+from rockcraft.image_cache import BaseImageCache, RootfsCache
+from rockcraft.rootfs_index import RootfsEntry, RootfsIndex
+
+import tests
+
+
+class FakeRegistry:
+    """Stand-in for oci.Image.from_docker_registry(), serving generated images."""
+
+    def __init__(self) -> None:
+        self.fetches: list[tuple[str, str]] = []
+        self.queries: list[str] = []
+        self.pinned: list[str | None] = []
+        self.revision = 0
+        self.layer_size = 100
+        # The blobs already in the layout, and whether the cache was locked,
+        # when each image was fetched.
+        self.existing: list[set[str]] = []
+        self.locked: list[bool] = []
+        self.cache_dir: Path | None = None
+
+    def digest(self, source_image: str) -> bytes:
+        """Stand-in for oci.Image.digest(), for the (multi-arch) source image."""
+        self.queries.append(source_image)
+        return hashlib.sha256(f"{source_image} {self.revision}".encode()).digest()
+
+    def __call__(
+        self,
+        image_name: str,
+        *,
+        image_dir: Path,
+        arch: str,
+        digest: str | None = None,
+    ) -> tuple[oci.Image, str]:
+        self.fetches.append((image_name, arch))
+        self.pinned.append(digest)
+        name, tag = image_name.split("@")
+        blobs_dir = image_dir / name / "blobs" / "sha256"
+        blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.existing.append({blob.name for blob in blobs_dir.iterdir()})
+        if self.cache_dir:
+            self.locked.append(_is_locked(self.cache_dir))
+
+        def _write(data: bytes) -> dict:
+            digest = hashlib.sha256(data).hexdigest()
+            (blobs_dir / digest).write_bytes(data)
+            return {"digest": f"sha256:{digest}", "size": len(data)}
+
+        content = f"{image_name} {arch} {self.revision}".encode()
+        layer = _write(content.ljust(self.layer_size, b"-"))
+        config = _write(json.dumps({"architecture": arch}).encode())
+        manifest = _write(
+            json.dumps(
+                {
+                    "schemaVersion": 2,
+                    "config": config,
+                    "layers": [layer],
+                }
+            ).encode()
+        )
+        oci.set_manifest_descriptor(
+            image_dir / f"{name}:{tag}",
+            {"mediaType": oci.MANIFEST_MEDIA_TYPE, **manifest},
+        )
+        return oci.Image(f"{name}:{tag}", image_dir), f"docker://x/{name}:{tag}"
+
+
+def _is_locked(cache_dir: Path) -> bool:
+    with (cache_dir / "lock").open("a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return False
+
+
+@pytest.fixture
+def registry(mocker) -> FakeRegistry:
+    fake_registry = FakeRegistry()
+    mocker.patch.object(oci.Image, "from_docker_registry", side_effect=fake_registry)
+    mocker.patch.object(oci.Image, "digest", side_effect=fake_registry.digest)
+    return fake_registry
+
+
+@pytest.fixture
+def cache(tmp_path) -> BaseImageCache:
+    return BaseImageCache(tmp_path / "cache")
+
+
+def read_index(image: oci.Image) -> dict:
+    layout_dir = image.path / image.image_name.split(":")[0]
+    return json.loads((layout_dir / "index.json").read_bytes())
+
+
+@tests.linux_only
+def test_get_image(registry, cache, tmp_path):
+    image, source_image = cache.get_image(
+        "ubuntu@24.04", image_dir=tmp_path / "images", arch="amd64"
+    )
+
+    assert image == oci.Image("ubuntu:24.04", tmp_path / "images")
+    assert source_image == f"docker://{oci.REGISTRY_URL}/ubuntu:24.04"
+    assert registry.fetches == [("ubuntu@24.04", "amd64")]
+
+    # The image is complete in the local layout, and its blobs are shared
+    # with the cache (or, depending on the filesystem, cloned).
+    (descriptor,) = read_index(image)["manifests"]
+    assert descriptor["annotations"] == {"org.opencontainers.image.ref.name": "24.04"}
+    local_blobs = tmp_path / "images/ubuntu/blobs/sha256"
+    cached_blobs = tmp_path / "cache/blobs/sha256"
+    assert sorted(p.name for p in local_blobs.iterdir()) == sorted(
+        p.name for p in cached_blobs.iterdir()
+    )
+    assert len(list(local_blobs.iterdir())) == 3
+
+    # No temporary layouts are left behind
+    assert not list((tmp_path / "cache").glob(".fetch-*"))
+
+
+@tests.linux_only
+def test_get_image_fetch_unlocked(registry, cache, tmp_path):
+    registry.cache_dir = tmp_path / "cache"
+    cache.get_image("ubuntu@22.04", image_dir=tmp_path / "a", arch="amd64")
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+
+    # Other processes can use the cache while an image is downloaded
+    assert registry.locked == [False, False]
+    # The tag is resolved once, and that digest is fetched
+    source_image = f"docker://{oci.REGISTRY_URL}/ubuntu:24.04"
+    assert registry.queries[-1] == source_image
+    assert registry.pinned[-1] == f"sha256:{registry.digest(source_image).hex()}"
+    # The cached blobs of the repository are available to the fetch, to be reused
+    assert registry.existing[0] == set()
+    assert len(registry.existing[1]) == 3
+
+
+@tests.linux_only
+def test_get_image_fetch_related_blobs(registry, cache, tmp_path):
+    cache.get_image("ubuntu@22.04", image_dir=tmp_path / "a", arch="amd64")
+    cache.get_image("ubuntu@22.04", image_dir=tmp_path / "a", arch="arm64")
+    cache.get_image("debian@12", image_dir=tmp_path / "a", arch="amd64")
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+
+    # Only the blobs of the same repository and architecture are linked
+    assert registry.existing[2] == set()
+    state = json.loads((tmp_path / "cache/state.json").read_bytes())
+    ubuntu_digest = state["refs"]["ubuntu@22.04/amd64"]["digest"]
+    assert registry.existing[3] == set(state["images"][ubuntu_digest]["blobs"])
+
+
+@tests.linux_only
+def test_get_image_cached(registry, cache, tmp_path):
+    first, _ = cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    second, _ = cache.get_image("ubuntu@24.04", image_dir=tmp_path / "b", arch="amd64")
+
+    # The second project got the image without going to the registry
+    assert len(registry.fetches) == 1
+    assert read_index(first) == read_index(second)
+
+
+@tests.linux_only
+def test_get_image_per_arch(registry, cache, tmp_path):
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "b", arch="arm64")
+
+    assert registry.fetches == [("ubuntu@24.04", "amd64"), ("ubuntu@24.04", "arm64")]
+
+
+@tests.linux_only
+@pytest.mark.parametrize("refresh", [True, False])
+def test_get_image_stale(registry, tmp_path, mocker, refresh):
+    cache = BaseImageCache(tmp_path / "cache", tag_ttl=60)
+    mock_time = mocker.patch("time.time", return_value=1000.0)
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+
+    # The tag changes in the registry
+    registry.revision += 1
+
+    mock_time.return_value = 1030.0
+    image, _ = cache.get_image(
+        "ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64", refresh=refresh
+    )
+    assert len(registry.fetches) == (2 if refresh else 1)
+
+    mock_time.return_value = 1080.0
+    image, _ = cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    assert len(registry.fetches) == 2
+
+    # The local tag points to the new image
+    (descriptor,) = read_index(image)["manifests"]
+    state = json.loads((tmp_path / "cache/state.json").read_bytes())
+    assert descriptor["digest"] == state["refs"]["ubuntu@24.04/amd64"]["digest"]
+
+
+@tests.linux_only
+def test_get_image_missing_blobs(registry, cache, tmp_path):
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    for blob in (tmp_path / "cache/blobs/sha256").iterdir():
+        blob.unlink()
+
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "b", arch="amd64")
+
+    assert len(registry.fetches) == 2
+
+
+@tests.linux_only
+def test_get_image_eviction(registry, tmp_path, mocker):
+    registry.layer_size = 1000
+    # Room for two images, but not three
+    cache = BaseImageCache(tmp_path / "cache", max_size=3000)
+    mock_time = mocker.patch("time.time")
+    image_dir = tmp_path / "images"
+
+    for now, base in enumerate(["ubuntu@20.04", "ubuntu@22.04", "ubuntu@20.04"]):
+        mock_time.return_value = float(now)
+        cache.get_image(base, image_dir=image_dir, arch="amd64")
+    assert len(registry.fetches) == 2
+
+    # 22.04 is now the least recently used image
+    mock_time.return_value = 3.0
+    cache.get_image("ubuntu@24.04", image_dir=image_dir, arch="amd64")
+
+    state = json.loads((tmp_path / "cache/state.json").read_bytes())
+    assert sorted(state["refs"]) == ["ubuntu@20.04/amd64", "ubuntu@24.04/amd64"]
+    # Two layers and manifests, and the config they share
+    assert len(list((tmp_path / "cache/blobs/sha256").iterdir())) == 5
+
+    # Evicting from the cache does not affect the local images
+    assert len(list((image_dir / "ubuntu/blobs/sha256").iterdir())) == 7
+
+
+@tests.linux_only
+def test_get_image_hit_no_eviction(registry, cache, tmp_path, mocker):
+    for base in ["ubuntu@20.04", "ubuntu@22.04", "ubuntu@24.04"]:
+        cache.get_image(base, image_dir=tmp_path / "a", arch="amd64")
+    state = json.loads((tmp_path / "cache/state.json").read_bytes())
+    blobs = (tmp_path / "cache/blobs/sha256").iterdir()
+    assert state["size"] == sum(blob.stat().st_size for blob in blobs)
+    spy_evict = mocker.spy(cache, "_evict")
+    spy_manifest_blobs = mocker.spy(image_cache, "_manifest_blobs")
+
+    # A hit in a cache under its size limit only reads the manifest it uses
+    cache.get_image("ubuntu@22.04", image_dir=tmp_path / "b", arch="amd64")
+    assert not spy_evict.called
+    assert spy_manifest_blobs.call_count == 2  # Checked, then exported
+
+
+@tests.linux_only
+def test_get_image_hit_over_limit(registry, cache, tmp_path):
+    for base in ["ubuntu@22.04", "ubuntu@24.04"]:
+        cache.get_image(base, image_dir=tmp_path / "a", arch="amd64")
+
+    # The images were cached by an older version, which recorded no sizes
+    state_path = tmp_path / "cache/state.json"
+    state = json.loads(state_path.read_bytes())
+    del state["size"]
+    for entry in state["images"].values():
+        del entry["blobs"]
+    state_path.write_text(json.dumps(state))
+
+    # And the limit was lowered since then
+    small_cache = BaseImageCache(tmp_path / "cache", max_size=0)
+    small_cache.get_image("ubuntu@24.04", image_dir=tmp_path / "b", arch="amd64")
+
+    state = json.loads(state_path.read_bytes())
+    assert list(state["refs"]) == ["ubuntu@24.04/amd64"]
+    assert len(state["images"]) == 1
+    assert state["size"] == sum(next(iter(state["images"].values()))["blobs"].values())
+
+
+@tests.linux_only
+@pytest.mark.parametrize("content", ['{"refs": {', "[]", '{"refs": []}'])
+def test_get_image_bad_state(registry, cache, tmp_path, content):
+    cache.get_image("ubuntu@22.04", image_dir=tmp_path / "a", arch="amd64")
+    (tmp_path / "cache/state.json").write_text(content)
+
+    # The state is rebuilt, and the blobs it lost track of are evicted
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    state = json.loads((tmp_path / "cache/state.json").read_bytes())
+    assert list(state["refs"]) == ["ubuntu@24.04/amd64"]
+    assert len(list((tmp_path / "cache/blobs/sha256").iterdir())) == 3
+    # No temporary state files are left behind
+    assert sorted(p.name for p in (tmp_path / "cache").iterdir()) == [
+        "blobs",
+        "lock",
+        "state.json",
+    ]
+
+
+@tests.linux_only
+def test_get_source_digest(registry, cache, tmp_path):
+    source_image = f"docker://{oci.REGISTRY_URL}/ubuntu:24.04"
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "b", arch="amd64")
+    expected = registry.digest(source_image)
+    registry.queries.clear()
+
+    # The digest was memoized when the image was fetched
+    assert cache.get_source_digest("ubuntu@24.04", arch="amd64") == expected
+    assert registry.queries == []
+
+
+@tests.linux_only
+def test_get_source_digest_stale(registry, tmp_path, mocker):
+    cache = BaseImageCache(tmp_path / "cache", tag_ttl=60)
+    mocker.patch("time.time", return_value=1000.0)
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    registry.revision += 1
+
+    mocker.patch("time.time", return_value=2000.0)
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+
+    assert cache.get_source_digest("ubuntu@24.04", arch="amd64") == registry.digest(
+        f"docker://{oci.REGISTRY_URL}/ubuntu:24.04"
+    )
+
+
+@tests.linux_only
+def test_get_source_digest_not_cached(registry, cache):
+    digest = cache.get_source_digest("ubuntu@24.04", arch="amd64")
+
+    assert registry.queries == [f"docker://{oci.REGISTRY_URL}/ubuntu:24.04"]
+    assert digest == registry.digest(f"docker://{oci.REGISTRY_URL}/ubuntu:24.04")
+
+
+@tests.linux_only
+def test_get_image_pinned(registry, tmp_path, mocker):
+    cache = BaseImageCache(tmp_path / "cache", tag_ttl=60)
+    mocker.patch("time.time", return_value=1000.0)
+    pinned = "sha256:" + "ab" * 32
+
+    cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    image, _ = cache.get_image(
+        "ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64", digest=pinned
+    )
+    resolved = registry.digest(f"docker://{oci.REGISTRY_URL}/ubuntu:24.04").hex()
+    assert registry.pinned == [f"sha256:{resolved}", pinned]
+    # The local image keeps its tag
+    assert image == oci.Image("ubuntu:24.04", tmp_path / "a")
+
+    # Pinned images never go stale, even when refreshing, and need no queries
+    registry.queries.clear()
+    mocker.patch("time.time", return_value=5000.0)
+    cache.get_image(
+        "ubuntu@24.04",
+        image_dir=tmp_path / "b",
+        arch="amd64",
+        digest=pinned,
+        refresh=True,
+    )
+    assert len(registry.fetches) == 2
+    assert registry.queries == []
+
+    state = json.loads((tmp_path / "cache/state.json").read_bytes())
+    assert state["refs"][f"ubuntu@{pinned}/amd64"]["source_digest"] == "ab" * 32
+
+
+@tests.linux_only
+def test_get_image_bad_name(cache, tmp_path):
+    with pytest.raises(ValueError, match="Bad image name"):
+        cache.get_image("ubuntu", image_dir=tmp_path, arch="amd64")
+
+
+@pytest.fixture
+def base_image(registry, cache, tmp_path) -> oci.Image:
+    image, _ = cache.get_image("ubuntu@24.04", image_dir=tmp_path / "a", arch="amd64")
+    return image
+
+
+@pytest.fixture
+def mock_unpack(mocker):
+    def fake_unpack(command):
+        rootfs = Path(command[-1]) / "rootfs"
+        (rootfs / "etc").mkdir(parents=True)
+        (rootfs / "etc/os-release").write_text("ID=ubuntu")
+
+    return mocker.patch("rockcraft.oci._process_run", side_effect=fake_unpack)
+
+
+@tests.linux_only
+def test_rootfs_cache(base_image, mock_unpack, tmp_path):
+    rootfs_cache = RootfsCache(tmp_path / "rootfs")
+
+    rootfs = rootfs_cache.extract(base_image, tmp_path / "work1/bundles")
+    assert rootfs == tmp_path / "work1/bundles/ubuntu-24.04/rootfs"
+    assert mock_unpack.call_count == 1
+
+    # Another work dir gets a copy of the cached rootfs
+    rootfs = rootfs_cache.extract(base_image, tmp_path / "work2/bundles")
+    assert (rootfs / "etc/os-release").read_text() == "ID=ubuntu"
+    assert mock_unpack.call_count == 1
+
+    # And the same work dir reuses its bundle
+    rootfs_cache.extract(base_image, tmp_path / "work2/bundles")
+    assert mock_unpack.call_count == 1
+
+    # No temporary copies are left behind
+    assert not list((tmp_path / "rootfs").glob(".*.tmp"))
+    assert not list((tmp_path / "work2/bundles").glob(".*.tmp"))
+
+
+@tests.linux_only
+def test_rootfs_cache_copy_error(base_image, mock_unpack, tmp_path, mocker):
+    rootfs_cache = RootfsCache(tmp_path / "rootfs")
+    rootfs_cache.extract(base_image, tmp_path / "work1/bundles")
+    mocker.patch("rockcraft.utils.link_tree", side_effect=OSError("no"))
+
+    # The image is unpacked again instead
+    rootfs = rootfs_cache.extract(base_image, tmp_path / "work2/bundles")
+
+    assert (rootfs / "etc/os-release").exists()
+    assert mock_unpack.call_count == 2
+
+
+@tests.linux_only
+def test_rootfs_cache_eviction(registry, cache, mock_unpack, tmp_path):
+    rootfs_cache = RootfsCache(tmp_path / "rootfs", max_entries=1)
+    for base in ["ubuntu@22.04", "ubuntu@24.04"]:
+        image, _ = cache.get_image(base, image_dir=tmp_path / "a", arch="amd64")
+        rootfs_cache.extract(image, tmp_path / "bundles")
+
+    (entry,) = (p for p in (tmp_path / "rootfs").iterdir() if p.is_dir())
+    assert f"sha256:{entry.name}" == image.manifest_digest()
+
+
+@pytest.fixture
+def mock_index(mocker):
+    index = RootfsIndex(
+        {
+            "etc": RootfsEntry("5", 0o755, 0, 0, 0, "", ""),
+            "etc/passwd": RootfsEntry("0", 0o644, 0, 0, 5, "digest", ""),
+        },
+        {"etc/passwd": b"root\n"},
+    )
+    return mocker.patch.object(RootfsIndex, "from_image", return_value=index)
+
+
+def test_rootfs_cache_extract_index(base_image, mock_index, mock_unpack, tmp_path):
+    rootfs_cache = RootfsCache(tmp_path / "rootfs")
+
+    rootfs, index = rootfs_cache.extract_index(base_image, tmp_path / "work1/bundles")
+    assert rootfs == tmp_path / "work1/bundles/ubuntu-24.04-partial/rootfs"
+    assert (rootfs / "etc/passwd").read_text() == "root\n"
+    assert index.is_file("etc/passwd")
+    mock_index.assert_called_once_with(base_image)
+
+    # Another work dir loads the cached index
+    rootfs, index = rootfs_cache.extract_index(base_image, tmp_path / "work2/bundles")
+    assert (rootfs / "etc/passwd").read_text() == "root\n"
+    assert index.is_file("etc/passwd")
+    assert mock_index.call_count == 1
+    # The image is never unpacked
+    assert mock_unpack.call_count == 0
+
+
+def test_rootfs_cache_extract_index_eviction(registry, cache, mock_index, tmp_path):
+    rootfs_cache = RootfsCache(tmp_path / "rootfs", max_entries=1)
+    for base in ["ubuntu@22.04", "ubuntu@24.04"]:
+        image, _ = cache.get_image(base, image_dir=tmp_path / "a", arch="amd64")
+        rootfs_cache.extract_index(image, tmp_path / "bundles")
+
+    (entry,) = (tmp_path / "rootfs").glob("*.index.json")
+    assert f"sha256:{entry.name.removesuffix('.index.json')}" == image.manifest_digest()
+
+
+def test_get_cache_dir(mocker):
+    mocker.patch("platformdirs.user_cache_path", return_value=Path("/cache/app"))
+
+    assert image_cache.get_cache_dir("app", None) == Path("/cache/app/base-images")
+    assert image_cache.get_cache_dir("app", "/elsewhere") == Path("/elsewhere")
+
+
+def test_get_rootfs_cache_dir(mocker):
+    mocker.patch("platformdirs.user_cache_path", return_value=Path("/cache/app"))
+
+    assert image_cache.get_rootfs_cache_dir("app") == Path("/cache/app/rootfs")
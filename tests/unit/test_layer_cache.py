@@ -0,0 +1,140 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import io
+import json
+import tarfile
+from pathlib import Path
+
+import pytest
+from rockcraft import errors
+from rockcraft.layer_cache import FINGERPRINT_ANNOTATION, CachedLayer, LayerCache
+
+LAYER_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+gzip"
+
+
+def write_layout(layout_dir: Path, layers: dict[str, bytes]) -> list[CachedLayer]:
+    """Write an OCI layout with an image made of ``layers``, by fingerprint."""
+    blobs_dir = layout_dir / "blobs/sha256"
+    blobs_dir.mkdir(parents=True)
+
+    def _write(data: bytes) -> dict:
+        digest = hashlib.sha256(data).hexdigest()
+        (blobs_dir / digest).write_bytes(data)
+        return {"digest": f"sha256:{digest}", "size": len(data)}
+
+    cached = [
+        CachedLayer(
+            diff_id=hashlib.sha256(b"diff " + data).hexdigest(),
+            digest=hashlib.sha256(data).hexdigest(),
+            size=len(data),
+            media_type=LAYER_MEDIA_TYPE,
+        )
+        for data in layers.values()
+    ]
+    config = {"rootfs": {"diff_ids": [f"sha256:{layer.diff_id}" for layer in cached]}}
+    manifest = {
+        "config": _write(json.dumps(config).encode()),
+        "layers": [
+            {
+                "mediaType": LAYER_MEDIA_TYPE,
+                **_write(data),
+                "annotations": {FINGERPRINT_ANNOTATION: fingerprint},
+            }
+            for fingerprint, data in layers.items()
+        ],
+    }
+    index = {"manifests": [_write(json.dumps(manifest).encode())]}
+    (layout_dir / "index.json").write_text(json.dumps(index))
+    return cached
+
+
+def write_archive(layout_dir: Path, archive_path: Path) -> None:
+    with tarfile.open(archive_path, "w") as archive:
+        for path in sorted(layout_dir.rglob("*")):
+            archive.add(path, arcname=path.relative_to(layout_dir), recursive=False)
+
+
+def test_add_layout(tmp_path):
+    layers = write_layout(tmp_path / "layout", {"fp1": b"layer1", "fp2": b"layer2"})
+    blobs_path = tmp_path / "layout/blobs/sha256"
+    layer2_blob = blobs_path / layers[1].digest
+    layer2_blob.unlink()
+
+    layer_cache = LayerCache()
+    layer_cache.add_layout(tmp_path / "layout")
+
+    # Layers whose blob is gone are not reused
+    assert len(layer_cache) == 1
+    assert layer_cache.fetch("fp1", blobs_path) == layers[0]
+    assert layer_cache.fetch("fp2", blobs_path) is None
+    assert layer_cache.fetch("fp3", blobs_path) is None
+
+
+def test_add_layout_missing(tmp_path):
+    layer_cache = LayerCache()
+    layer_cache.add_layout(tmp_path / "layout")
+
+    assert len(layer_cache) == 0
+
+
+def test_add_archive(tmp_path):
+    layers = write_layout(tmp_path / "layout", {"fp1": b"layer1"})
+    write_archive(tmp_path / "layout", tmp_path / "previous.rock")
+    blobs_path = tmp_path / "new/blobs/sha256"
+    blobs_path.mkdir(parents=True)
+
+    layer_cache = LayerCache()
+    layer_cache.add_archive(tmp_path / "previous.rock")
+
+    # The blob is copied from the archive
+    assert layer_cache.fetch("fp1", blobs_path) == layers[0]
+    assert (blobs_path / layers[0].digest).read_bytes() == b"layer1"
+    assert [p.name for p in blobs_path.iterdir()] == [layers[0].digest]
+
+
+def test_add_archive_corrupt_blob(tmp_path):
+    layers = write_layout(tmp_path / "layout", {"fp1": b"layer1"})
+    (tmp_path / "layout/blobs/sha256" / layers[0].digest).write_bytes(b"layer2")
+    write_archive(tmp_path / "layout", tmp_path / "previous.rock")
+    blobs_path = tmp_path / "new/blobs/sha256"
+    blobs_path.mkdir(parents=True)
+
+    layer_cache = LayerCache()
+    layer_cache.add_archive(tmp_path / "previous.rock")
+
+    assert layer_cache.fetch("fp1", blobs_path) is None
+    assert not list(blobs_path.iterdir())
+
+
+@pytest.mark.parametrize("content", [None, b"not a tar file"])
+def test_add_archive_invalid(tmp_path, content):
+    archive_path = tmp_path / "previous.rock"
+    if content is not None:
+        archive_path.write_bytes(content)
+
+    with pytest.raises(errors.RockcraftError, match="Cannot reuse the layers"):
+        LayerCache().add_archive(archive_path)
+
+
+def test_add_archive_no_index(tmp_path):
+    archive_path = tmp_path / "previous.rock"
+    with tarfile.open(archive_path, "w") as archive:
+        info = tarfile.TarInfo("oci-layout")
+        archive.addfile(info, io.BytesIO())
+
+    with pytest.raises(errors.RockcraftError, match="Cannot reuse the layers"):
+        LayerCache().add_archive(archive_path)
@@ -13,6 +13,7 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import io
 import os
 import re
 import stat
@@ -23,6 +24,7 @@ from pathlib import Path
 import pytest
 from craft_parts.overlays import overlays
 from rockcraft import errors, layers
+from rockcraft.rootfs_index import RootfsEntry, RootfsIndex
 
 
 def get_tar_contents(tar_path: Path) -> list[str]:
@@ -85,6 +87,131 @@ def test_archive_layer_directories(tmp_path):
     assert temp_tar_contents == expected_tar_contents
 
 
+class WriteOnlyFile:
+    """A file object that only supports sequential writes."""
+
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def write(self, data):
+        return self.data.write(data)
+
+    def flush(self):
+        pass
+
+
+def test_write_layer_source_date_epoch(tmp_path):
+    """Test that timestamps newer than SOURCE_DATE_EPOCH are clamped."""
+    layer_dir = tmp_path / "layer_dir"
+    layer_dir.mkdir()
+    (layer_dir / "old.txt").write_text("old")
+    os.utime(layer_dir / "old.txt", (1000, 1000))
+    (layer_dir / "new.txt").write_text("new")
+
+    output = io.BytesIO()
+    layers.write_layer(layer_dir, output, source_date_epoch=5000)
+
+    output.seek(0)
+    with tarfile.open(fileobj=output) as tar_file:
+        assert tar_file.getmember("old.txt").mtime == 1000
+        assert tar_file.getmember("new.txt").mtime == 5000
+
+
+def test_write_layer_paths(tmp_path):
+    """Test that a layer can be limited to some paths and their parents."""
+    base_layer_dir = tmp_path / "base"
+    base_layer_dir.mkdir()
+    (base_layer_dir / "usr/lib").mkdir(parents=True)
+    (base_layer_dir / "lib").symlink_to("usr/lib")
+    layer_dir = tmp_path / "layer_dir"
+    for path in ("lib/dep/dep.so", "usr/lib/app.so", "etc/app.conf"):
+        (layer_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (layer_dir / path).write_text(path)
+
+    output = io.BytesIO()
+    layers.write_layer(
+        layer_dir, output, base_layer_dir, paths={"lib/dep/dep.so", "etc"}
+    )
+
+    output.seek(0)
+    with tarfile.open(fileobj=output) as tar_file:
+        # Paths are selected before being moved under the base's symlinks
+        assert tar_file.getnames() == [
+            "etc",
+            "usr/lib/dep",
+            "usr/lib/dep/dep.so",
+        ]
+
+
+def test_layer_fingerprint(tmp_path):
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "bin").mkdir(parents=True)
+    (layer_dir / "bin/app").write_text("app")
+    (layer_dir / "bin/link").symlink_to("app")
+    fingerprint = layers.layer_fingerprint(layer_dir)
+
+    # Reading files does not change the fingerprint
+    (layer_dir / "bin/app").read_text()
+    os.utime(layer_dir / "bin/app", ns=(0, (layer_dir / "bin/app").stat().st_mtime_ns))
+    assert layers.layer_fingerprint(layer_dir) == fingerprint
+
+    # But the options of the layer do
+    assert layers.layer_fingerprint(layer_dir, deduplicate=True) != fingerprint
+    assert layers.layer_fingerprint(layer_dir, paths={"bin/app"}) != fingerprint
+
+    # And so do changes, even when timestamps are clamped to SOURCE_DATE_EPOCH
+    epoch_fingerprint = layers.layer_fingerprint(layer_dir, source_date_epoch=1000)
+    (layer_dir / "bin/app").write_text("new")
+    assert layers.layer_fingerprint(layer_dir, source_date_epoch=1000) != (
+        epoch_fingerprint
+    )
+    assert layers.layer_fingerprint(layer_dir) != fingerprint
+
+
+def test_layer_fingerprint_content_digests(tmp_path):
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "bin").mkdir(parents=True)
+    (layer_dir / "bin/app").write_bytes(b"app" * 1024**2)
+    (layer_dir / "bin/empty").touch()
+    os.link(layer_dir / "bin/app", layer_dir / "bin/app-link")
+
+    # The digests collected while writing the layer give the same fingerprint
+    content_digests: dict[str, str] = {}
+    with (tmp_path / "layer.tar").open("wb", buffering=0) as layer_file:
+        layers.write_layer(
+            layer_dir,
+            layer_file,
+            source_date_epoch=1000,
+            content_digests=content_digests,
+        )
+    assert sorted(content_digests) == ["bin/app", "bin/empty"]
+    assert layers.layer_fingerprint(
+        layer_dir, source_date_epoch=1000, content_digests=content_digests
+    ) == layers.layer_fingerprint(layer_dir, source_date_epoch=1000)
+
+
+def test_write_layer_stream(tmp_path):
+    """Test that the layer can be written to a non-seekable file object."""
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "first").mkdir(parents=True)
+    (layer_dir / "first/first.txt").write_text("first")
+
+    output = WriteOnlyFile()
+    layers.write_layer(layer_dir, output)
+
+    # The stream is identical to the archive written to a file
+    temp_tar_path = tmp_path / "layer.tar"
+    layers.archive_layer(layer_dir, temp_tar_path)
+    assert output.data.getvalue() == temp_tar_path.read_bytes()
+
+    output.data.seek(0)
+    with tarfile.open(fileobj=output.data) as tar_file:
+        assert tar_file.getnames() == ["first", "first/first.txt"]
+        extracted = tar_file.extractfile("first/first.txt")
+        assert extracted is not None
+        assert extracted.read() == b"first"
+
+
 def test_archive_layer_symlinks(tmp_path):
     """
     Test creating a new layer with symlinks (both file and dir).
@@ -331,6 +458,106 @@ def test_archive_layer_duplicate_identical_files(tmp_path):
     assert temp_tar_contents == expected_tar_contents
 
 
+def test_archive_layer_duplicate_pc_files(tmp_path):
+    """
+    Test creating a layer where, because of symlinks in the base, multiple
+    pkg-config files end up at the same target. They only differ in their
+    prefix, of different lengths, so the layer must be created successfully.
+    """
+    layer_dir, rootfs_dir = duplicate_dirs_setup(tmp_path)
+
+    (layer_dir / "bin/dir1/lib.pc").write_text("prefix=/usr\nName: lib\n")
+    (layer_dir / "usr/bin/dir1/lib.pc").write_text("prefix=/root/prime\nName: lib\n")
+
+    temp_tar_path = tmp_path / "layer.tar"
+    layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+
+    assert "usr/bin/dir1/lib.pc" in get_tar_contents(temp_tar_path)
+
+
+def test_archive_layer_duplicate_hardlinked_files(tmp_path, mocker):
+    """
+    Test creating a layer where, because of symlinks in the base, hard links to
+    the same file end up at the same target. The other hard links to the file
+    are kept as such.
+    """
+    layer_dir, rootfs_dir = duplicate_dirs_setup(tmp_path)
+
+    (layer_dir / "usr/bin/dir1/same.txt").write_text("foobar")
+    os.link(layer_dir / "usr/bin/dir1/same.txt", layer_dir / "bin/dir1/same.txt")
+    os.link(layer_dir / "usr/bin/dir1/same.txt", layer_dir / "usr/bin/other.txt")
+    # Links to the same file are compatible without reading them.
+    spy_collide = mocker.spy(layers, "paths_collide")
+
+    temp_tar_path = tmp_path / "layer.tar"
+    layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+
+    assert not spy_collide.called
+    with tarfile.open(temp_tar_path) as tar_file:
+        assert tar_file.getmember("usr/bin/dir1/same.txt").isreg()
+        other = tar_file.getmember("usr/bin/other.txt")
+        assert other.islnk()
+        assert other.linkname == "usr/bin/dir1/same.txt"
+
+
+def test_write_layer_hardlinks(tmp_path, emitter):
+    """Test that the contents of hard-linked files are only stored once."""
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "bin").mkdir(parents=True)
+    (layer_dir / "lib").mkdir()
+    content = os.urandom(1024 * 1024)
+    (layer_dir / "bin/python3").write_bytes(content)
+    os.link(layer_dir / "bin/python3", layer_dir / "bin/python")
+    os.link(layer_dir / "bin/python3", layer_dir / "lib/python3.12")
+
+    output = io.BytesIO()
+    layers.write_layer(layer_dir, output)
+
+    assert len(output.getvalue()) < 2 * len(content)
+    emitter.assert_debug("Stored 2 hard links in the layer, saving 2097152 bytes")
+
+    output.seek(0)
+    extract_dir = tmp_path / "extract"
+    with tarfile.open(fileobj=output) as tar_file:
+        assert [(m.name, m.linkname) for m in tar_file if m.islnk()] == [
+            ("bin/python3", "bin/python"),
+            ("lib/python3.12", "bin/python"),
+        ]
+        tar_file.extractall(extract_dir, filter="tar")
+    assert (extract_dir / "lib/python3.12").read_bytes() == content
+    assert (extract_dir / "lib/python3.12").stat().st_nlink == 3
+
+
+def test_write_layer_deduplicate(tmp_path, emitter):
+    """Test that identical files are stored as hard links to a single copy."""
+    layer_dir = tmp_path / "layer_dir"
+    for name in ("a", "b", "c", "d"):
+        (layer_dir / name).mkdir(parents=True)
+        (layer_dir / name / "LICENSE").write_text("license")
+        (layer_dir / name / "empty").touch()
+    # Different mode or contents: not duplicates
+    (layer_dir / "c/LICENSE").chmod(0o600)
+    (layer_dir / "d/LICENSE").write_text("LICENSE")
+    # A hard link to a duplicate
+    os.link(layer_dir / "b/LICENSE", layer_dir / "e")
+
+    output = io.BytesIO()
+    layers.write_layer(layer_dir, output, deduplicate=True)
+
+    emitter.assert_progress("Deduplicated 2 files in the layer, saving 14 bytes")
+    output.seek(0)
+    extract_dir = tmp_path / "extract"
+    with tarfile.open(fileobj=output) as tar_file:
+        assert [(m.name, m.linkname) for m in tar_file if m.islnk()] == [
+            ("b/LICENSE", "a/LICENSE"),
+            ("e", "a/LICENSE"),
+        ]
+        tar_file.extractall(extract_dir, filter="tar")
+    assert (extract_dir / "e").read_text() == "license"
+    assert (extract_dir / "a/LICENSE").stat().st_nlink == 3
+    assert (extract_dir / "c/LICENSE").stat().st_mode & 0o777 == 0o600
+
+
 def test_prune_prime_files(tmp_path):
     base_layer_dir = tmp_path / "base"
     base_layer_dir.mkdir()
@@ -356,3 +583,184 @@ def test_prune_prime_files(tmp_path):
 
     # "file1.txt" gets pruned, the other files remain.
     assert sorted(os.listdir(prime_dir)) == ["file2.txt", "file3.txt"]  # noqa: PTH208 (use Path.iterdir())
+
+
+def test_prune_prime_files_attributes_first(tmp_path, mocker):
+    """Test that files are only read if their attributes are the same."""
+    base_layer_dir = tmp_path / "base"
+    prime_dir = tmp_path / "prime"
+    base_layer_dir.mkdir()
+    prime_dir.mkdir()
+    for name in ("same", "size", "mode", "contents"):
+        (base_layer_dir / name).write_text("content")
+    (prime_dir / "same").write_text("content")
+    (prime_dir / "size").write_text("other content")
+    (prime_dir / "mode").write_text("content")
+    (prime_dir / "mode").chmod(0o600)
+    (prime_dir / "contents").write_text("CONTENT")
+    spy_contents = mocker.spy(layers, "_same_file_contents")
+
+    files = {"same", "size", "mode", "contents", "missing"}
+    layers.prune_prime_files(prime_dir, files, base_layer_dir)
+
+    assert sorted(p.name for p in prime_dir.iterdir()) == ["contents", "mode", "size"]
+    assert sorted(call.args[1].name for call in spy_contents.call_args_list) == [
+        "contents",
+        "same",
+    ]
+
+
+def test_prune_prime_files_symlinks_and_pc(tmp_path):
+    """Test that symlinks and pkg-config files are compared like before."""
+    # The prefixes of the pkg-config files have different lengths.
+    base_layer_dir = tmp_path / "base"
+    prime_dir = tmp_path / "prime"
+    for directory in (base_layer_dir, prime_dir):
+        directory.mkdir()
+        (directory / "target").write_text("target")
+        (directory / "link").symlink_to("target")
+        (directory / "other-link").symlink_to("target")
+        (directory / "lib.pc").write_text(f"prefix={directory}\nName: lib\n")
+    (prime_dir / "other-link").unlink()
+    (prime_dir / "other-link").symlink_to("link")
+
+    files = {"link", "other-link", "lib.pc"}
+    layers.prune_prime_files(prime_dir, files, base_layer_dir)
+
+    assert sorted(p.name for p in prime_dir.iterdir()) == ["other-link", "target"]
+
+
+def test_prune_prime_files_base_index(tmp_path):
+    """Test that primed files are compared with the index of the base."""
+    uid, gid = os.getuid(), os.getgid()
+
+    def _file(content: bytes, mode: int = 0o644) -> RootfsEntry:
+        digest = layers.content_digest(io.BytesIO(content))
+        return RootfsEntry("0", mode, uid, gid, len(content), digest, "")
+
+    base_index = RootfsIndex(
+        {
+            "usr": RootfsEntry("5", 0o755, uid, gid, 0, "", ""),
+            "usr/same": _file(b"content"),
+            "usr/mode": _file(b"content", 0o600),
+            "usr/contents": _file(b"CONTENT"),
+            "usr/dir": RootfsEntry("5", 0o755, uid, gid, 0, "", ""),
+            "usr/link": RootfsEntry("2", 0o777, uid, gid, 0, "", "same"),
+            "lib": RootfsEntry("2", 0o777, uid, gid, 0, "", "usr"),
+        }
+    )
+    prime_dir = tmp_path / "prime"
+    (prime_dir / "usr").mkdir(parents=True)
+    (prime_dir / "lib").symlink_to("usr")
+    for name in ("same", "mode", "contents", "dir"):
+        (prime_dir / "usr" / name).write_text("content")
+        (prime_dir / "usr" / name).chmod(0o644)
+    (prime_dir / "usr/link").symlink_to("same")
+
+    files = {"usr/same", "usr/mode", "usr/contents", "usr/dir", "usr/link", "lib"}
+    layers.prune_prime_files(prime_dir, files, tmp_path / "missing", base_index)
+
+    assert sorted(p.name for p in (prime_dir / "usr").iterdir()) == [
+        "contents",
+        "dir",
+        "mode",
+    ]
+    # Like with an extracted base, only files and symlinks to files are pruned
+    assert (prime_dir / "lib").is_symlink()
+
+
+def test_prune_prime_files_base_index_pc(tmp_path):
+    """Test that pkg-config files are compared with the index without their prefix."""
+    content = b"prefix=/usr\nName: lib\n"
+    digest = layers.content_digest(io.BytesIO(content), pkgconfig=True)
+    base_index = RootfsIndex(
+        {"lib.pc": RootfsEntry("0", 0o644, os.getuid(), os.getgid(), 22, digest, "")}
+    )
+    prime_dir = tmp_path / "prime"
+    prime_dir.mkdir()
+    (prime_dir / "lib.pc").write_text(f"prefix={prime_dir}\nName: lib\n")
+    (prime_dir / "lib.pc").chmod(0o644)
+
+    layers.prune_prime_files(prime_dir, {"lib.pc"}, tmp_path / "missing", base_index)
+
+    assert not (prime_dir / "lib.pc").exists()
+
+
+def test_write_layer_same_as_tarfile(tmp_path):
+    """Test that the layer entries match the ones from TarFile.add()."""
+    layer_dir = tmp_path / "layer_dir"
+    long_dir = "d" * 120
+    (layer_dir / "etc").mkdir(parents=True)
+    (layer_dir / "etc/file.txt").write_text("content")
+    (layer_dir / "etc/file.txt").chmod(0o640)
+    os.link(layer_dir / "etc/file.txt", layer_dir / "etc/hardlink.txt")
+    (layer_dir / "etc/link").symlink_to("file.txt")
+    (layer_dir / "lib").symlink_to("etc")
+    (layer_dir / long_dir).mkdir()
+    (layer_dir / long_dir / "big").write_bytes(os.urandom(3 * 1024 * 1024 + 1))
+    os.mkfifo(layer_dir / "fifo")
+    names = [
+        "etc",
+        "etc/file.txt",
+        "etc/hardlink.txt",
+        "etc/link",
+        "fifo",
+        "lib",
+        long_dir,
+        f"{long_dir}/big",
+    ]
+
+    def whole_seconds(tarinfo):
+        tarinfo.mtime = int(tarinfo.mtime)
+        return tarinfo
+
+    expected = io.BytesIO()
+    with tarfile.open(fileobj=expected, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for name in sorted(names):
+            tar.add(
+                layer_dir / name, arcname=name, recursive=False, filter=whole_seconds
+            )
+
+    output = WriteOnlyFile()
+    layers.write_layer(layer_dir, output)
+    assert output.data.getvalue() == expected.getvalue()
+
+    # Written to a file, file contents are copied by the kernel instead
+    layers.archive_layer(layer_dir, tmp_path / "layer.tar")
+    assert (tmp_path / "layer.tar").read_bytes() == expected.getvalue()
+
+
+def test_write_layer_stats_once(tmp_path, mocker):
+    """Test that the layer paths are not stat'ed again after the walk."""
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "dir/subdir").mkdir(parents=True)
+    (layer_dir / "dir/subdir/file.txt").write_text("content")
+    (layer_dir / "dir/link").symlink_to("subdir")
+    spy_lstat = mocker.spy(os, "lstat")
+    spy_stat = mocker.spy(os, "stat")
+
+    layers.write_layer(layer_dir, io.BytesIO())
+
+    stat_calls = [*spy_lstat.call_args_list, *spy_stat.call_args_list]
+    assert [c for c in stat_calls if str(layer_dir) in str(c.args[0])] == []
+
+
+def test_stat_cache(tmp_path, mocker):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "file").write_text("content")
+    (tmp_path / "link").symlink_to("dir")
+    stat_cache = layers.StatCache()
+
+    assert stat_cache.is_file(tmp_path / "file")
+    assert stat_cache.is_dir(tmp_path / "link")
+    assert stat_cache.is_symlink(tmp_path / "link")
+    assert not stat_cache.is_dir(tmp_path / "file")
+    assert stat_cache.lstat(tmp_path / "missing") is None
+    assert stat_cache.lstat(tmp_path / "file/child") is None
+
+    # The results are cached, even for missing paths
+    spy_lstat = mocker.spy(os, "lstat")
+    (tmp_path / "missing").touch()
+    assert stat_cache.lstat(tmp_path / "missing") is None
+    assert stat_cache.lstat(tmp_path / "file").st_size == len("content")
+    assert spy_lstat.call_count == 0
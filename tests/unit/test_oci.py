@@ -14,17 +14,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import datetime
+import errno
+import gzip
 import hashlib
+import io
 import json
 import os
+import subprocess
 import tarfile
 from pathlib import Path
 from typing import NamedTuple
-from unittest.mock import ANY, call, mock_open, patch
+from unittest.mock import call, mock_open, patch
 
 import pytest
-from rockcraft import errors, oci
+from rockcraft import compression, errors, oci
 from rockcraft.architectures import SUPPORTED_ARCHS
+from rockcraft.compression import LayerCompression
 from rockcraft.pebble import Pebble
 
 import tests
@@ -47,11 +52,6 @@ def mock_run(mocker):
     return mocker.patch("rockcraft.oci._process_run")
 
 
-@pytest.fixture
-def mock_archive_layer(mocker):
-    return mocker.patch("rockcraft.layers.archive_layer")
-
-
 @pytest.fixture
 def mock_rmtree(mocker):
     return mocker.patch("shutil.rmtree")
@@ -97,6 +97,68 @@ def mock_add_layer(mocker):
     return mocker.patch("rockcraft.oci.Image.add_layer")
 
 
+def write_blob(blobs_dir: Path, content: dict) -> dict:
+    """Write ``content`` as a JSON blob, returning its descriptor."""
+    data = json.dumps(content).encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    (blobs_dir / digest).write_bytes(data)
+    return {"digest": f"sha256:{digest}", "size": len(data)}
+
+
+def read_blob(blobs_dir: Path, descriptor: dict) -> dict:
+    return json.loads((blobs_dir / descriptor["digest"].split(":")[-1]).read_bytes())
+
+
+@pytest.fixture
+def oci_image(tmp_path):
+    """A minimal on-disk OCI image, "a:b", with an empty config and no layers."""
+    blobs_dir = tmp_path / "a/blobs/sha256"
+    blobs_dir.mkdir(parents=True)
+    config = {
+        "architecture": "amd64",
+        "os": "linux",
+        "config": {"Env": ["PATH=/usr/bin"]},
+        "rootfs": {"type": "layers", "diff_ids": []},
+        "history": [],
+    }
+    manifest = {
+        "schemaVersion": 2,
+        "config": {
+            "mediaType": "application/vnd.oci.image.config.v1+json",
+            **write_blob(blobs_dir, config),
+        },
+        "layers": [],
+    }
+    index = {
+        "schemaVersion": 2,
+        "manifests": [
+            {
+                "mediaType": oci.MANIFEST_MEDIA_TYPE,
+                **write_blob(blobs_dir, manifest),
+                "annotations": {"org.opencontainers.image.ref.name": "b"},
+            }
+        ],
+    }
+    (tmp_path / "a/index.json").write_text(json.dumps(index))
+    (tmp_path / "a/oci-layout").write_text('{"imageLayoutVersion": "1.0.0"}')
+
+    return oci.Image("a:b", tmp_path)
+
+
+def read_image(image: oci.Image, tag: str = "b") -> tuple[dict, dict]:
+    """Get the manifest and config of ``image``."""
+    layout_dir = image.path / image.image_name.split(":")[0]
+    blobs_dir = layout_dir / "blobs/sha256"
+    index = json.loads((layout_dir / "index.json").read_bytes())
+    (descriptor,) = [
+        m
+        for m in index["manifests"]
+        if m["annotations"]["org.opencontainers.image.ref.name"] == tag
+    ]
+    manifest = read_blob(blobs_dir, descriptor)
+    return manifest, read_blob(blobs_dir, manifest["config"])
+
+
 @tests.linux_only
 class TestImage:
     """OCI image manipulation."""
@@ -151,6 +213,20 @@ class TestImage:
             )
         ]
 
+    def test_from_docker_registry_digest(self, mock_run, new_dir):
+        digest = "sha256:" + "ab" * 32
+        image, source_image = oci.Image.from_docker_registry(
+            "a@b", image_dir=Path("images/dir"), arch="amd64", digest=digest
+        )
+
+        # The pinned image is fetched, but still stored with its tag
+        assert image.image_name == "a:b"
+        assert source_image == f"docker://{oci.REGISTRY_URL}/a@{digest}"
+        assert mock_run.mock_calls[0].args[0][-2:] == [
+            f"docker://{oci.REGISTRY_URL}/a@{digest}",
+            "oci:images/dir/a:b",
+        ]
+
     def _get_arch_from_call(self, mock_call):
         class ArchData(NamedTuple):
             override_arch: str
@@ -278,36 +354,282 @@ class TestImage:
         assert Path("bundle/dir/a-b/foo.txt").exists() is False
         assert bundle_path == Path("bundle/dir/a-b/rootfs")
 
-    def test_add_layer(self, mocker, mock_run, new_dir):
-        image = oci.Image("a:b", new_dir / "c")
-        Path("c").mkdir()
+    def test_extract_to_reuse(self, mock_run, oci_image, new_dir):
+        def fake_unpack(command):
+            (Path(command[-1]) / "rootfs").mkdir(parents=True)
+
+        mock_run.side_effect = fake_unpack
+
+        rootfs = oci_image.extract_to(Path("bundle"))
+        assert rootfs == Path("bundle/a-b/rootfs")
+        assert mock_run.call_count == 1
+
+        # The bundle is still valid for the same manifest
+        assert oci_image.extract_to(Path("bundle")) == rootfs
+        assert mock_run.call_count == 1
+
+        # But not when extracting rootless, or for another manifest
+        oci_image.extract_to(Path("bundle"), rootless=True)
+        assert mock_run.call_count == 2
+        oci_image.add_layer("b", Path("bundle/a-b/rootfs"))
+        oci_image.extract_to(Path("bundle"), rootless=True)
+        assert mock_run.call_count == 3
+
+    def test_add_layer(self, mocker, mock_run, oci_image, new_dir):
         Path("layer_dir").mkdir()
-        Path("layer_dir/foo.txt").touch()
-        pid = os.getpid()
-
-        spy_add = mocker.spy(tarfile.TarFile, "add")
-
-        image.add_layer("tag", Path("layer_dir"))
-        # The `Tarfile.add()` on the directory ends up calling the method multiple
-        # times (due to the recursion), but we're mainly interested that the first
-        # call was to add `layer_dir`.
-        assert spy_add.mock_calls[0] == call(
-            ANY, Path("layer_dir/foo.txt"), arcname="foo.txt", recursive=False
-        )
-
-        expected_cmd = [
-            "umoci",
-            "raw",
-            "add-layer",
-            "--image",
-            str(new_dir / "c/a:b"),
-            str(new_dir / f"c/.temp_layer.{pid}.tar"),
-            "--tag",
-            "tag",
-        ]
-        assert mock_run.mock_calls == [
-            call([*expected_cmd, "--history.created_by", " ".join(expected_cmd)])
+        Path("layer_dir/foo.txt").write_text("foo")
+        _, original_config = read_image(oci_image)
+
+        new_image = oci_image.add_layer("tag", Path("layer_dir"))
+        assert new_image.image_name == "a:tag"
+
+        # No external tools were used, and the temporary tarball is gone
+        assert not mock_run.called
+        assert not list(oci_image.path.glob(".temp_layer*"))
+
+        manifest, config = read_image(new_image, "tag")
+        (layer,) = manifest["layers"]
+        assert layer["mediaType"] == "application/vnd.oci.image.layer.v1.tar+gzip"
+
+        blob = oci_image.path / "a/blobs/sha256" / layer["digest"].split(":")[-1]
+        blob_bytes = blob.read_bytes()
+        assert layer["digest"] == f"sha256:{hashlib.sha256(blob_bytes).hexdigest()}"
+        assert layer["size"] == len(blob_bytes)
+
+        uncompressed = gzip.decompress(blob_bytes)
+        diff_id = f"sha256:{hashlib.sha256(uncompressed).hexdigest()}"
+        assert config["rootfs"]["diff_ids"] == [diff_id]
+        assert len(config["history"]) == 1
+
+        with tarfile.open(fileobj=io.BytesIO(uncompressed)) as tar_file:
+            assert tar_file.getnames() == ["foo.txt"]
+
+        # The original tag is untouched
+        original_manifest, config = read_image(oci_image)
+        assert original_manifest["layers"] == []
+        assert config == original_config
+
+    def test_add_layer_compression(self, oci_image, new_dir):
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").write_text("foo")
+        layer_compression = LayerCompression(threads=3)
+
+        image = oci_image.with_compression(layer_compression)
+        new_image = image.add_layer("tag", Path("layer_dir"))
+
+        # The compression settings carry over to the new image
+        assert new_image.compression == layer_compression
+        manifest, _ = read_image(new_image, "tag")
+        (layer,) = manifest["layers"]
+        blob = oci_image.path / "a/blobs/sha256" / layer["digest"].split(":")[-1]
+        with tarfile.open(
+            fileobj=io.BytesIO(gzip.decompress(blob.read_bytes()))
+        ) as tar:
+            assert tar.getnames() == ["foo.txt"]
+
+    def test_add_layer_zstd(self, oci_image, new_dir):
+        zstandard = pytest.importorskip("zstandard")
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").write_text("foo")
+
+        image = oci_image.with_compression(LayerCompression(algorithm="zstd"))
+        new_image = image.add_layer("tag", Path("layer_dir"))
+
+        manifest, config = read_image(new_image, "tag")
+        (layer,) = manifest["layers"]
+        assert layer["mediaType"] == "application/vnd.oci.image.layer.v1.tar+zstd"
+
+        blob = oci_image.path / "a/blobs/sha256" / layer["digest"].split(":")[-1]
+        with zstandard.ZstdDecompressor().stream_reader(blob.open("rb")) as reader:
+            uncompressed = reader.read()
+        diff_id = f"sha256:{hashlib.sha256(uncompressed).hexdigest()}"
+        assert config["rootfs"]["diff_ids"] == [diff_id]
+
+    def test_add_layer_source_date_epoch(self, oci_image, new_dir):
+        for layer_dir, mtime in (("layer1", 2_000_000_000), ("layer2", 1_900_000_000)):
+            Path(layer_dir).mkdir()
+            Path(layer_dir, "foo.txt").write_text("foo")
+            os.utime(Path(layer_dir, "foo.txt"), (mtime, mtime))
+
+        image = oci_image.with_source_date_epoch(1_000_000_000)
+        image.add_layer("t1", Path("layer1"))
+        image.add_layer("t2", Path("layer2"))
+
+        # Layers with the same content are the same, whatever their timestamps
+        manifest1, config1 = read_image(oci_image, "t1")
+        manifest2, config2 = read_image(oci_image, "t2")
+        assert manifest1 == manifest2
+        assert config1 == config2
+        assert config1["created"] == "2001-09-09T01:46:40+00:00"
+        assert config1["history"][0]["created"] == "2001-09-09T01:46:40+00:00"
+
+    def test_add_layer_layer_cache(self, oci_image, new_dir, mocker):
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").write_text("foo")
+        oci_image.with_layer_cache().add_layer("t1", Path("layer_dir"))
+        manifest1, config1 = read_image(oci_image, "t1")
+        spy_write = mocker.spy(oci.layers, "write_layer")
+
+        # The unchanged layer of t1 is reused
+        oci_image.with_layer_cache().add_layer("t2", Path("layer_dir"))
+        manifest2, config2 = read_image(oci_image, "t2")
+        assert not spy_write.called
+        assert manifest2["layers"] == manifest1["layers"]
+        assert config2["rootfs"] == config1["rootfs"]
+        (layer,) = manifest2["layers"]
+        assert list(layer["annotations"]) == ["io.rockcraft.layer.fingerprint"]
+
+        # But not once a file has changed, or with another compression
+        os.utime("layer_dir/foo.txt", (1000, 1000))
+        oci_image.with_layer_cache().add_layer("t3", Path("layer_dir"))
+        assert spy_write.call_count == 1
+        oci_image.with_compression(
+            LayerCompression(level=1)
+        ).with_layer_cache().add_layer("t4", Path("layer_dir"))
+        assert spy_write.call_count == 2
+
+    def test_add_layer_layer_cache_source_date_epoch(self, oci_image, new_dir):
+        Path("layer_dir").mkdir()
+        digests = []
+        for build, mtime in enumerate((2_000_000_000, 1_900_000_000)):
+            Path("layer_dir/foo.txt").write_text("foo")
+            os.utime("layer_dir/foo.txt", (mtime, mtime))
+            image = oci_image.with_source_date_epoch(1_000_000_000)
+            image.with_layer_cache().add_layer(f"t{build}", Path("layer_dir"))
+            index = json.loads((oci_image.path / "a/index.json").read_text())
+            digests.append(index["manifests"][-1]["digest"])
+            manifest, _ = read_image(oci_image, f"t{build}")
+            (layer,) = manifest["layers"]
+            assert "io.rockcraft.layer.fingerprint" in layer["annotations"]
+
+        # Packing the same content twice gives the same manifest
+        assert digests[0] == digests[1]
+
+        # But a change of the contents is not hidden by the clamped timestamps
+        Path("layer_dir/foo.txt").write_text("bar")
+        os.utime("layer_dir/foo.txt", (2_000_000_000, 2_000_000_000))
+        image.with_layer_cache().add_layer("t2", Path("layer_dir"))
+        manifest, _ = read_image(oci_image, "t2")
+        assert manifest["layers"] != read_image(oci_image, "t0")[0]["layers"]
+
+    def test_add_layer_layer_cache_source_date_epoch_read_once(
+        self, oci_image, new_dir, mocker
+    ):
+        Path("layer_dir/sub").mkdir(parents=True)
+        Path("layer_dir/foo.txt").write_text("foo")
+        Path("layer_dir/sub/bar.txt").write_text("bar")
+        Path("layer_dir/empty.txt").touch()
+        spy_open = mocker.spy(Path, "open")
+
+        # Nothing can be reused: each file is read once, to archive it
+        image = oci_image.with_source_date_epoch(1_000_000_000).with_layer_cache()
+        image.add_layer("t1", Path("layer_dir"))
+        layer_dir = Path("layer_dir").resolve()
+        opened = [
+            call.args[0].name
+            for call in spy_open.call_args_list
+            if layer_dir in call.args[0].resolve().parents
         ]
+        assert sorted(opened) == ["bar.txt", "foo.txt"]
+
+        # And the layer still has the fingerprint of its content, to be reused
+        spy_write = mocker.spy(oci.layers, "write_layer")
+        image.with_layer_cache().add_layer("t2", Path("layer_dir"))
+        assert not spy_write.called
+        assert read_image(oci_image, "t1")[0] == read_image(oci_image, "t2")[0]
+
+    def test_add_layer_layer_cache_archive(self, oci_image, new_dir, mocker):
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").write_text("foo")
+        image = oci_image.with_layer_cache().add_layer("t1", Path("layer_dir"))
+        image.to_oci_archive("t1", filename="previous.rock")
+        manifest1, _ = read_image(oci_image, "t1")
+        (layer1,) = manifest1["layers"]
+        # The layer is gone from the local layout
+        layer_blob = oci_image.path / "a/blobs/sha256" / layer1["digest"].split(":")[-1]
+        layer_blob.unlink()
+        spy_write = mocker.spy(oci.layers, "write_layer")
+
+        oci_image.with_layer_cache(Path("previous.rock")).add_layer(
+            "t2", Path("layer_dir")
+        )
+
+        assert not spy_write.called
+        manifest2, _ = read_image(oci_image, "t2")
+        assert manifest2["layers"] == [layer1]
+        assert (
+            hashlib.sha256(layer_blob.read_bytes()).hexdigest()
+            == (layer1["digest"].split(":")[-1])
+        )
+
+    def test_add_layer_same_tag(self, oci_image, new_dir):
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").write_text("foo")
+
+        new_image = oci_image.add_layer("b", Path("layer_dir"))
+        new_image = new_image.add_layer("b", Path("layer_dir"))
+        assert new_image.image_name == "a:b"
+
+        index = json.loads((oci_image.path / "a/index.json").read_text())
+        assert len(index["manifests"]) == 1
+
+        manifest, config = read_image(new_image)
+        assert len(manifest["layers"]) == 2
+        assert len(config["rootfs"]["diff_ids"]) == 2
+
+        # Only the current config and manifest remain, plus the layer blob
+        # (the same content was added twice).
+        assert len(list((oci_image.path / "a/blobs/sha256").iterdir())) == 3
+
+    def test_add_layer_error(self, mocker, oci_image, new_dir):
+        """A failure while archiving leaves no partial blob behind."""
+        Path("layer_dir").mkdir()
+        mocker.patch(
+            "rockcraft.layers.write_layer", side_effect=errors.LayerArchivingError("x")
+        )
+        blobs_dir = oci_image.path / "a/blobs/sha256"
+        blobs_before = set(blobs_dir.iterdir())
+
+        with pytest.raises(errors.LayerArchivingError):
+            oci_image.add_layer("tag", Path("layer_dir"))
+
+        assert set(blobs_dir.iterdir()) == blobs_before
+
+    def test_add_layer_error_not_compressed(self, mocker, oci_image, new_dir):
+        """The rest of the layer is not compressed when archiving fails."""
+        Path("layer_dir").mkdir()
+
+        def _write_layer(_layer_dir, layer_file, *args, **kwargs):
+            layer_file.write(b"data" * 1024)
+            raise errors.LayerArchivingError("x")
+
+        mocker.patch("rockcraft.layers.write_layer", side_effect=_write_layer)
+        mock_close = mocker.patch.object(
+            compression.ParallelGzipWriter, "close", side_effect=OSError
+        )
+        blobs_dir = oci_image.path / "a/blobs/sha256"
+        blobs_before = set(blobs_dir.iterdir())
+
+        # The original error is raised, not one from finishing the stream
+        with pytest.raises(errors.LayerArchivingError):
+            oci_image.add_layer("tag", Path("layer_dir"))
+
+        assert not mock_close.called
+        assert set(blobs_dir.iterdir()) == blobs_before
+
+    def test_add_layer_compression_error(self, mocker, oci_image, new_dir):
+        """A failure to finish the compressed stream leaves no partial blob."""
+        Path("layer_dir").mkdir()
+        mocker.patch.object(
+            compression.ParallelGzipWriter, "close", side_effect=OSError("full")
+        )
+        blobs_dir = oci_image.path / "a/blobs/sha256"
+        blobs_before = set(blobs_dir.iterdir())
+
+        with pytest.raises(OSError, match="full"):
+            oci_image.add_layer("tag", Path("layer_dir"))
+
+        assert set(blobs_dir.iterdir()) == blobs_before
 
     def test_add_new_user(
         self,
@@ -505,27 +827,68 @@ class TestImage:
             )
         ]
 
-    def test_to_oci_archive(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
+    def test_to_oci_archive(self, oci_image, new_dir):
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").write_text("foo")
+        image = oci_image.add_layer("tag", Path("layer_dir"))
+        # A blob that the exported image does not refer to
+        (oci_image.path / "a/blobs/sha256" / ("0" * 64)).write_text("unused")
+
         image.to_oci_archive("tag", filename="foobar")
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "skopeo",
-                    "--insecure-policy",
-                    "copy",
-                    "oci:/c/a:tag",
-                    "oci-archive:foobar:tag",
-                ]
-            )
-        ]
+
+        manifest, _ = read_image(image, tag="tag")
+        with tarfile.open("foobar") as archive:
+            names = archive.getnames()
+            index = json.loads(archive.extractfile("index.json").read())
+            (layer,) = manifest["layers"]
+            layer_blob = archive.extractfile(
+                f"blobs/sha256/{layer['digest'].split(':')[-1]}"
+            ).read()
+
+        (descriptor,) = index["manifests"]
+        assert descriptor["annotations"] == {"org.opencontainers.image.ref.name": "tag"}
+        manifest_digest = descriptor["digest"].split(":")[-1]
+        config_digest = manifest["config"]["digest"].split(":")[-1]
+        assert sorted(names) == sorted(
+            [
+                "oci-layout",
+                "index.json",
+                "blobs",
+                "blobs/sha256",
+                f"blobs/sha256/{manifest_digest}",
+                f"blobs/sha256/{config_digest}",
+                f"blobs/sha256/{layer['digest'].split(':')[-1]}",
+            ]
+        )
+        assert len(layer_blob) == layer["size"]
+        assert Path("foobar").stat().st_size % tarfile.RECORDSIZE == 0
+
+    def test_to_oci_archive_no_kernel_copy(self, oci_image, new_dir, mocker):
+        mocker.patch("os.copy_file_range", side_effect=OSError(errno.EXDEV, "no"))
+        mocker.patch("os.sendfile", side_effect=OSError(errno.EINVAL, "no"))
+
+        oci_image.to_oci_archive("b", filename="foobar")
+
+        manifest, config = read_image(oci_image)
+        config_digest = manifest["config"]["digest"].split(":")[-1]
+        with tarfile.open("foobar") as archive:
+            data = archive.extractfile(f"blobs/sha256/{config_digest}").read()
+        assert json.loads(data) == config
+
+    def test_to_oci_archive_error(self, oci_image, new_dir, mocker):
+        mocker.patch("os.copy_file_range", side_effect=OSError(errno.EIO, "I/O"))
+
+        with pytest.raises(OSError, match="I/O"):
+            oci_image.to_oci_archive("b", filename="foobar")
 
     def test_digest(self, mocker):
         source_image = "docker://ubuntu:22.04"
         image = oci.Image("a:b", Path("/c"))
         mock_output = mocker.patch(
-            "subprocess.check_output",
-            return_value="000102030405060708090a0b0c0d0e0f",
+            "subprocess.run",
+            return_value=subprocess.CompletedProcess(
+                [], 0, stdout="000102030405060708090a0b0c0d0e0f"
+            ),
         )
         mock_skopeo = mocker.patch(
             "shutil.which",
@@ -544,80 +907,56 @@ class TestImage:
                     "-n",
                     source_image,
                 ],
+                check=True,
+                stdout=subprocess.PIPE,
                 text=True,
             )
         ]
         assert digest == bytes([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15])
 
-    def test_set_default_user(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
+    def test_digest_local(self, oci_image, mocker):
+        mock_output = mocker.patch("subprocess.run")
+        index = json.loads((oci_image.path / "a/index.json").read_bytes())
 
-        image.set_default_user(584792, "_daemon_")
+        digest = oci.Image.digest(f"oci:{oci_image.path / 'a:b'}")
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=config.entrypoint",
-                    "--config.user",
-                    "584792",
-                ]
-            )
-        ]
+        # The digest is read from the layout, without running skopeo
+        assert not mock_output.called
+        assert f"sha256:{digest.hex()}" == index["manifests"][0]["digest"]
+
+    def test_set_default_user(self, oci_image, mock_run):
+        oci_image.set_default_user(584792, "_daemon_")
+
+        _, config = read_image(oci_image)
+        assert config["config"]["User"] == "584792"
+        assert "Entrypoint" not in config["config"]
+        assert not mock_run.called
 
     @pytest.mark.parametrize(
         ("entrypoint"),
         [
-            ([Pebble.PEBBLE_BINARY_PATH_PREVIOUS, "enter"],),
-            ([Pebble.PEBBLE_BINARY_PATH, "enter"],),
-            (["echo", "Test"],),
-            ([],),
+            [Pebble.PEBBLE_BINARY_PATH_PREVIOUS, "enter"],
+            [Pebble.PEBBLE_BINARY_PATH, "enter"],
+            ["echo", "Test"],
+            [],
         ],
     )
-    def test_set_entrypoint_default(self, mock_run, entrypoint):
-        image = oci.Image("a:b", Path("/tmp"))
-
-        image.set_entrypoint(entrypoint)
-
-        arg_list = [
-            "umoci",
-            "config",
-            "--image",
-            "/tmp/a:b",
-            "--clear=config.entrypoint",
-        ]
-
-        for e in entrypoint:
-            arg_list.extend(["--config.entrypoint", e])
-
-        arg_list.append("--clear=config.cmd")
+    def test_set_entrypoint_default(self, oci_image, mock_run, entrypoint):
+        oci_image.set_cmd(["previous", "cmd"])
+        oci_image.set_entrypoint(entrypoint)
 
-        assert mock_run.mock_calls == [
-            call(arg_list),
-        ]
+        _, config = read_image(oci_image)
+        assert config["config"].get("Entrypoint", []) == entrypoint
+        assert "Cmd" not in config["config"]
+        assert not mock_run.called
 
     @pytest.mark.parametrize(("cmd"), [(["echo", "Test"]), ([])])
-    def test_set_cmd(self, mock_run, cmd):
-        image = oci.Image("a:b", Path("/c"))
-        image.set_cmd(cmd)
-
-        arg_list = [
-            "umoci",
-            "config",
-            "--image",
-            "/c/a:b",
-            "--clear=config.cmd",
-        ]
-
-        for arg in cmd:
-            arg_list.extend(["--config.cmd", arg])
+    def test_set_cmd(self, oci_image, mock_run, cmd):
+        oci_image.set_cmd(cmd)
 
-        assert mock_run.mock_calls == [
-            call(arg_list),
-        ]
+        _, config = read_image(oci_image)
+        assert config["config"].get("Cmd", []) == cmd
+        assert not mock_run.called
 
     @pytest.mark.parametrize(
         ("mock_services", "mock_checks"),
@@ -708,34 +1047,32 @@ class TestImage:
             fake_tmpfs, mock_base_layer_dir, expected_layer, mock_name
         )
 
-    def test_set_environment(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-
-        image.set_environment({"NAME1": "VALUE1", "NAME2": "VALUE2"})
+    def test_set_environment(self, oci_image, mock_run):
+        oci_image.set_environment({"NAME1": "VALUE1", "NAME2": "VALUE2"})
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--config.env",
-                    "NAME1=VALUE1",
-                    "--config.env",
-                    "NAME2=VALUE2",
-                ]
-            )
+        _, config = read_image(oci_image)
+        assert config["config"]["Env"] == [
+            "PATH=/usr/bin",
+            "NAME1=VALUE1",
+            "NAME2=VALUE2",
         ]
 
+        # Existing variables are replaced, not duplicated
+        oci_image.set_environment({"PATH": "/bin", "NAME1": "VALUE3"})
+
+        _, config = read_image(oci_image)
+        assert config["config"]["Env"] == ["PATH=/bin", "NAME1=VALUE3", "NAME2=VALUE2"]
+        assert not mock_run.called
+
     def test_set_control_data(
         self,
-        mock_archive_layer,
         mock_rmtree,
         mock_mkdir,
         mock_mkdtemp,
         mock_run,
+        mocker,
     ):
+        mock_add_layer_into_image = mocker.patch("rockcraft.oci._add_layer_into_image")
         image = oci.Image("a:b", Path("/c"))
 
         mock_control_data_path = "layer_dir"
@@ -763,66 +1100,134 @@ class TestImage:
         assert mocked_data["writes"] == expected
         mock_mkdtemp.assert_called_once()
         mock_mkdir.assert_called_once()
-        mock_archive_layer.assert_called_once_with(
+        mock_add_layer_into_image.assert_called_once_with(
+            Path("/c/a:b"),
             Path(mock_control_data_path),
-            Path(f"/c/.temp_layer.control_data.{os.getpid()}.tar"),
-        )
-        expected_cmd = [
-            "umoci",
-            "raw",
-            "add-layer",
-            "--image",
-            "/c/a:b",
-            str(f"/c/.temp_layer.control_data.{os.getpid()}.tar"),
-        ]
-        assert mock_run.mock_calls == [
-            call(
-                [*expected_cmd, "--history.created_by", " ".join(expected_cmd)],
-            )
-        ]
+            image.compression,
+            source_date_epoch=None,
+        )
+        assert not mock_run.called
         mock_rmtree.assert_called_once_with(Path(mock_control_data_path))
 
-    def test_set_annotations(self, mocker):
-        mocker.patch("rockcraft.utils.get_host_command").return_value = "umoci"
-        mock_run = mocker.patch("subprocess.run")
+    def test_write_synthetic_files(self, tmp_path):
+        """The user, Pebble layer and control data can share a layer directory."""
         image = oci.Image("a:b", Path("/c"))
+        layer_dir = tmp_path / "layer"
+        layer_dir.mkdir()
+        base_layer_dir = tmp_path / "base"
+        (base_layer_dir / "etc").mkdir(parents=True)
+        (base_layer_dir / "etc/passwd").write_text("root:x:0:0::/root:/bin/bash\n")
+
+        image.write_user_files(
+            layer_dir,
+            prime_dir=tmp_path / "prime",
+            base_layer_dir=base_layer_dir,
+            username="_daemon_",
+            uid=584792,
+        )
+        image.write_pebble_layer(
+            layer_dir,
+            services={"test": {"override": "replace", "command": "foo"}},
+            checks={},
+            name="rock",
+            summary="summary",
+            description="description",
+            base_layer_dir=base_layer_dir,
+        )
+        image.write_control_data(layer_dir, {"name": "rock"})
+
+        assert sorted(
+            str(path.relative_to(layer_dir))
+            for path in layer_dir.rglob("*")
+            if path.is_file()
+        ) == [
+            ".rock/metadata.yaml",
+            "etc/group",
+            "etc/passwd",
+            "var/lib/pebble/default/layers/001-rockcraft-rock.yaml",
+        ]
+        assert (
+            (layer_dir / "etc/passwd")
+            .read_text()
+            .endswith(
+                "_daemon_:x:584792:584792::/var/lib/pebble/default:/usr/bin/false\n"
+            )
+        )
 
-        image.set_annotations({"NAME1": "VALUE1", "NAME2": "VALUE2"})
+    def test_set_annotations(self, oci_image, mock_run):
+        oci_image.set_annotations({"NAME1": "VALUE1", "NAME2": 2})
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=config.labels",
-                    "--config.label",
-                    "NAME1=VALUE1",
-                    "--config.label",
-                    "NAME2=VALUE2",
-                ],
-                capture_output=True,
-                check=True,
-                text=True,
-            ),
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=manifest.annotations",
-                    "--manifest.annotation",
-                    "NAME1=VALUE1",
-                    "--manifest.annotation",
-                    "NAME2=VALUE2",
-                ],
-                capture_output=True,
-                check=True,
-                text=True,
-            ),
-        ]
+        manifest, config = read_image(oci_image)
+        expected = {"NAME1": "VALUE1", "NAME2": "2"}
+        assert config["config"]["Labels"] == expected
+        assert manifest["annotations"] == expected
+
+        # Previous labels and annotations are cleared
+        oci_image.set_annotations({"NAME3": "VALUE3"})
+
+        manifest, config = read_image(oci_image)
+        assert config["config"]["Labels"] == {"NAME3": "VALUE3"}
+        assert manifest["annotations"] == {"NAME3": "VALUE3"}
+        assert not mock_run.called
+
+    def test_set_media_type(self, oci_image):
+        oci_image.set_media_type()
+
+        manifest, _ = read_image(oci_image)
+        assert manifest["mediaType"] == oci.MANIFEST_MEDIA_TYPE
+
+    def test_config_transaction(self, oci_image, mock_run):
+        blobs_dir = oci_image.path / "a/blobs/sha256"
+        blobs_before = set(blobs_dir.iterdir())
+
+        with oci_image.config_transaction() as config:
+            config.set_default_user(584792, "_daemon_")
+            config.set_entrypoint(["/usr/bin/pebble", "enter"])
+            config.set_cmd(["foo"])
+            config.set_default_path("bare")
+            config.set_environment({"NAME1": "VALUE1"})
+            config.set_annotations({"NAME2": "VALUE2"})
+            config.set_media_type()
+
+            # Nothing is written until the transaction is committed.
+            assert set(blobs_dir.iterdir()) == blobs_before
+
+        assert not mock_run.called
+
+        manifest, config = read_image(oci_image)
+        assert manifest["mediaType"] == oci.MANIFEST_MEDIA_TYPE
+        assert manifest["annotations"] == {"NAME2": "VALUE2"}
+        assert config["config"] == {
+            "Env": [f"PATH={Pebble.DEFAULT_ENV_PATH}", "NAME1=VALUE1"],
+            "User": "584792",
+            "Entrypoint": ["/usr/bin/pebble", "enter"],
+            "Cmd": ["foo"],
+            "Labels": {"NAME2": "VALUE2"},
+        }
+        # A single history entry covers all the edits
+        assert len(config["history"]) == 1
+        assert config["history"][0]["empty_layer"] is True
+
+        # The replaced config and manifest blobs are removed
+        blobs_after = set(blobs_dir.iterdir())
+        assert len(blobs_after) == 2
+        assert not blobs_before & blobs_after
+
+    def test_config_transaction_error(self, oci_image):
+        blobs_dir = oci_image.path / "a/blobs/sha256"
+        blobs_before = set(blobs_dir.iterdir())
+
+        def edit_and_fail():
+            with oci_image.config_transaction() as config:
+                config.set_cmd(["foo"])
+                raise RuntimeError("fail")
+
+        with pytest.raises(RuntimeError):
+            edit_and_fail()
+
+        assert set(blobs_dir.iterdir()) == blobs_before
+        _, config = read_image(oci_image)
+        assert "Cmd" not in config["config"]
 
     def test_inject_oci_fields(self, mock_read_bytes, mock_write_bytes, mock_unlink):
         test_index = {
@@ -936,24 +1341,13 @@ class TestImage:
         ]
         assert mock_loads.called
 
-    def test_set_path_bare(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-
-        image.set_default_path("bare")
+    def test_set_path_bare(self, oci_image, mock_run):
+        oci_image.set_default_path("bare")
 
         expected = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--config.env",
-                    f"PATH={expected}",
-                ]
-            )
-        ]
+        _, config = read_image(oci_image)
+        assert config["config"]["Env"] == [f"PATH={expected}"]
+        assert not mock_run.called
 
     @pytest.mark.parametrize(
         "base",
@@ -965,3 +1359,105 @@ class TestImage:
         image.set_default_path(base)
 
         assert not mock_run.called
+
+    def _write_rock(self, image, tag, architecture, filename, variant=None):
+        """Export ``image`` as an archive, for another architecture."""
+        blobs_dir = image.path / "a/blobs/sha256"
+        manifest, config = read_image(image, "b")
+        config["architecture"] = architecture
+        if variant:
+            config["variant"] = variant
+        manifest["config"] = {**manifest["config"], **write_blob(blobs_dir, config)}
+        oci.set_manifest_descriptor(
+            image.path / f"a:{tag}",
+            {"mediaType": oci.MANIFEST_MEDIA_TYPE, **write_blob(blobs_dir, manifest)},
+        )
+        image.to_oci_archive(tag, filename=filename)
+        return Path(filename)
+
+    def test_merge_oci_archives(self, oci_image, new_dir):
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").write_text("foo")
+        oci_image.add_layer("b", Path("layer_dir"))
+        rocks = [
+            self._write_rock(oci_image, "1.0", "amd64", "rock_amd64.rock"),
+            self._write_rock(oci_image, "1.0", "arm64", "rock_arm64.rock"),
+        ]
+        ppc64el = self._write_rock(oci_image, "1.0", "ppc64le", "rock_ppc64el.rock")
+
+        oci.merge_oci_archives(rocks, Path("rock.rock"))
+        # Merged archives can be merged again
+        oci.merge_oci_archives(
+            [Path("rock.rock"), ppc64el], Path("rock.rock"), tag="stable"
+        )
+
+        with tarfile.open("rock.rock") as archive:
+            names = archive.getnames()
+            archive.extractall("merged", filter="data")
+        assert names[:4] == ["oci-layout", "index.json", "blobs", "blobs/sha256"]
+        # Each blob is stored once: the index, 3 manifests, 3 configs and a
+        # single copy of the shared layer
+        assert len(names) == 4 + 1 + 3 + 3 + 1
+        assert not list(Path().glob(".*.tmp"))
+
+        index = json.loads(Path("merged/index.json").read_text())
+        (descriptor,) = index["manifests"]
+        assert descriptor["mediaType"] == oci.INDEX_MEDIA_TYPE
+        assert descriptor["annotations"] == {
+            "org.opencontainers.image.ref.name": "stable"
+        }
+        image_index = read_blob(Path("merged/blobs/sha256"), descriptor)
+        assert image_index["mediaType"] == oci.INDEX_MEDIA_TYPE
+        assert [m["platform"] for m in image_index["manifests"]] == [
+            {"architecture": "amd64", "os": "linux"},
+            {"architecture": "arm64", "os": "linux", "variant": "v8"},
+            {"architecture": "ppc64le", "os": "linux"},
+        ]
+        assert not any("annotations" in m for m in image_index["manifests"])
+
+        # The layers are copied as they are
+        layers = {
+            layer["digest"]
+            for m in image_index["manifests"]
+            for layer in read_blob(Path("merged/blobs/sha256"), m)["layers"]
+        }
+        (layer_digest,) = layers
+        blob = Path("merged/blobs/sha256", layer_digest.split(":")[-1]).read_bytes()
+        assert hashlib.sha256(blob).hexdigest() == layer_digest.split(":")[-1]
+
+    def test_merge_oci_archives_tag(self, oci_image, new_dir):
+        rock = self._write_rock(oci_image, "1.0", "amd64", "rock_amd64.rock")
+
+        oci.merge_oci_archives([rock], Path("rock.rock"))
+
+        with tarfile.open("rock.rock") as archive:
+            index = json.load(archive.extractfile("index.json"))
+        assert index["manifests"][0]["annotations"] == {
+            "org.opencontainers.image.ref.name": "1.0"
+        }
+
+    def test_merge_oci_archives_same_platform(self, oci_image, new_dir):
+        rocks = [
+            self._write_rock(oci_image, "1.0", "arm64", "first.rock"),
+            self._write_rock(oci_image, "1.0", "arm64", "second.rock", variant="v8"),
+        ]
+
+        with pytest.raises(
+            errors.RockcraftError, match="have an image for linux/arm64/v8"
+        ):
+            oci.merge_oci_archives(rocks, Path("rock.rock"))
+        assert not Path("rock.rock").exists()
+
+    def test_merge_oci_archives_unsupported(self, oci_image, new_dir):
+        rock = self._write_rock(oci_image, "1.0", "arm64", "rock.rock", variant="v6")
+
+        with pytest.raises(
+            errors.RockcraftError, match="unsupported architecture: arm64/v6"
+        ):
+            oci.merge_oci_archives([rock], Path("merged.rock"))
+
+    def test_merge_oci_archives_invalid(self, new_dir):
+        Path("invalid.rock").write_text("not an archive")
+
+        with pytest.raises(errors.RockcraftError, match="Cannot read the OCI archive"):
+            oci.merge_oci_archives([Path("invalid.rock")], Path("merged.rock"))
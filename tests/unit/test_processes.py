@@ -0,0 +1,163 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import subprocess
+import sys
+
+import pytest
+from rockcraft import errors, oci, processes, timings
+
+_SCRIPT = "import sys; print('hello'); sys.exit(int(sys.argv[1]))"
+
+
+def test_run_recording():
+    with processes.recording() as log:
+        result = processes.run(
+            [sys.executable, "-c", _SCRIPT, "0"], capture_output=True, text=True
+        )
+        with processes.recording() as inner_log:
+            with pytest.raises(subprocess.CalledProcessError):
+                processes.run(
+                    [sys.executable, "-c", _SCRIPT, "3"],
+                    capture_output=True,
+                    check=True,
+                )
+    # Commands run after the recording are not in the log
+    processes.run([sys.executable, "-c", "pass"])
+
+    assert result.stdout == "hello\n"
+    first, second = log.records
+    assert first.command == processes.summarize([sys.executable, "-c", _SCRIPT])
+    assert first.argv == (sys.executable, "-c", _SCRIPT, "0")
+    assert first.returncode == 0
+    assert first.stdout_size == len("hello\n")
+    assert first.stderr_size == 0
+    assert first.duration > 0
+    assert second.returncode == 3
+    assert inner_log.records == [second]
+
+    (totals,) = log.totals().values()
+    assert totals.runs == 2
+    assert totals.failures == 1
+    assert totals.stdout_size == 2 * len("hello\n")
+
+
+def test_run_not_found():
+    with processes.recording() as log, pytest.raises(FileNotFoundError):
+        processes.run(["/nonexistent/umoci", "unpack"])
+
+    (record,) = log.records
+    assert record.command == "umoci unpack"
+    assert record.returncode is None
+    assert log.totals()["umoci unpack"].failures == 1
+
+
+def test_run_timings(tmp_path):
+    with timings.record(tmp_path / "timings.json", "test"):
+        processes.run([sys.executable, "-c", "pass"])
+
+    events = json.loads((tmp_path / "timings.json").read_text())["traceEvents"]
+    assert [(e["name"], e["cat"]) for e in events][1] == (
+        f"{sys.executable.rsplit('/', 1)[-1]} pass",
+        "process",
+    )
+
+
+@pytest.mark.parametrize(
+    ("command", "expected"),
+    [
+        ([], ""),
+        (
+            ["/snap/rockcraft/current/bin/umoci", "config", "--image", "a:b"],
+            "umoci config",
+        ),
+        (["skopeo", "--insecure-policy", "copy", "oci:a", "oci:b"], "skopeo copy"),
+        (
+            [
+                "skopeo",
+                "--insecure-policy",
+                "--override-arch",
+                "arm64",
+                "--override-variant",
+                "v8",
+                "copy",
+                "--retry-times",
+                "5",
+                "docker://docker.io/ubuntu:22.04",
+                "oci:images/dir/ubuntu:22.04",
+            ],
+            "skopeo copy",
+        ),
+        (["umoci", "--log", "debug", "unpack", "--image", "a:b"], "umoci unpack"),
+        (["skopeo", "--override-arch=arm64", "inspect", "-n"], "skopeo inspect"),
+        (["true"], "true"),
+    ],
+)
+def test_summarize(command, expected):
+    assert processes.summarize(command) == expected
+
+
+def test_summarize_oci_commands(mocker, tmp_path):
+    mock_run = mocker.patch(
+        "subprocess.run",
+        side_effect=lambda command, **_: subprocess.CompletedProcess(command, 0, ""),
+    )
+    mocker.patch("shutil.which", return_value="/usr/bin/skopeo")
+    with processes.recording() as log:
+        oci.Image.from_docker_registry("ubuntu@22.04", image_dir=tmp_path, arch="arm64")
+
+    # The global options of skopeo and their values are not the subcommand
+    (record,) = log.records
+    assert "--override-variant" in mock_run.call_args.args[0]
+    assert record.command == "skopeo copy"
+
+
+def test_format_totals():
+    log = processes.ProcessLog()
+    for command, duration, returncode in [
+        ("umoci config", 0.5, 0),
+        ("skopeo copy", 2.0, 0),
+        ("umoci config", 0.25, 1),
+    ]:
+        log.add(processes.ProcessRecord(command, (), duration, returncode, 10, 0))
+
+    assert log.format_totals() == (
+        "Ran 3 external commands in 2.750s\n"
+        "  skopeo copy: 1 runs, 2.000s, 10 bytes of output\n"
+        "  umoci config: 2 runs, 0.750s, 20 bytes of output, 1 failed"
+    )
+
+
+def test_process_run_accounting(mocker):
+    """Every umoci and skopeo call of the oci module is accounted for."""
+    mocker.patch("shutil.which", side_effect=lambda name: f"/usr/bin/{name}")
+    mocker.patch(
+        "subprocess.run",
+        side_effect=[
+            subprocess.CompletedProcess([], 0, stdout="", stderr=""),
+            subprocess.CalledProcessError(1, [], stderr="no such image"),
+        ],
+    )
+
+    with processes.recording() as log:
+        oci._process_run(["umoci", "config", "--image", "a:b"])
+        with pytest.raises(errors.RockcraftError, match="no such image"):
+            oci._process_run(["skopeo", "copy", "a", "b"])
+
+    assert [(r.command, r.returncode, r.stderr_size) for r in log.records] == [
+        ("umoci config", 0, 0),
+        ("skopeo copy", 1, len("no such image")),
+    ]
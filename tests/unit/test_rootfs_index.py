@@ -0,0 +1,221 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import hashlib
+import io
+import json
+import tarfile
+from pathlib import Path
+
+import pytest
+from rockcraft import oci
+from rockcraft.rootfs_index import RootfsIndex
+
+
+def make_layer(members: list[tuple[str, bytes, str]]) -> bytes:
+    """Make a gzipped layer tarball from (name, type, contents or link) tuples."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for name, member_type, content in members:
+            info = tarfile.TarInfo(name)
+            info.type = member_type
+            info.mode = 0o755 if member_type != tarfile.REGTYPE else 0o644
+            if member_type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = content
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content.encode()))
+    return gzip.compress(data.getvalue())
+
+
+def write_image(layout_dir: Path, layers: list[bytes]) -> oci.Image:
+    blobs_dir = layout_dir / "blobs/sha256"
+    blobs_dir.mkdir(parents=True)
+
+    def _write(data: bytes) -> dict:
+        digest = hashlib.sha256(data).hexdigest()
+        (blobs_dir / digest).write_bytes(data)
+        return {"digest": f"sha256:{digest}", "size": len(data)}
+
+    manifest = {
+        "schemaVersion": 2,
+        "config": _write(b"{}"),
+        "layers": [
+            {
+                "mediaType": "application/vnd.oci.image.layer.v1.tar+gzip",
+                **_write(layer),
+            }
+            for layer in layers
+        ],
+    }
+    oci.set_manifest_descriptor(
+        Path(f"{layout_dir}:base"),
+        {"mediaType": oci.MANIFEST_MEDIA_TYPE, **_write(json.dumps(manifest).encode())},
+    )
+    return oci.Image(f"{layout_dir.name}:base", layout_dir.parent)
+
+
+@pytest.fixture
+def base_image(tmp_path) -> oci.Image:
+    lower = make_layer(
+        [
+            ("etc", tarfile.DIRTYPE, ""),
+            ("etc/passwd", tarfile.REGTYPE, "root:x:0:0::/root:/bin/bash\n"),
+            ("etc/group", tarfile.REGTYPE, "root:x:0:\n"),
+            ("bin", tarfile.SYMTYPE, "usr/bin"),
+            ("usr", tarfile.DIRTYPE, ""),
+            ("usr/bin", tarfile.DIRTYPE, ""),
+            ("usr/bin/ls", tarfile.REGTYPE, "ls"),
+            ("usr/bin/dir", tarfile.LNKTYPE, "usr/bin/ls"),
+            ("usr/lib/foo.pc", tarfile.REGTYPE, "prefix=/usr\nName: foo\n"),
+            ("opt/old/file", tarfile.REGTYPE, "old"),
+            ("srv/file", tarfile.REGTYPE, "srv"),
+            ("var/lib/pebble/default/layers/001-base.yaml", tarfile.REGTYPE, "{}"),
+        ]
+    )
+    upper = make_layer(
+        [
+            ("etc/group", tarfile.REGTYPE, "root:x:0:\nusers:x:100:\n"),
+            ("opt/.wh..wh..opq", tarfile.REGTYPE, ""),
+            ("opt/new", tarfile.REGTYPE, "new"),
+            ("./srv/.wh.file", tarfile.REGTYPE, ""),
+        ]
+    )
+    return write_image(tmp_path / "ubuntu", [lower, upper])
+
+
+def test_from_image(base_image):
+    index = RootfsIndex.from_image(base_image)
+
+    ls = index.lookup("usr/bin/ls")
+    assert ls is not None
+    assert ls.is_file
+    assert (ls.mode, ls.size) == (0o644, 2)
+    assert ls.digest == hashlib.sha256(b"ls").hexdigest()
+    # Hard links and symlinks lead to the same file
+    assert index.lookup("usr/bin/dir") == ls
+    assert index.lookup("bin/ls") == ls
+    assert index.lookup("/bin/../bin/./ls") == ls
+    bin_link = index.lookup("bin", follow_symlinks=False)
+    assert bin_link is not None
+    assert bin_link.is_symlink
+    assert bin_link.linkname == "usr/bin"
+    # The prefix of pkg-config files is not part of their digest
+    pc = index.lookup("usr/lib/foo.pc")
+    assert pc is not None
+    assert pc.digest == hashlib.sha256(b"prefix=\nName: foo\n").hexdigest()
+
+    # Whiteouts of the upper layer are applied
+    assert index.lookup("opt") is not None
+    assert index.lookup("opt/old") is None
+    assert index.is_file("opt/new")
+    assert index.lookup("srv/file") is None
+    assert not index.is_file("bin/missing")
+    assert not index.is_file("usr/bin/ls/child")
+
+
+def test_save_load(base_image, tmp_path):
+    index = RootfsIndex.from_image(base_image)
+    index_path = tmp_path / "index.json"
+
+    index.save(index_path)
+    loaded = RootfsIndex.load(index_path)
+
+    assert loaded is not None
+    assert len(loaded) == len(index)
+    assert loaded.lookup("bin/ls") == index.lookup("bin/ls")
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+@pytest.mark.parametrize("content", [None, "{", '{"version": 0}', '{"version": 1}'])
+def test_load_unusable(tmp_path, content):
+    index_path = tmp_path / "index.json"
+    if content is not None:
+        index_path.write_text(content)
+
+    assert RootfsIndex.load(index_path) is None
+
+
+def test_extract_to(base_image, tmp_path):
+    index = RootfsIndex.from_image(base_image)
+    rootfs = tmp_path / "rootfs"
+    (rootfs / "stale").mkdir(parents=True)
+
+    index.extract_to(rootfs)
+
+    assert not (rootfs / "stale").exists()
+    # Only the files read from the base have contents
+    assert (rootfs / "etc/group").read_text() == "root:x:0:\nusers:x:100:\n"
+    assert (rootfs / "etc/passwd").exists()
+    assert (rootfs / "var/lib/pebble/default/layers/001-base.yaml").read_text() == "{}"
+    assert not (rootfs / "usr/bin/ls").exists()
+    assert not (rootfs / "opt/new").exists()
+    # All directories and symlinks are there
+    assert (rootfs / "bin").readlink() == Path("usr/bin")
+    assert (rootfs / "usr/lib").is_dir()
+    assert (rootfs / "opt").is_dir()
+    assert not (rootfs / "opt/old").exists()
+
+
+def test_from_image_whiteouts_after_entries(tmp_path):
+    lower = make_layer(
+        [
+            ("opt/old/file", tarfile.REGTYPE, "old"),
+            ("srv/file", tarfile.REGTYPE, "srv"),
+        ]
+    )
+    # The whiteouts come after the entries of the same layer they would hide
+    upper = make_layer(
+        [
+            ("opt/new/file", tarfile.REGTYPE, "new"),
+            ("opt/.wh..wh..opq", tarfile.REGTYPE, ""),
+            ("srv/file", tarfile.REGTYPE, "replaced"),
+            ("srv/.wh.file", tarfile.REGTYPE, ""),
+        ]
+    )
+    index = RootfsIndex.from_image(write_image(tmp_path / "ubuntu", [lower, upper]))
+
+    # Only the entries of the lower layer are hidden
+    assert index.lookup("opt/old") is None
+    assert index.is_file("opt/new/file")
+    assert index.is_file("srv/file")
+
+
+def test_from_image_whiteouts_subtree(tmp_path):
+    lower = make_layer(
+        [
+            ("opt/a/b/file", tarfile.REGTYPE, "a"),
+            ("opt/a-b/file", tarfile.REGTYPE, "a-b"),
+            ("opt/ab", tarfile.REGTYPE, "ab"),
+            ("srv/file", tarfile.REGTYPE, "srv"),
+        ]
+    )
+    upper = make_layer(
+        [
+            ("opt/.wh.a", tarfile.REGTYPE, ""),
+            ("srv", tarfile.REGTYPE, "now a file"),
+        ]
+    )
+    index = RootfsIndex.from_image(write_image(tmp_path / "ubuntu", [lower, upper]))
+
+    # Only the paths under the hidden or replaced directories are gone
+    assert index.lookup("opt/a") is None
+    assert index.lookup("opt/a/b/file", follow_symlinks=False) is None
+    assert index.is_file("opt/a-b/file")
+    assert index.is_file("opt/ab")
+    assert index.is_file("srv")
+    assert len(index) == 5
@@ -0,0 +1,101 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import threading
+
+import pytest
+from rockcraft import timings
+
+
+@timings.timed("test")
+def _timed_function(value):
+    return value * 2
+
+
+def test_record(tmp_path):
+    path = tmp_path / "timings.json"
+
+    with timings.record(path, "root"):
+        with timings.span("outer", "test", detail="foo"):
+            assert _timed_function(2) == 4
+        thread = threading.Thread(target=_timed_function, args=(1,))
+        thread.start()
+        thread.join()
+    assert timings.get_timeline() is None
+
+    data = json.loads(path.read_text())
+    events = data["traceEvents"]
+    # Events are sorted by start time, and nested in time
+    assert [e["name"] for e in events] == [
+        "root",
+        "outer",
+        "_timed_function",
+        "_timed_function",
+    ]
+    root, outer, inner, threaded = events
+    for event in events:
+        assert event["ph"] == "X"
+        assert event["dur"] >= 0
+        assert event["args"]["cpu_time"] >= 0
+        assert event["args"]["max_rss"] > 0
+    assert root["cat"] == "rockcraft"
+    assert outer["args"]["detail"] == "foo"
+    assert inner["cat"] == "test"
+    assert root["ts"] <= outer["ts"] <= inner["ts"]
+    assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+    assert outer["ts"] + outer["dur"] <= root["ts"] + root["dur"]
+    assert threaded["tid"] != inner["tid"]
+
+    assert data["summary"]["_timed_function"]["count"] == 2
+    assert data["summary"]["root"]["count"] == 1
+
+
+def test_record_failure(tmp_path):
+    path = tmp_path / "timings.json"
+
+    with pytest.raises(RuntimeError), timings.record(path, "root"):
+        with timings.span("failed", "test"):
+            raise RuntimeError("failed")
+
+    data = json.loads(path.read_text())
+    assert [e["name"] for e in data["traceEvents"]] == ["root", "failed"]
+
+
+def test_record_disabled(tmp_path):
+    with timings.record(None, "root"):
+        assert timings.get_timeline() is None
+        assert timings.start_span("span", "test") is None
+        with timings.span("span", "test"):
+            assert _timed_function(1) == 2
+
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("content", [None, "rchar: 10\nwchar: 20\n"])
+def test_io_counters(tmp_path, monkeypatch, content):
+    io_path = tmp_path / "io"
+    if content is not None:
+        io_path.write_text(content)
+    monkeypatch.setattr(timings, "_PROC_IO_PATH", io_path)
+    path = tmp_path / "timings.json"
+
+    with timings.record(path, "root"):
+        pass
+
+    (event,) = json.loads(path.read_text())["traceEvents"]
+    expected = 0 if content else None
+    assert event["args"]["read_bytes"] == expected
+    assert event["args"]["written_bytes"] == expected
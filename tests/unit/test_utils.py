@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import re
 from pathlib import Path
 
@@ -97,3 +98,84 @@ def test_parse_command(command, expected):
 def test_parse_command_invalid(command, exception, expected):
     with pytest.raises(exception, match=re.escape(expected)):
         utils.parse_command(command)
+
+
+def test_link_or_copy(tmp_path):
+    source = tmp_path / "source"
+    source.write_text("content")
+    source.chmod(0o640)
+
+    utils.link_or_copy(source, tmp_path / "destination")
+
+    destination = tmp_path / "destination"
+    assert destination.read_text() == "content"
+    assert destination.stat().st_mode & 0o777 == 0o640
+
+
+def test_link_or_copy_no_reflink(tmp_path, mocker):
+    mocker.patch("fcntl.ioctl", side_effect=OSError(95, "Not supported"))
+    source = tmp_path / "source"
+    source.write_text("content")
+
+    utils.link_or_copy(source, tmp_path / "destination")
+
+    assert (tmp_path / "destination").stat().st_ino == source.stat().st_ino
+
+
+def test_link_or_copy_fallback(tmp_path, mocker):
+    mocker.patch("fcntl.ioctl", side_effect=OSError(95, "Not supported"))
+    mocker.patch("os.link", side_effect=OSError(18, "Cross-device link"))
+    source = tmp_path / "source"
+    source.write_text("content")
+
+    utils.link_or_copy(source, tmp_path / "destination")
+
+    destination = tmp_path / "destination"
+    assert destination.read_text() == "content"
+    assert destination.stat().st_ino != source.stat().st_ino
+
+
+def test_link_or_copy_exists(tmp_path):
+    source = tmp_path / "source"
+    source.write_text("content")
+    (tmp_path / "destination").write_text("other")
+
+    with pytest.raises(FileExistsError):
+        utils.link_or_copy(source, tmp_path / "destination")
+
+    assert (tmp_path / "destination").read_text() == "other"
+
+
+@pytest.mark.parametrize("reflink", [True, False])
+def test_link_tree(tmp_path, mocker, reflink):
+    if not reflink:
+        mocker.patch("fcntl.ioctl", side_effect=OSError(95, "Not supported"))
+        mocker.patch("os.link", side_effect=OSError(18, "Cross-device link"))
+    source = tmp_path / "source"
+    (source / "etc/empty").mkdir(parents=True)
+    (source / "etc/passwd").write_text("root:x:0:0")
+    (source / "etc/passwd").chmod(0o600)
+    (source / "bin").symlink_to("usr/bin")
+    (source / "etc").chmod(0o750)
+    os.utime(source / "etc/passwd", ns=(1, 1_000_000_000))
+    os.utime(source / "etc", ns=(1, 2_000_000_000))
+
+    utils.link_tree(source, tmp_path / "destination")
+
+    destination = tmp_path / "destination"
+    assert (destination / "etc/passwd").read_text() == "root:x:0:0"
+    assert (destination / "etc/passwd").stat().st_mode & 0o777 == 0o600
+    assert (destination / "etc/passwd").stat().st_mtime_ns == 1_000_000_000
+    assert (destination / "etc").stat().st_mode & 0o777 == 0o750
+    assert (destination / "etc").stat().st_mtime_ns == 2_000_000_000
+    assert (destination / "etc/empty").is_dir()
+    assert (destination / "bin").readlink() == Path("usr/bin")
+
+
+def test_link_tree_special_file(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    os.mkfifo(source / "fifo")
+
+    with pytest.raises(OSError, match="Cannot copy special file"):
+        utils.link_tree(source, tmp_path / "destination")
@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+#
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2025 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of layer archiving, pruning and OCI operations on synthetic trees.
+
+A prime directory and an extracted base of a configurable shape are generated,
+and each stage of packing a rock is timed on them. The results can be saved
+as a JSON baseline, and compared with the baseline of a previous run:
+
+    tools/benchmark/benchmark.py --shape 100k --output baseline.json
+    tools/benchmark/benchmark.py --shape 100k --baseline baseline.json
+
+The OCI stages need the umoci and skopeo binaries, and no network; they are
+skipped if the binaries are missing.
+"""
+
+import argparse
+import dataclasses
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from craft_cli import EmitterMode, emit
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+import rockcraft
+from rockcraft import errors, layers, oci, timings
+from rockcraft.layer_cache import LayerCache
+from rockcraft.rootfs_index import RootfsIndex
+
+RESULTS_VERSION = 1
+
+# The category of the timeline spans of the benchmark stages.
+_CATEGORY = "benchmark"
+
+# The files of each package in the node_modules-like trees.
+_PACKAGE_FILES = 10
+
+# The architecture directory of the libraries, in the base and the prime.
+_LIB_ARCH_DIR = "x86_64-linux-gnu"
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class TreeShape(NamedTuple):
+    """The shape of the synthetic prime directory and base.
+
+    :param files: The approximate number of regular files in the prime directory.
+    :param node_modules_depth: How deep the node_modules directories are nested.
+    :param node_modules_fanout: How many packages each node_modules directory has.
+    :param large_files: The number of large, incompressible binaries.
+    :param large_file_size: The size of each large binary, in bytes.
+    :param hardlink_ratio: The fraction of the package files that are hard links
+        to a file of an earlier package, like in a pnpm store.
+    :param base_ratio: The fraction of the prime files that are libraries also
+        in the base; most are identical and pruned, some differ.
+    :param usrmerge: Whether ``bin``, ``lib`` and ``sbin`` are symlinks to
+        their ``usr`` counterparts in the base, like on Ubuntu.
+    """
+
+    files: int
+    node_modules_depth: int = 8
+    node_modules_fanout: int = 4
+    large_files: int = 4
+    large_file_size: int = 64 * 1024 * 1024
+    hardlink_ratio: float = 0.1
+    base_ratio: float = 0.2
+    usrmerge: bool = True
+
+
+SHAPES = {
+    "10k": TreeShape(files=10_000, large_files=2, large_file_size=16 * 1024 * 1024),
+    "100k": TreeShape(files=100_000),
+    "1m": TreeShape(files=1_000_000, node_modules_depth=12, large_files=8),
+}
+
+
+class Stage(NamedTuple):
+    """A step of packing a rock, to time.
+
+    :param name: The name of the stage in the results.
+    :param run: The function to time.
+    :param repeatable: Whether the stage can run several times on the same trees.
+    """
+
+    name: str
+    run: Callable[[], Any]
+    repeatable: bool = True
+
+
+class _TreeWriter:
+    """Write the files of a synthetic tree, with deterministic contents."""
+
+    def __init__(self, root: Path, rng: random.Random) -> None:
+        self.root = root
+        self.count = 0
+        self._rng = rng
+
+    def write(self, name: str, content: bytes, mode: int = 0o644) -> Path:
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        path.chmod(mode)
+        self.count += 1
+        return path
+
+    def write_random(self, name: str, size: int) -> None:
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("wb") as file:
+            for offset in range(0, size, _CHUNK_SIZE):
+                file.write(self._rng.randbytes(min(_CHUNK_SIZE, size - offset)))
+        path.chmod(0o755)
+        self.count += 1
+
+    def link(self, name: str, target: Path) -> None:
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.link(target, path)
+        self.count += 1
+
+    def symlink(self, name: str, target: str) -> None:
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.symlink_to(target)
+
+
+def generate_trees(
+    shape: TreeShape, work_dir: Path, *, seed: int = 0
+) -> tuple[Path, Path]:
+    """Generate a prime directory and an extracted base of the given shape.
+
+    :param shape: The shape of the trees.
+    :param work_dir: The directory to create the trees in.
+    :param seed: The seed of the file contents and of the hard links.
+    :returns: The paths of the prime directory and of the base.
+    """
+    rng = random.Random(seed)  # noqa: S311 (not for cryptography)
+    base = _TreeWriter(work_dir / "base", rng)
+    prime = _TreeWriter(work_dir / "prime", rng)
+    base.root.mkdir(parents=True)
+    prime.root.mkdir(parents=True)
+
+    base.write("etc/passwd", b"root:x:0:0:root:/root:/bin/bash\n")
+    base.write("etc/group", b"root:x:0:\n")
+    for name in ("bin", "lib", "sbin"):
+        if shape.usrmerge:
+            base.symlink(name, f"usr/{name}")
+            (base.root / "usr" / name).mkdir(parents=True)
+        else:
+            (base.root / name).mkdir()
+
+    # Libraries of the prime directory, through the usrmerge symlinks of the
+    # base; most of them are identical to the ones of the base.
+    libraries = int(shape.files * shape.base_ratio)
+    for index in range(libraries):
+        name = f"lib/{_LIB_ARCH_DIR}/lib{index}.so.1"
+        content = f"ELF library {index}\n".encode() * 16
+        base.write(name, content)
+        if index % 10 == 0:
+            content = content.replace(b"ELF", b"elf", 1)
+        prime.write(name, content)
+        base.write(f"usr/share/doc/lib{index}/copyright", b"Copyright\n")
+    for index in range(max(1, shape.files // 1000)):
+        prime.write(f"bin/tool{index}", b"#!/bin/sh\n", mode=0o755)
+
+    for index in range(shape.large_files):
+        prime.write_random(f"opt/app/lib/blob{index}.bin", shape.large_file_size)
+
+    # The rest of the files are in node_modules-like trees.
+    remaining = shape.files - prime.count
+    for app in itertools.count():
+        if remaining <= 0 or shape.node_modules_depth < 1:
+            break
+        written = _write_node_modules(prime, shape, f"app{app}", remaining, rng)
+        if not written:
+            break
+        remaining -= written
+
+    return prime.root, base.root
+
+
+def _write_node_modules(
+    tree: _TreeWriter, shape: TreeShape, app: str, budget: int, rng: random.Random
+) -> int:
+    """Write the nested packages of an application, breadth first.
+
+    :returns: The number of files written, at most ``budget`` rounded up to
+        a whole package.
+    """
+    written = 0
+    previous: list[Path] = []
+    queue = [(f"{app}/node_modules", 1)]
+    while queue and written < budget:
+        node_modules, depth = queue.pop(0)
+        for package in range(shape.node_modules_fanout):
+            package_dir = f"{node_modules}/pkg{package}"
+            for index in range(_PACKAGE_FILES):
+                name = f"{package_dir}/lib/file{index}.js"
+                if previous and rng.random() < shape.hardlink_ratio:
+                    tree.link(name, rng.choice(previous))
+                elif index == 0:
+                    # The same license in every package, for deduplication.
+                    tree.write(f"{package_dir}/LICENSE", b"MIT License\n" * 20)
+                else:
+                    content = f"module.exports = {written + index};\n".encode()
+                    previous.append(tree.write(name, content))
+            written += _PACKAGE_FILES
+            if depth < shape.node_modules_depth:
+                queue.append((f"{package_dir}/node_modules", depth + 1))
+        # Only keep a bounded sample of files to link to.
+        del previous[:-1000]
+    return written
+
+
+def _list_files(root: Path) -> set[str]:
+    """Get the files of a tree, relative to it, like the post-prime callback does."""
+    files: set[str] = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative = Path(dirpath).relative_to(root)
+        files.update(str(relative / name) for name in filenames)
+        files.update(
+            str(relative / name)
+            for name in dirnames
+            if (Path(dirpath) / name).is_symlink()
+        )
+    return files
+
+
+def _get_stages(
+    work_dir: Path, prime_dir: Path, base_dir: Path, skipped: dict[str, str]
+) -> Iterator[Stage]:
+    """Get the stages to time, in order.
+
+    The stages that need a missing tool are added to ``skipped``.
+    """
+    stat_cache = layers.StatCache()
+    candidates: dict[str, list[Path]] = {}
+
+    def gather() -> None:
+        nonlocal stat_cache, candidates
+        stat_cache = layers.StatCache()
+        candidates = layers._gather_layer_paths(  # noqa: SLF001
+            prime_dir, base_dir, stat_cache
+        )
+
+    yield Stage("gather_layer_paths", gather)
+    yield Stage(
+        "merge_layer_paths",
+        lambda: layers._merge_layer_paths(  # noqa: SLF001
+            candidates, stat_cache
+        ),
+    )
+    yield Stage(
+        "layer_fingerprint", lambda: layers.layer_fingerprint(prime_dir, base_dir)
+    )
+    yield Stage(
+        "archive_layer",
+        lambda: layers.archive_layer(prime_dir, work_dir / "layer.tar", base_dir),
+    )
+    yield Stage(
+        "archive_layer_deduplicate",
+        lambda: layers.archive_layer(
+            prime_dir, work_dir / "layer.tar", base_dir, deduplicate=True
+        ),
+    )
+
+    oci_stages = list(_get_oci_stages(work_dir, prime_dir, base_dir))
+    missing = [tool for tool in ("umoci", "skopeo") if shutil.which(tool) is None]
+    if missing:
+        reason = f"{' and '.join(missing)} not found"
+        skipped.update(dict.fromkeys((stage.name for stage in oci_stages), reason))
+    else:
+        yield from oci_stages
+
+    # Last, because it removes files from the prime directory.
+    files = _list_files(prime_dir)
+    yield Stage(
+        "prune_prime_files",
+        lambda: layers.prune_prime_files(prime_dir, files, base_dir),
+        repeatable=False,
+    )
+
+
+def _get_oci_stages(work_dir: Path, prime_dir: Path, base_dir: Path) -> Iterator[Stage]:
+    """Get the stages that work on OCI images, with umoci and skopeo."""
+    image_dir = work_dir / "images"
+    archive_path = work_dir / "rock.rock"
+    image = oci.Image("base:base", image_dir)
+    bundles = itertools.count()
+
+    def new_image() -> None:
+        nonlocal image
+        image = oci.Image.new_oci_image("base@latest", image_dir, arch="amd64")[0]
+
+    def add_base_layer() -> None:
+        nonlocal image
+        image = image.add_layer("base", base_dir)
+
+    yield Stage("new_oci_image", new_image)
+    yield Stage("add_base_layer", add_base_layer)
+    yield Stage("index_base", lambda: RootfsIndex.from_image(image))
+    yield Stage(
+        "extract_to",
+        lambda: image.extract_to(work_dir / f"bundle{next(bundles)}", rootless=True),
+    )
+    # Like when packing a rock, the new layer is fingerprinted, first with no
+    # layer to reuse, then with the one just added.
+    yield Stage(
+        "add_layer",
+        lambda: dataclasses.replace(image, layer_cache=LayerCache()).add_layer(
+            "rock", prime_dir, base_dir
+        ),
+    )
+    yield Stage(
+        "add_layer_cached",
+        lambda: image.with_layer_cache().add_layer("cached", prime_dir, base_dir),
+    )
+    yield Stage(
+        "to_oci_archive", lambda: image.to_oci_archive("rock", str(archive_path))
+    )
+    yield Stage(
+        "merge_oci_archives",
+        lambda: oci.merge_oci_archives([archive_path], work_dir / "merged.rock"),
+    )
+    yield Stage(
+        "copy_to",
+        lambda: oci.Image("base:rock", image_dir).copy_to(
+            "copy:rock", image_dir=work_dir / "copies"
+        ),
+    )
+
+
+def run_benchmark(
+    shape: TreeShape,
+    work_dir: Path,
+    *,
+    repeat: int = 1,
+    seed: int = 0,
+    trace_path: Path | None = None,
+) -> dict[str, Any]:
+    """Generate the trees, and time each stage on them.
+
+    :param shape: The shape of the trees.
+    :param work_dir: The directory for the trees and the images.
+    :param repeat: How many times to run each repeatable stage, keeping the
+        fastest run.
+    :param seed: The seed of the trees.
+    :param trace_path: Where to write the timeline of the whole run, with the
+        spans of rockcraft itself; by default, in ``work_dir``.
+    :returns: The results, to save as a baseline.
+    """
+    emit.progress(f"Generating {shape.files} files in {str(work_dir)!r}")
+    prime_dir, base_dir = generate_trees(shape, work_dir, seed=seed)
+
+    skipped: dict[str, str] = {}
+    best: dict[str, dict[str, Any]] = {}
+    with timings.record(trace_path or work_dir / "trace.json", "benchmark"):
+        timeline = timings.get_timeline()
+        for stage in _get_stages(work_dir, prime_dir, base_dir, skipped):
+            for _ in range(repeat if stage.repeatable else 1):
+                with timings.span(stage.name, _CATEGORY):
+                    stage.run()
+                result = _get_result(timeline, stage.name)
+                if (
+                    stage.name not in best
+                    or result["duration"] < best[stage.name]["duration"]
+                ):
+                    best[stage.name] = result
+            emit.progress(f"{stage.name}: {best[stage.name]['duration']:.3f}s")
+
+    return {
+        "version": RESULTS_VERSION,
+        "shape": shape._asdict(),
+        "seed": seed,
+        "environment": {
+            "rockcraft": rockcraft.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "stages": best,
+        "skipped": skipped,
+    }
+
+
+def _get_result(timeline: timings.Timeline | None, name: str) -> dict[str, Any]:
+    """Get the usage of the last run of a stage, from its span."""
+    span = next(
+        span
+        for span in reversed(timeline.spans if timeline else [])
+        if span["category"] == _CATEGORY and span["name"] == name
+    )
+    return {
+        "duration": span["duration"] / 1_000_000,
+        "cpu_time": span["cpu_time"],
+        "max_rss": span["max_rss"],
+        "read_bytes": span["read_bytes"],
+        "written_bytes": span["written_bytes"],
+    }
+
+
+def compare_results(
+    results: dict[str, Any],
+    baseline: dict[str, Any],
+    *,
+    threshold: float,
+    min_delta: float,
+) -> list[str]:
+    """Compare the duration of each stage with a baseline.
+
+    :param results: The results of this run.
+    :param baseline: The results of a previous run.
+    :param threshold: How much slower than the baseline a stage can be, as a
+        fraction of the baseline duration.
+    :param min_delta: How much slower than the baseline a stage can always be,
+        in seconds, so that very short stages are not flagged for noise.
+    :returns: The stages that regressed.
+    :raises RockcraftError: If the runs were not done on the same trees.
+    """
+    for key in ("version", "shape", "seed"):
+        if results.get(key) != baseline.get(key):
+            raise errors.RockcraftError(
+                f"Cannot compare with the baseline: different {key}",
+                resolution="Run the benchmark with the options of the baseline.",
+            )
+
+    regressions: list[str] = []
+    emit.message(f"{'stage':<28}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, result in results["stages"].items():
+        previous = baseline["stages"].get(name)
+        if previous is None:
+            emit.message(f"{name:<28}{'-':>12}{result['duration']:>11.3f}s")
+            continue
+        before, after = previous["duration"], result["duration"]
+        change = (after - before) / before if before else 0.0
+        regressed = after > before * (1 + threshold) and after - before >= min_delta
+        emit.message(
+            f"{name:<28}{before:>11.3f}s{after:>11.3f}s{change:>+10.1%}"
+            + ("  REGRESSION" if regressed else "")
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def _get_shape(args: argparse.Namespace) -> TreeShape:
+    """Get the preset shape, with the options that override it."""
+    shape = SHAPES[args.shape]
+    overrides = {
+        field: getattr(args, field)
+        for field in shape._fields
+        if getattr(args, field, None) is not None
+    }
+    return shape._replace(**overrides)
+
+
+def _parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shape", choices=SHAPES, default="10k")
+    parser.add_argument("--files", type=int, help="Override the number of files")
+    parser.add_argument("--node-modules-depth", type=int)
+    parser.add_argument("--node-modules-fanout", type=int)
+    parser.add_argument("--large-files", type=int)
+    parser.add_argument("--large-file-size", type=int, help="In bytes")
+    parser.add_argument("--hardlink-ratio", type=float)
+    parser.add_argument("--base-ratio", type=float)
+    parser.add_argument(
+        "--no-usrmerge", dest="usrmerge", action="store_false", default=None
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Keep the fastest of several runs"
+    )
+    parser.add_argument(
+        "--work-dir", type=Path, help="Keep the trees in this directory"
+    )
+    parser.add_argument("--output", type=Path, help="Write the results to this file")
+    parser.add_argument("--trace", type=Path, help="Write the timeline to this file")
+    parser.add_argument(
+        "--baseline", type=Path, help="Compare the results with a previous run"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="The allowed slowdown of a stage, as a fraction (default: 0.2)",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=0.1,
+        help="The slowdown of a stage that is always allowed, in seconds "
+        "(default: 0.1)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str]) -> int:
+    """Run the benchmark.
+
+    :returns: 1 if a stage regressed compared to the baseline, 0 otherwise.
+    """
+    args = _parse_args(argv)
+    shape = _get_shape(args)
+    with tempfile.TemporaryDirectory(prefix="rockcraft-benchmark-") as temp_dir:
+        work_dir = args.work_dir or Path(temp_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        emit.init(
+            EmitterMode.BRIEF,
+            "rockcraft-benchmark",
+            f"Running the {args.shape} benchmark",
+        )
+        try:
+            results = run_benchmark(
+                shape,
+                work_dir,
+                repeat=args.repeat,
+                seed=args.seed,
+                trace_path=args.trace,
+            )
+            if args.output:
+                args.output.write_text(json.dumps(results, indent=2) + "\n")
+            for name, reason in results["skipped"].items():
+                emit.message(f"Skipped {name}: {reason}")
+
+            regressions: list[str] = []
+            if args.baseline:
+                baseline = json.loads(args.baseline.read_text())
+                regressions = compare_results(
+                    results,
+                    baseline,
+                    threshold=args.threshold,
+                    min_delta=args.min_delta,
+                )
+        except errors.RockcraftError as err:
+            emit.error(err)
+            return 2
+        except BaseException:
+            emit.ended_ok()
+            raise
+
+        if regressions:
+            emit.message(f"Regressions: {', '.join(regressions)}")
+        emit.ended_ok()
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))